@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compressed, deduplicated archive of armory snapshots.
+
+Instead of one loose XML file per entity and run, snapshots are packed into
+append-only segment files under the archive directory:
+
+    archive/segment-000001.dat  zlib compressed blocks, appended to
+    archive/index.db            SQLite index of blocks and snapshots
+
+Each document is cut into blocks at content defined boundaries (the end of
+a tag whose crc32 matches BLOCK_MASK), so a change in one part of a
+character sheet only changes the blocks around it. Blocks are addressed by
+their sha1 and stored only once, no matter how many snapshots contain
+them. A snapshot is a row (kind, realm, name, time) with the list of its
+blocks, so disk use grows with what actually changed.
+
+kind is one of "guild", "char", "item" and "tooltip", realm is '' for items.
+
+    archive = Archive()
+    archive.put("char", "Trollbane", "Aabacus", data)
+    data = archive.get("char", "Trollbane", "Aabacus", timestamp)
+
+The archive expects to be written by one process at a time.
+
+armoarchive.py
+    -h, --help              Show help - what you are reading now.
+    -k ..., --kind=...      Kind of snapshots (default char).
+    -r ..., --realm=...     Set realm.
+    -n ..., --name=...      Name of the guild/character, or item id.
+    -t ..., --time=...      Print the snapshot as it was at this time
+                            (seconds since the epoch), default the latest.
+    -l, --list              List the snapshots of the name.
+    --import=...            Import the loose XML files in the given dump
+                            directory (chars/, items/ or guilds/), using their
+                            modification times as snapshot times.
+    --dir=...               Archive directory (default ./archive).
+"""
+
+import os
+import re
+import sys
+import time
+import zlib
+import getopt
+import hashlib
+import sqlite3
+import threading
+
+ARCHIVE_DIR = "archive/"
+SEGMENT_SIZE = 64 * 1024 * 1024
+BLOCK_MASK = 0x1f           # => a block ends after ~32 tags on average
+MIN_BLOCK = 512
+MAX_BLOCK = 16 * 1024
+COMPRESS_LEVEL = 6
+DIGEST_SIZE = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    digest BLOB PRIMARY KEY,
+    segment INTEGER,
+    offset INTEGER,
+    length INTEGER
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    kind TEXT,
+    realm TEXT,
+    name TEXT,
+    time REAL,
+    size INTEGER,
+    digest BLOB,
+    blocks BLOB
+);
+CREATE INDEX IF NOT EXISTS snapshots_key ON snapshots (kind, realm, name, time);
+"""
+
+_SPLIT_RE = re.compile(r"[^>]*>|[^>]+$")
+
+
+def split_blocks(data):
+    """Cut data into blocks at content defined tag boundaries."""
+    blocks = []
+    start = size = 0
+    for m in _SPLIT_RE.finditer(data):
+        piece = m.group()
+        size += len(piece)
+        if size >= MAX_BLOCK or (size >= MIN_BLOCK and
+                zlib.crc32(piece) & BLOCK_MASK == 0):
+            blocks.append(data[start:m.end()])
+            start = m.end()
+            size = 0
+    if start < len(data):
+        blocks.append(data[start:])
+    return blocks
+
+
+class Archive(object):
+    """Snapshot archive in directory 'dir'."""
+
+    def __init__(self, dir=ARCHIVE_DIR, segment_size=SEGMENT_SIZE):
+        self.dir = dir
+        self.segment_size = segment_size
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(dir, "index.db"),
+                check_same_thread=False)
+        self._db.text_factory = str
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        segment = self._db.execute("SELECT MAX(segment) FROM blocks").fetchone()[0]
+        self._segment = segment or 1
+        self._out = None
+        self._readers = {}
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._out is not None:
+                self._out.close()
+                self._out = None
+            for f in self._readers.values():
+                f.close()
+            self._readers = {}
+            self._db.close()
+        finally:
+            self._lock.release()
+
+    def _get_segment_path(self, segment):
+        return os.path.join(self.dir, "segment-%06d.dat" % segment)
+
+    def _append(self, data):
+        """Append data to the current segment, return (segment, offset)."""
+        if self._out is None:
+            self._out = open(self._get_segment_path(self._segment), 'ab')
+        self._out.seek(0, 2)
+        offset = self._out.tell()
+        if offset and offset + len(data) > self.segment_size:
+            self._out.close()
+            self._segment += 1
+            self._out = open(self._get_segment_path(self._segment), 'ab')
+            offset = 0
+        self._out.write(data)
+        return self._segment, offset
+
+    def _store_blocks(self, blocks):
+        digests = []
+        for block in blocks:
+            digest = hashlib.sha1(block).digest()
+            digests.append(digest)
+            row = self._db.execute("SELECT 1 FROM blocks WHERE digest = ?",
+                    (sqlite3.Binary(digest),)).fetchone()
+            if row is not None:
+                continue
+            packed = zlib.compress(block, COMPRESS_LEVEL)
+            segment, offset = self._append(packed)
+            self._db.execute("INSERT INTO blocks VALUES (?, ?, ?, ?)",
+                    (sqlite3.Binary(digest), segment, offset, len(packed)))
+        return digests
+
+    def put(self, kind, realm, name, data, timestamp=None):
+        """Add a snapshot of data (a str) taken at 'timestamp' (default now)."""
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        if isinstance(realm, unicode):
+            realm = realm.encode('utf-8')
+        digest = hashlib.sha1(data).digest()
+        self._lock.acquire()
+        try:
+            latest = self._db.execute("SELECT digest, blocks FROM snapshots "
+                    "WHERE kind = ? AND realm = ? AND name = ? "
+                    "ORDER BY time DESC LIMIT 1", (kind, realm, name)).fetchone()
+            if latest is not None and str(latest[0]) == digest:
+                blocks = latest[1]
+            else:
+                blocks = "".join(self._store_blocks(split_blocks(data)))
+                if self._out is not None:
+                    self._out.flush()
+                    os.fsync(self._out.fileno())
+            self._db.execute("INSERT INTO snapshots "
+                    "(kind, realm, name, time, size, digest, blocks) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", (kind, realm, name,
+                    timestamp, len(data), sqlite3.Binary(digest),
+                    sqlite3.Binary(blocks)))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def _read_block(self, digest):
+        segment, offset, length = self._db.execute("SELECT segment, offset, "
+                "length FROM blocks WHERE digest = ?",
+                (sqlite3.Binary(digest),)).fetchone()
+        f = self._readers.get(segment)
+        if f is None:
+            if self._out is not None:
+                self._out.flush()
+            f = self._readers[segment] = open(self._get_segment_path(segment), 'rb')
+        f.seek(offset)
+        return zlib.decompress(f.read(length))
+
+    def get(self, kind, realm, name, timestamp=None):
+        """Return the snapshot as it was at 'timestamp' (the latest one taken
+        at or before it), default the latest. None if there is none."""
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        if isinstance(realm, unicode):
+            realm = realm.encode('utf-8')
+        if timestamp is None:
+            timestamp = float("inf")
+        self._lock.acquire()
+        try:
+            row = self._db.execute("SELECT blocks FROM snapshots "
+                    "WHERE kind = ? AND realm = ? AND name = ? AND time <= ? "
+                    "ORDER BY time DESC LIMIT 1",
+                    (kind, realm, name, timestamp)).fetchone()
+            if row is None:
+                return None
+            blocks = str(row[0])
+            return "".join([self._read_block(blocks[i:i + DIGEST_SIZE])
+                for i in range(0, len(blocks), DIGEST_SIZE)])
+        finally:
+            self._lock.release()
+
+    def history(self, kind, realm, name):
+        """[(time, size), ...] of the snapshots of a name, oldest first."""
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        if isinstance(realm, unicode):
+            realm = realm.encode('utf-8')
+        self._lock.acquire()
+        try:
+            return self._db.execute("SELECT time, size FROM snapshots "
+                    "WHERE kind = ? AND realm = ? AND name = ? ORDER BY time",
+                    (kind, realm, name)).fetchall()
+        finally:
+            self._lock.release()
+
+    def names(self, kind, realm=None):
+        """Names with snapshots of 'kind' (in realm if given)."""
+        sql = "SELECT DISTINCT name FROM snapshots WHERE kind = ?"
+        args = [kind]
+        if realm is not None:
+            sql += " AND realm = ?"
+            args.append(realm)
+        self._lock.acquire()
+        try:
+            return [row[0] for row in self._db.execute(sql, args)]
+        finally:
+            self._lock.release()
+
+    def import_dir(self, dir, realm=''):
+        """Import the files of a chars/, items/ or guilds/ dump directory,
+        return the number of files imported."""
+        count = 0
+        for filename in sorted(os.listdir(dir)):
+            if not filename.endswith('.xml'):
+                continue
+            path = os.path.join(dir, filename)
+            kind, file_realm, name = get_key_from_filename(dir, filename, realm)
+            f = open(path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            self.put(kind, file_realm, name, data, os.path.getmtime(path))
+            count += 1
+        return count
+
+
+def get_key_from_filename(dir, filename, realm=''):
+    """(kind, realm, name) of a file written by the armoread dump_* helpers."""
+    base = filename[:-len('.xml')]
+    dir_name = os.path.basename(os.path.normpath(dir))
+    if dir_name == "items":
+        if base.endswith('-tooltip'):
+            return "tooltip", '', base[:-len('-tooltip')]
+        return "item", '', base
+    if dir_name == "guilds" and ' - ' in base:
+        guild_realm, guild = base.split(' - ', 1)
+        return "guild", guild_realm, guild
+    return "char", realm, base
+
+
+def usage():
+    print __doc__
+
+def _main(argv):
+    class Flags: pass
+    flags = Flags()
+    flags.dir = ARCHIVE_DIR
+    flags.kind = "char"
+    flags.realm = 'Trollbane'
+    flags.name = None
+    flags.time = None
+    flags.list = False
+    flags.imports = []
+    try:
+        opts, args = getopt.getopt(argv, "hk:r:n:t:l", ["help", "kind=",
+            "realm=", "name=", "time=", "list", "import=", "dir="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ('-k', '--kind'):
+            flags.kind = arg
+        elif opt in ('-r', '--realm'):
+            flags.realm = arg
+        elif opt in ('-n', '--name'):
+            flags.name = arg
+        elif opt in ('-t', '--time'):
+            flags.time = float(arg)
+        elif opt in ('-l', '--list'):
+            flags.list = True
+        elif opt == '--import':
+            flags.imports.append(arg)
+        elif opt == '--dir':
+            flags.dir = arg
+
+    archive = Archive(flags.dir)
+    realm = flags.realm
+    if flags.kind in ("item", "tooltip"):
+        realm = ''
+    try:
+        for dir in flags.imports:
+            print "imported %d files from '%s'" % (archive.import_dir(dir, realm), dir)
+        if flags.name is None:
+            return
+        if flags.list:
+            for timestamp, size in archive.history(flags.kind, realm, flags.name):
+                print "%s %12.1f %8d" % (time.strftime("%Y-%m-%d %H:%M:%S",
+                    time.localtime(timestamp)), timestamp, size)
+        else:
+            data = archive.get(flags.kind, realm, flags.name, flags.time)
+            if data is None:
+                print >> sys.stderr, "no snapshot"
+                sys.exit(1)
+            sys.stdout.write(data)
+    finally:
+        archive.close()
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Batch runs over many guilds, characters and items, in several areas and
+realms.
+
+Targets are read from a JSON manifest, a list of objects like:
+
+    [{"area": "EU", "realm": "Trollbane", "guild": "Emerge"},
+     {"area": "US", "realm": "Argent Dawn", "char": "Aabacus"},
+     {"area": "EU", "item": 50415}]
+
+and added to a work queue kept in a SQLite database. Worker processes take
+jobs from the queue until it is empty: a guild job dumps the guild-info and
+queues a job per member, a char job dumps the character sheet (and with
+--items queues a job per item, gem and enchant worn), an item job dumps the
+item's info and tooltip. Each (kind, area, realm, name) is queued once, so
+a character in two guilds' rosters or an item worn by a whole raid is
+fetched once.
+
+Files end up under the output directory, per area and realm:
+
+    batch/EU/Trollbane/guilds/Emerge.xml
+    batch/EU/Trollbane/chars/Aabacus.xml
+    batch/EU/items/50415.xml, batch/EU/items/50415-tooltip.xml
+
+Done jobs stay done, so a run that crashed or was stopped is resumed by
+running again: jobs of workers that are gone are put back in the queue,
+nothing already done is fetched again. Failed jobs are retried up to
+MAX_ATTEMPTS times, RETRY_DELAY seconds later, twice that after the second
+failure and so on.
+
+Every worker process has its own connections and rate limit (--rate
+applies per process), they share the response cache.
+
+armobatch.py
+    -h, --help              Show help - what you are reading now.
+    -m ..., --manifest=...  Queue the targets of a manifest, several can be
+                            given.
+    -p ..., --processes=... Number of worker processes (default 2).
+    -j ..., --jobs=...      Downloads at once per worker (default 4).
+    --rate=...              Max requests per second to each armory host, per
+                            worker (default 5, 0 for no limit).
+    --items                 Queue the items worn by each character too.
+    --queue=...             Queue database (default ./batch.db).
+    --out=...               Output directory (default ./batch).
+    --status                Print the number of jobs per state and exit.
+    --retry-failed          Put failed jobs back in the queue.
+"""
+
+import os
+import sys
+import time
+import json
+import errno
+import getopt
+import socket
+import sqlite3
+import threading
+import multiprocessing
+from cStringIO import StringIO
+
+import armoread
+import armonet
+import armoxml
+
+QUEUE_DB = "batch.db"
+OUT_DIR = "batch/"
+PROCESSES = 2
+MAX_ATTEMPTS = 3
+# seconds before a failed job is tried again, doubled with every attempt
+RETRY_DELAY = 5.0
+POLL = 0.5
+# seconds a worker waits on jobs other workers are running without any
+# progress, before it gives up on them
+STALL_TIMEOUT = 300
+KINDS = ("guild", "char", "item")
+
+PENDING, RUNNING, DONE, FAILED = range(4)
+STATE_NAMES = ("pending", "running", "done", "failed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT,
+    area TEXT,
+    realm TEXT,
+    name TEXT,
+    state INTEGER DEFAULT 0,
+    attempts INTEGER DEFAULT 0,
+    host TEXT,
+    pid INTEGER,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    not_before REAL,
+    UNIQUE (kind, area, realm, name)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+"""
+
+
+class WorkQueue(object):
+    """Jobs (kind, area, realm, name) in the SQLite database 'path'.
+
+    Can be shared by the threads of a process, each process needs its own
+    WorkQueue (connection).
+    """
+
+    def __init__(self, path=QUEUE_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+
+    def _transaction(self, func, *args):
+        """Run func(db, *args) in a write transaction, return its result."""
+        self._lock.acquire()
+        try:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._db, *args)
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+        finally:
+            self._lock.release()
+
+    def add(self, jobs):
+        """Queue jobs, [(kind, area, realm, name), ...], unless already
+        queued. Return the number of new jobs."""
+        def add(db):
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO jobs (kind, area, realm, name) "
+                    "VALUES (?, ?, ?, ?)", [(kind, area, realm, unicode(name))
+                    for kind, area, realm, name in jobs])
+            return db.total_changes - before
+        return self._transaction(add)
+
+    def claim(self, n):
+        """Mark up to n pending jobs as run by this process and return them,
+        [(id, kind, area, realm, name), ...]. Jobs waiting to be retried
+        aren't claimed before their time."""
+        def claim(db):
+            rows = db.execute("SELECT id, kind, area, realm, name FROM jobs "
+                    "WHERE state = ? AND (not_before IS NULL OR not_before <= ?) "
+                    "ORDER BY id LIMIT ?", (PENDING, time.time(), n)).fetchall()
+            db.executemany("UPDATE jobs SET state = ?, host = ?, pid = ?, "
+                    "started = ? WHERE id = ?", [(RUNNING, socket.gethostname(),
+                    os.getpid(), time.time(), row[0]) for row in rows])
+            return rows
+        return self._transaction(claim)
+
+    def done(self, job_id):
+        self._transaction(lambda db: db.execute("UPDATE jobs SET state = ?, "
+                "finished = ?, error = NULL WHERE id = ?",
+                (DONE, time.time(), job_id)))
+
+    def fail(self, job_id, error):
+        """Put a job back in the queue to be retried after a delay (see
+        RETRY_DELAY), or mark it failed after MAX_ATTEMPTS."""
+        def fail(db):
+            attempts = db.execute("SELECT attempts FROM jobs WHERE id = ?",
+                    (job_id,)).fetchone()[0] + 1
+            if attempts < MAX_ATTEMPTS:
+                state = PENDING
+            else:
+                state = FAILED
+            now = time.time()
+            db.execute("UPDATE jobs SET state = ?, attempts = ?, error = ?, "
+                    "finished = ?, not_before = ? WHERE id = ?", (state,
+                    attempts, error, now, now + RETRY_DELAY * 2 ** (attempts - 1),
+                    job_id))
+        self._transaction(fail)
+
+    def recover(self):
+        """Put jobs claimed by processes on this host that are gone back in
+        the queue, return how many."""
+        def recover(db):
+            host = socket.gethostname()
+            stale = [row[0] for row in db.execute("SELECT id, pid FROM jobs "
+                    "WHERE state = ? AND host = ?", (RUNNING, host))
+                    if not is_alive(row[1])]
+            db.executemany("UPDATE jobs SET state = ? WHERE id = ?",
+                    [(PENDING, id) for id in stale])
+            return len(stale)
+        return self._transaction(recover)
+
+    def release(self):
+        """Put the jobs still marked as run by this process back in the
+        queue, return how many."""
+        return self._transaction(lambda db: db.execute("UPDATE jobs SET "
+                "state = ? WHERE state = ? AND host = ? AND pid = ?", (PENDING,
+                RUNNING, socket.gethostname(), os.getpid())).rowcount)
+
+    def retry_failed(self):
+        return self._transaction(lambda db: db.execute("UPDATE jobs SET "
+                "state = ?, attempts = 0, not_before = NULL WHERE state = ?",
+                (PENDING, FAILED)).rowcount)
+
+    def counts(self):
+        """{state name: number of jobs}"""
+        self._lock.acquire()
+        try:
+            rows = self._db.execute("SELECT state, COUNT(*) FROM jobs "
+                    "GROUP BY state").fetchall()
+        finally:
+            self._lock.release()
+        counts = dict([(name, 0) for name in STATE_NAMES])
+        for state, count in rows:
+            counts[STATE_NAMES[state]] = count
+        return counts
+
+    def failures(self):
+        """[(kind, area, realm, name, error), ...] of the failed jobs."""
+        self._lock.acquire()
+        try:
+            return self._db.execute("SELECT kind, area, realm, name, error "
+                    "FROM jobs WHERE state = ? ORDER BY id", (FAILED,)).fetchall()
+        finally:
+            self._lock.release()
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def read_manifest(path):
+    """[(kind, area, realm, name), ...] of the targets in a manifest."""
+    f = open(path, 'rb')
+    try:
+        targets = json.load(f)
+    finally:
+        f.close()
+    jobs = []
+    for target in targets:
+        area = target.get("area", armoread.SERVER_AREA).upper()
+        if area not in armoread.BASE_URLs:
+            raise ValueError("unknown area %r in %s" % (area, path))
+        for kind in KINDS:
+            if kind in target:
+                realm = kind != "item" and target["realm"] or u''
+                jobs.append((kind, area, realm, target[kind]))
+                break
+        else:
+            raise ValueError("no guild, char or item in %r" % (target,))
+    return jobs
+
+
+def get_path(out_dir, area, realm, *parts):
+    if realm:
+        return os.path.join(out_dir, area, realm, *parts)
+    return os.path.join(out_dir, area, *parts)
+
+def fetch_to_file(url, filename):
+    """Fetch url, write it to filename (making its directory) and return
+    the data."""
+    data = armoread.open_url(url).read()
+    dir = os.path.dirname(filename)
+    if not os.path.isdir(dir):
+        try:
+            os.makedirs(dir)
+        except OSError, e:
+            # another worker made it first
+            if e.errno != errno.EEXIST:
+                raise
+    armoread.write_str_to_file(data, filename)
+    return data
+
+def run_job(queue, job, out_dir, items=False):
+    """Run a job claimed from queue, queue the jobs it leads to and mark it
+    done (or failed). A job that can't be marked stays running until work()
+    releases it."""
+    job_id, kind, area, realm, name = job
+    base_url = armoread.BASE_URLs[area]
+    try:
+        new_jobs = []
+        if kind == "guild":
+            url = armoread.get_guildinfo_url(name, realm, base_url)
+            data = fetch_to_file(url, get_path(out_dir, area, realm, "guilds",
+                name + '.xml'))
+            new_jobs = [("char", area, realm, record.name)
+                    for record in armoxml.iter_roster(StringIO(data))]
+        elif kind == "char":
+            url = armoread.get_charactersheet_url(name, realm, base_url)
+            data = fetch_to_file(url, get_path(out_dir, area, realm, "chars",
+                name + '.xml'))
+            if items:
+                char = armoread.Character(name, realm, base_url)
+                char.parse_reader(StringIO(data))
+                new_jobs = [("item", area, u'', unicode(id))
+                        for slot, id in char.get_item_ids()]
+        else:
+            fetch_to_file(armoread.get_iteminfo_url(name, base_url),
+                    get_path(out_dir, area, '', "items", name + '.xml'))
+            fetch_to_file(armoread.get_itemtooltip_url(name, base_url),
+                    get_path(out_dir, area, '', "items", name + '-tooltip.xml'))
+        if new_jobs:
+            queue.add(new_jobs)
+    except Exception, e:
+        queue.fail(job_id, "%s: %s" % (e.__class__.__name__, e))
+    else:
+        queue.done(job_id)
+
+def get_job_url(job):
+    job_id, kind, area, realm, name = job
+    base_url = armoread.BASE_URLs[area]
+    if kind == "guild":
+        return armoread.get_guildinfo_url(name, realm, base_url)
+    if kind == "char":
+        return armoread.get_charactersheet_url(name, realm, base_url)
+    return armoread.get_iteminfo_url(name, base_url)
+
+def work(queue_path=QUEUE_DB, out_dir=OUT_DIR, jobs=armonet.MAX_JOBS, items=False,
+        rate=None):
+    """Run jobs from the queue until there are none left, in this process.
+
+    A worker only stops once no job is pending or running anywhere, as a
+    running guild or char job may still queue more, or when the jobs other
+    workers run haven't moved for STALL_TIMEOUT seconds.
+
+    rate -- max requests per second to each host, default armoread's."""
+    if rate is not None:
+        armoread.get_session().limiter = armonet.RateLimiter(rate)
+    queue = WorkQueue(queue_path)
+    pool = armonet.FetchPool(jobs)
+    last_counts, since = None, time.time()
+    try:
+        while True:
+            batch = queue.claim(jobs * 2)
+            if not batch:
+                if queue.recover():
+                    continue
+                counts = queue.counts()
+                if not counts["pending"] and not counts["running"]:
+                    break
+                if counts["pending"] or counts != last_counts:
+                    # pending jobs are only waiting for their retry
+                    last_counts, since = counts, time.time()
+                elif time.time() - since > STALL_TIMEOUT:
+                    print >> sys.stderr, "giving up on %d stuck running jobs" % (
+                            counts["running"])
+                    break
+                time.sleep(POLL)
+                continue
+            for job in batch:
+                pool.add(get_job_url(job), run_job, queue, job, out_dir, items)
+            pool.join()
+            # jobs whose done/fail bookkeeping failed are still marked as
+            # ours, if this fails too the worker dies and recover() frees them
+            queue.release()
+    finally:
+        queue.close()
+
+def run(queue_path=QUEUE_DB, out_dir=OUT_DIR, processes=PROCESSES,
+        jobs=armonet.MAX_JOBS, items=False, rate=None):
+    """Drain the queue with 'processes' worker processes, return the
+    number of jobs per state when done."""
+    queue = WorkQueue(queue_path)
+    try:
+        recovered = queue.recover()
+    finally:
+        # no connection is carried over to the workers
+        queue.close()
+    if recovered:
+        print "resuming %d unfinished jobs" % recovered
+    workers = [multiprocessing.Process(target=work,
+        args=(queue_path, out_dir, jobs, items, rate)) for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    queue = WorkQueue(queue_path)
+    try:
+        # a worker that died leaves its jobs running, the next run resumes them
+        queue.recover()
+        return queue.counts()
+    finally:
+        queue.close()
+
+def print_counts(counts):
+    print ", ".join(["%d %s" % (counts[name], name) for name in STATE_NAMES])
+
+def usage():
+    print __doc__
+
+def _main(argv):
+    class Flags: pass
+    flags = Flags()
+    flags.manifests = []
+    flags.processes = PROCESSES
+    flags.jobs = armonet.MAX_JOBS
+    flags.items = False
+    flags.queue = QUEUE_DB
+    flags.out = OUT_DIR
+    flags.status = False
+    flags.retry_failed = False
+    flags.rate = None
+    try:
+        opts, args = getopt.getopt(argv, "hm:p:j:", ["help", "manifest=",
+            "processes=", "jobs=", "items", "queue=", "out=", "status",
+            "retry-failed", "rate="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ('-m', '--manifest'):
+            flags.manifests.append(arg)
+        elif opt in ('-p', '--processes'):
+            flags.processes = int(arg)
+        elif opt in ('-j', '--jobs'):
+            flags.jobs = int(arg)
+        elif opt == '--items':
+            flags.items = True
+        elif opt == '--queue':
+            flags.queue = arg
+        elif opt == '--out':
+            flags.out = arg
+        elif opt == '--status':
+            flags.status = True
+        elif opt == '--retry-failed':
+            flags.retry_failed = True
+        elif opt == '--rate':
+            flags.rate = float(arg)
+
+    queue = WorkQueue(flags.queue)
+    try:
+        if flags.status:
+            print_counts(queue.counts())
+            return
+        for path in flags.manifests:
+            print "queued %d new jobs from '%s'" % (queue.add(read_manifest(path)), path)
+        if flags.retry_failed:
+            print "retrying %d failed jobs" % queue.retry_failed()
+    finally:
+        queue.close()
+
+    counts = run(flags.queue, flags.out, flags.processes, flags.jobs, flags.items,
+            flags.rate)
+    print_counts(counts)
+    if counts["failed"]:
+        queue = WorkQueue(flags.queue)
+        for kind, area, realm, name, error in queue.failures():
+            print >> sys.stderr, ("failed: %s %s %s %s (%s)" % (kind, area,
+                realm, name, error)).encode('utf-8')
+        queue.close()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # like armoread, run in the importable module so the workers share
+    # armoread's state
+    import armobatch
+    armobatch._main(sys.argv[1:])
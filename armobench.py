@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks, run against a local stand-in for the armory.
+
+A small HTTP server serves synthetic guild-info.xml, character-sheet.xml,
+item-info.xml and item-tooltip.xml documents (gzipped, with ETags, like the
+armory) with a configurable number of guild members, items per character,
+padding and latency. armoread's BASE_URLs are pointed at it and each case
+is run a number of times, without the response cache or rate limit:
+
+    dump_guild, dump_char, dump_item        (written to a temp directory)
+    dump_chars_pool                         (the whole guild, -j jobs)
+    get_guild_dom, get_char_dom, get_item_dom, get_itemtooltip_dom
+    get_opml_doc                            (guildrss)
+    parse_roster, parse_sheet, parse_sheet_dom   (no requests)
+
+For each case the requests/sec, p50/p99 latency of a run, peak RSS and
+memory use are reported. Python 2 has no tracemalloc, so memory is the
+growth in gc tracked objects over the case ("objects"); with tracemalloc
+the peak traced allocation is reported as well. Results are written to
+<out>/bench-<time>.json so runs of different versions can be compared
+(--compare).
+
+armobench.py
+    -h, --help              Show help - what you are reading now.
+    -m ..., --members=...   Guild members (default 25).
+    -i ..., --items=...     Equipped items per character (default 18).
+    --padding=...           Bytes of padding per document (default 0).
+    --latency=...           Server latency per request in ms (default 0).
+    -n ..., --repeat=...    Runs per case (default 20).
+    -j ..., --jobs=...      Jobs for dump_chars_pool (default 4).
+    -k ..., --case=...      Only run this case, several can be given.
+    -o ..., --out=...       Directory of result files (default ./bench).
+    --compare=...           Compare with an earlier result file.
+"""
+
+import os
+import sys
+import gc
+import time
+import json
+import gzip
+import getopt
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import urlparse
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import armoread
+import armonet
+import armoxml
+
+BENCH_DIR = "bench/"
+REALM = "Trollbane"
+GUILD = "Emerge"
+MEMBERS = 25
+ITEMS = 18
+REPEAT = 20
+
+
+def _make_stat_elements():
+    """Nested <characterTab> stat elements for every armoxml.STAT_LAYOUT path."""
+    tree = {}
+    for path, attrs in armoxml.STAT_LAYOUT:
+        node = tree
+        for part in path.split("/"):
+            if part not in node:
+                node[part] = {}
+                node.setdefault(" order", []).append(part)
+            node = node[part]
+        node[" attrs"] = attrs.split()
+    def write(name, node, out):
+        attrs = "".join([' %s="%d"' % (attr, 10 + i)
+            for i, attr in enumerate(node.get(" attrs", ()))])
+        children = node.get(" order", ())
+        if not children:
+            out.append('<%s%s/>' % (name, attrs))
+            return
+        out.append('<%s%s>' % (name, attrs))
+        for child in children:
+            write(child, node[child], out)
+        out.append('</%s>' % name)
+    out = []
+    for section in tree[" order"]:
+        write(section, tree[section], out)
+    return "".join(out)
+
+_STAT_ELEMENTS = _make_stat_elements()
+
+def _pad(padding):
+    return padding and "<!--%s-->" % ("x" * padding) or ""
+
+def make_guild_info(realm, guild, members, padding=0):
+    chars = "".join(['<character achPoints="%d" classId="%d" genderId="%d" '
+        'level="80" name="Char%d" raceId="%d" rank="%d" '
+        'url="r=%s&amp;cn=Char%d"/>' % (1000 + i, 1 + i % 11, i % 2, i,
+        1 + i % 10, i % 10, realm, i) for i in range(members)])
+    return ('<?xml version="1.0" encoding="UTF-8"?><page><guildInfo>'
+        '<guildHeader battleGroup="Reckoning" count="%d" faction="0" '
+        'name="%s" realm="%s"/><guild><members memberCount="%d">%s'
+        '</members></guild></guildInfo>%s</page>' % (members, guild, realm,
+        members, chars, _pad(padding)))
+
+def make_character_sheet(name, realm, items, padding=0):
+    equipped = "".join(['<item durability="100" gem0Id="%d" gem1Id="0" '
+        'gem2Id="0" icon="inv_%d" id="%d" level="%d" maxDurability="100" '
+        'name="Item %d" permanentEnchantItemId="%d" randomPropertiesId="0" '
+        'rarity="4" slot="%d"/>' % (40000 + slot % 4, slot, 50000 + slot,
+        232 + slot, slot, 44000 + slot % 5, slot) for slot in range(items)])
+    return ('<?xml version="1.0" encoding="UTF-8"?><page><characterInfo>'
+        '<character battleGroup="Reckoning" class="Warrior" classId="1" '
+        'faction="Alliance" factionId="0" gender="Female" genderId="1" '
+        'guildName="%s" lastModified="May 15, 2010" level="80" name="%s" '
+        'points="3080" prefix="" race="Night Elf" raceId="4" realm="%s" '
+        'suffix="" titleId="0"/><characterTab><talentSpecs><talentSpec '
+        'active="1" group="1" icon="x" prim="Protection" treeOne="14" '
+        'treeThree="54" treeTwo="3"/></talentSpecs><professions><skill '
+        'id="164" key="blacksmithing" max="450" name="Blacksmithing" '
+        'value="450"/></professions>%s<items>%s</items></characterTab>'
+        '</characterInfo>%s</page>' % (GUILD, name, realm, _STAT_ELEMENTS,
+        equipped, _pad(padding)))
+
+def make_item_info(item_id, padding=0):
+    return ('<?xml version="1.0" encoding="UTF-8"?><page><itemInfo><item '
+        'icon="inv_%s" id="%s" level="245" name="Item %s" quality="4" '
+        'type="Plate"><cost/></item></itemInfo>%s</page>' % (item_id, item_id,
+        item_id, _pad(padding)))
+
+def make_item_tooltip(item_id, padding=0):
+    i = int(item_id)
+    return ('<?xml version="1.0" encoding="UTF-8"?><page><itemTooltips>'
+        '<itemTooltip><id>%d</id><name>Item %d</name><bonding>1</bonding>'
+        '<bonusStrength>%d</bonusStrength><bonusStamina>%d</bonusStamina>'
+        '<armor armorBonus="0">%d</armor><bonusCritRating>%d</bonusCritRating>'
+        '<itemLevel>245</itemLevel></itemTooltip></itemTooltips>%s</page>'
+        % (i, i, i % 50, i % 70, i % 2000, i % 40, _pad(padding)))
+
+
+class ArmoryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # one write per response, unbuffered headers get delayed by Nagle
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        scheme, host, path, query, fragment = urlparse.urlsplit(self.path)
+        query = dict([(k, v[0]) for k, v in urlparse.parse_qs(query).items()])
+        server.count()
+        if server.latency:
+            time.sleep(server.latency)
+        if path == "/guild-info.xml":
+            body = make_guild_info(query.get("r", REALM), query.get("n", GUILD),
+                    server.members, server.padding)
+        elif path == "/character-sheet.xml":
+            body = make_character_sheet(query.get("n", ""), query.get("r", REALM),
+                    server.items, server.padding)
+        elif path == "/item-info.xml":
+            body = make_item_info(query.get("i", "0"), server.padding)
+        elif path == "/item-tooltip.xml":
+            body = make_item_tooltip(query.get("i", "0"), server.padding)
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        gzipped = "gzip" in (self.headers.get("Accept-Encoding") or "")
+        if gzipped:
+            out = StringIO()
+            f = gzip.GzipFile(fileobj=out, mode="wb")
+            f.write(body)
+            f.close()
+            body = out.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("ETag", etag)
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ArmoryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Stand-in armory on 127.0.0.1:port (0 picks a free port).
+
+    latency is in seconds, padding in bytes added to every document.
+    requests counts the requests served."""
+
+    daemon_threads = True
+
+    def __init__(self, port=0, members=MEMBERS, items=ITEMS, padding=0, latency=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), ArmoryHandler)
+        self.members = members
+        self.items = items
+        self.padding = padding
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        self._lock.acquire()
+        self.requests += 1
+        self._lock.release()
+
+    def get_base_url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+
+def get_peak_rss():
+    """Peak resident set size in kB, None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def run_case(name, func, server, repeat):
+    """Run func() repeat times, return the case's result dict."""
+    gc.collect()
+    objects = len(gc.get_objects())
+    requests = server.requests
+    if tracemalloc is not None:
+        tracemalloc.start()
+    times = []
+    start = time.time()
+    for i in range(repeat):
+        t = time.time()
+        func()
+        times.append(time.time() - t)
+    elapsed = time.time() - start
+    result = {
+        "name": name,
+        "runs": repeat,
+        "seconds": elapsed,
+        "requests": server.requests - requests,
+        "requests_per_sec": (server.requests - requests) / elapsed if elapsed else 0.0,
+        "runs_per_sec": repeat / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(times, 50) * 1000,
+        "p99_ms": percentile(times, 99) * 1000,
+        "peak_rss_kb": get_peak_rss(),
+    }
+    if tracemalloc is not None:
+        result["peak_traced_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    gc.collect()
+    result["objects"] = len(gc.get_objects()) - objects
+    return result
+
+
+def get_cases(base_url, server, jobs):
+    """[(name, func), ...] of all cases."""
+    import guildrss
+    names = ["Char%d" % i for i in range(server.members)]
+    roster = make_guild_info(REALM, GUILD, server.members, server.padding)
+    sheet = make_character_sheet("Char0", REALM, server.items, server.padding)
+    item_id = "50000"
+    ranks, groups = guildrss.parse_ranks("0135 6 8 279 4")
+
+    def dump_chars_pool():
+        pool = armonet.FetchPool(jobs)
+        for name in names:
+            armoread.dump_char(name, REALM, base_url, False, True, True, pool)
+        failures = pool.join()
+        if failures:
+            raise failures[0][1]
+    def parse_sheet():
+        char = armoread.Character("Char0", REALM, base_url)
+        char.parse_reader(StringIO(sheet))
+    def parse_sheet_dom():
+        dom = armoread.get_dom(StringIO(sheet))
+        # stats is only read from the dom when used
+        armoread.Character("Char0", REALM, base_url, dom=dom).stats
+
+    return [
+        ("dump_guild", lambda: armoread.dump_guild(REALM, GUILD, base_url,
+            False, True, True)),
+        ("dump_char", lambda: armoread.dump_char("Char0", REALM, base_url,
+            False, True, True)),
+        ("dump_item", lambda: armoread.dump_item(item_id, base_url, False, True, True)),
+        ("dump_chars_pool", dump_chars_pool),
+        ("get_guild_dom", lambda: armoread.get_guild_dom(REALM, GUILD, base_url)),
+        ("get_char_dom", lambda: armoread.get_char_dom("Char0", REALM, base_url)),
+        ("get_item_dom", lambda: armoread.get_item_dom(item_id, base_url)),
+        ("get_itemtooltip_dom", lambda: armoread.get_itemtooltip_dom(item_id, base_url)),
+        ("get_opml_doc", lambda: guildrss.get_opml_doc(ranks, groups, REALM,
+            GUILD, base_url)),
+        ("parse_roster", lambda: list(armoxml.iter_roster(StringIO(roster)))),
+        ("parse_sheet", parse_sheet),
+        ("parse_sheet_dom", parse_sheet_dom),
+    ]
+
+
+def get_revision():
+    """The git revision of the code benchmarked, or None."""
+    try:
+        p = subprocess.Popen(["git", "rev-parse", "--short", "HEAD"],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        out = p.communicate()[0].strip()
+    except OSError:
+        return None
+    return p.returncode == 0 and out or None
+
+def run(members=MEMBERS, items=ITEMS, padding=0, latency=0.0, repeat=REPEAT,
+        jobs=armonet.MAX_JOBS, only=None):
+    """Run the benchmarks, return the results as a dict.
+
+    The cases run in a temporary directory (dumps are written there) with
+    armoread's cache and rate limit off, which are restored afterwards."""
+    server = ArmoryServer(0, members, items, padding, latency)
+    server.start()
+    base_url = server.get_base_url()
+    old_base_url = armoread.BASE_URLs[armoread.SERVER_AREA]
+    old_cache = armoread.get_cache()
+    old_limiter = armoread.get_session().limiter
+    old_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="armobench-")
+    armoread.BASE_URLs[armoread.SERVER_AREA] = base_url
+    armoread.set_cache(None)
+    armoread.get_session().limiter = None
+    results = []
+    try:
+        os.chdir(work_dir)
+        for dir in ("guilds", "chars", "items"):
+            os.mkdir(dir)
+        for name, func in get_cases(base_url, server, jobs):
+            if only and name not in only:
+                continue
+            results.append(run_case(name, func, server, repeat))
+    finally:
+        os.chdir(old_dir)
+        shutil.rmtree(work_dir, True)
+        armoread.BASE_URLs[armoread.SERVER_AREA] = old_base_url
+        armoread.set_cache(old_cache)
+        armoread.get_session().limiter = old_limiter
+        # drop the kept alive connections to the server
+        armoread.get_session().close()
+        server.shutdown()
+        server.server_close()
+    return {
+        "time": time.time(),
+        "revision": get_revision(),
+        "python": sys.version.split()[0],
+        "params": {"members": members, "items": items, "padding": padding,
+            "latency": latency, "repeat": repeat, "jobs": jobs},
+        "results": results,
+    }
+
+def save(report, dir=BENCH_DIR):
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    path = os.path.join(dir, "bench-%s.json" % time.strftime("%Y%m%d-%H%M%S",
+        time.localtime(report["time"])))
+    f = open(path, 'wb')
+    try:
+        json.dump(report, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    return path
+
+def load(path):
+    f = open(path, 'rb')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def print_report(report, old=None):
+    """Print the results, with the change in p50 from 'old' if given."""
+    old_results = {}
+    if old is not None:
+        old_results = dict([(r["name"], r) for r in old["results"]])
+        print "compared to %s" % (old.get("revision") or time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime(old["time"])))
+    print "%-20s %9s %9s %9s %9s %9s" % ("case", "req/s", "p50 ms", "p99 ms",
+            "rss kB", "objects")
+    for r in report["results"]:
+        line = "%-20s %9.1f %9.2f %9.2f %9s %9d" % (r["name"],
+                r["requests_per_sec"], r["p50_ms"], r["p99_ms"],
+                r["peak_rss_kb"], r["objects"])
+        before = old_results.get(r["name"])
+        if before is not None and before["p50_ms"]:
+            line += " %+6.1f%%" % ((r["p50_ms"] / before["p50_ms"] - 1) * 100)
+        print line
+
+
+def usage():
+    print __doc__
+
+def _main(argv):
+    class Flags: pass
+    flags = Flags()
+    flags.members = MEMBERS
+    flags.items = ITEMS
+    flags.padding = 0
+    flags.latency = 0.0
+    flags.repeat = REPEAT
+    flags.jobs = armonet.MAX_JOBS
+    flags.cases = []
+    flags.out = BENCH_DIR
+    flags.compare = None
+    try:
+        opts, args = getopt.getopt(argv, "hm:i:n:j:k:o:", ["help", "members=",
+            "items=", "padding=", "latency=", "repeat=", "jobs=", "case=",
+            "out=", "compare="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ('-m', '--members'):
+            flags.members = int(arg)
+        elif opt in ('-i', '--items'):
+            flags.items = int(arg)
+        elif opt == '--padding':
+            flags.padding = int(arg)
+        elif opt == '--latency':
+            flags.latency = float(arg) / 1000
+        elif opt in ('-n', '--repeat'):
+            flags.repeat = int(arg)
+        elif opt in ('-j', '--jobs'):
+            flags.jobs = int(arg)
+        elif opt in ('-k', '--case'):
+            flags.cases.append(arg)
+        elif opt in ('-o', '--out'):
+            flags.out = arg
+        elif opt == '--compare':
+            flags.compare = arg
+
+    report = run(flags.members, flags.items, flags.padding, flags.latency,
+            flags.repeat, flags.jobs, flags.cases)
+    old = flags.compare and load(flags.compare) or None
+    print_report(report, old)
+    print "results written to '%s'" % save(report, flags.out)
+
+
+if __name__ == "__main__":
+    # like armoread, run in the importable module so the cases and armoread
+    # share its state
+    import armobench
+    armobench._main(sys.argv[1:])
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""On-disk cache of armory responses.
+
+Responses are stored under the cache directory keyed by their (canonical)
+url, one body file and one small JSON file with the validators per url:
+
+    cache/<xx>/<sha1 of url>        response body (decompressed)
+    cache/<xx>/<sha1 of url>.meta   {"url", "fetched", "etag", "last_modified"}
+
+An entry younger than the ttl for its kind of resource (see TTLS) is served
+without going online. An older entry is revalidated with If-None-Match /
+If-Modified-Since, a 304 answer just refreshes it. When the armory can't
+be reached or answers with a server error the old entry is served anyway.
+When the cache grows past max_size the least recently used entries are
+removed.
+
+With offline set nothing is fetched, whatever is in the cache is served no
+matter how old it is, and a url not in the cache raises NotCached.
+"""
+
+import os
+import time
+import json
+import errno
+import hashlib
+import tempfile
+import threading
+import urlparse
+
+import armotrace
+
+CACHE_DIR = "cache/"
+MAX_SIZE = 256 * 1024 * 1024
+CHUNK_SIZE = 16 * 1024
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# seconds a cached response is served without revalidation, per resource
+TTLS = {
+    'item-info.xml': 30 * DAY,
+    'item-tooltip.xml': 30 * DAY,
+    'character-sheet.xml': 3 * HOUR,
+    'guild-info.xml': 3 * HOUR,
+}
+DEFAULT_TTL = HOUR
+
+
+class NotCached(IOError):
+    """Raised in offline mode for urls that aren't in the cache."""
+    pass
+
+
+def canonical_url(url):
+    """Lower case scheme and host, drop the fragment."""
+    scheme, host, path, query, fragment = urlparse.urlsplit(url)
+    return urlparse.urlunsplit((scheme.lower(), host.lower(), path or '/', query, ''))
+
+def get_resource(url):
+    """'http://eu.wowarmory.com/item-info.xml?i=1' => 'item-info.xml'"""
+    return urlparse.urlsplit(url)[2].rsplit('/', 1)[-1]
+
+def get_ttl(url):
+    return TTLS.get(get_resource(url), DEFAULT_TTL)
+
+
+class Cache(object):
+    """Response cache in directory 'dir'.
+
+    max_size -- size in bytes of the bodies kept before evicting entries.
+    offline -- never go online, serve from the cache only.
+    """
+
+    def __init__(self, dir=CACHE_DIR, max_size=MAX_SIZE, offline=False):
+        self.dir = dir
+        self.max_size = max_size
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stale = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _get_path(self, url):
+        key = hashlib.sha1(canonical_url(url)).hexdigest()
+        return os.path.join(self.dir, key[:2], key)
+
+    def _read_meta(self, path):
+        try:
+            f = open(path + '.meta', 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                return json.load(f)
+            except ValueError:
+                return None
+        finally:
+            f.close()
+
+    def _write_file(self, path, chunks):
+        """Atomically write the strings from 'chunks' to path, return size."""
+        dir = os.path.dirname(path)
+        try:
+            os.makedirs(dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=dir, prefix='.tmp-')
+        size = 0
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        return size
+
+    def _write_meta(self, path, meta):
+        self._write_file(path + '.meta', [json.dumps(meta)])
+
+    def _open_body(self, path):
+        f = open(path, 'rb')
+        # the body's mtime is when it was last used, for the lru eviction
+        os.utime(path, None)
+        return f
+
+    def get(self, url):
+        """Return (meta, path) for a cached url or (None, path)."""
+        path = self._get_path(url)
+        meta = self._read_meta(path)
+        if meta is None or not os.path.exists(path):
+            return None, path
+        return meta, path
+
+    def is_fresh(self, meta, url, now=None, max_age=None):
+        if now is None:
+            now = time.time()
+        if max_age is None:
+            max_age = get_ttl(url)
+        fetched = meta.get("fetched")
+        if fetched is None:
+            return False
+        return now - fetched < max_age
+
+    def open(self, url, session, max_age=None):
+        """Return a file like object reading url's body.
+
+        session -- armonet.Session used when the cache can't answer.
+        max_age -- seconds a cached copy may be used without revalidation,
+            instead of the ttl for its kind of url. 0 always revalidates.
+        """
+        meta, path = self.get(url)
+        if meta is not None and (self.offline or self.is_fresh(meta, url, max_age=max_age)):
+            self.hits += 1
+            if armotrace.hooks:
+                armotrace.emit("cache", url, 0.0, cached=True)
+            return self._open_body(path)
+        if self.offline:
+            raise NotCached("'%s' isn't cached" % url)
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers['if-none-match'] = meta["etag"]
+            if meta.get("last_modified"):
+                headers['if-modified-since'] = meta["last_modified"]
+        try:
+            reader = session.open(url, headers)
+        except IOError, e:
+            # the armory is down or throttling: a stale copy beats nothing,
+            # but not when it says the page is gone
+            code = getattr(e, 'code', None)
+            if meta is None or (code is not None and code < 500):
+                raise
+            self.stale += 1
+            if armotrace.hooks:
+                armotrace.emit("cache", url, 0.0, cached=True)
+            return self._open_body(path)
+        if reader.getcode() == 304 and meta is not None:
+            reader.read()
+            self.revalidated += 1
+            meta["fetched"] = time.time()
+            self._write_meta(path, meta)
+            if armotrace.hooks:
+                armotrace.emit("cache", url, 0.0, cached=True)
+            return self._open_body(path)
+        self.misses += 1
+        if armotrace.hooks:
+            armotrace.emit("cache", url, 0.0, cached=False)
+        return self._store(url, path, reader)
+
+    def _store(self, url, path, reader):
+        chunks = iter(lambda: reader.read(CHUNK_SIZE), '')
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        size = self._write_file(path, chunks)
+        info = reader.info()
+        meta = {
+            "url": canonical_url(url),
+            "fetched": time.time(),
+            "etag": info.getheader('etag'),
+            "last_modified": info.getheader('last-modified'),
+        }
+        self._write_meta(path, meta)
+        f = open(path, 'rb')
+        self._add_size(size - old_size)
+        return f
+
+    def _entries(self):
+        """Yield (path, size, last used) for all cached bodies."""
+        if not os.path.isdir(self.dir):
+            return
+        for sub in os.listdir(self.dir):
+            subdir = os.path.join(self.dir, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if name.endswith('.meta') or name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(subdir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _add_size(self, size):
+        self._lock.acquire()
+        try:
+            if self._size is None:
+                self._size = sum([e[1] for e in self._entries()])
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        """Remove least recently used entries until below 90% of max_size."""
+        entries = list(self._entries())
+        entries.sort(key=lambda e: e[2])
+        self._size = sum([e[1] for e in entries])
+        limit = self.max_size * 0.9
+        for path, size, used in entries:
+            if self._size <= limit:
+                break
+            for p in (path + '.meta', path):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            self._size -= size
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        self._lock.acquire()
+        try:
+            for path, size, used in list(self._entries()):
+                for p in (path + '.meta', path):
+                    try:
+                        os.remove(p)
+                    except OSError:
+                        pass
+            self._size = 0
+        finally:
+            self._lock.release()
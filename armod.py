@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Daemon keeping armoread warm between command line runs.
+
+Every run of armoread.py or guildrss.py pays for starting Python, importing
+the network and XML modules, opening new connections to the armory and
+finding its way around the response cache again. Run from cron or a shell
+loop that is most of the time spent. armod runs the tools inside a long
+running process instead: modules are imported once, connections are kept
+alive between runs and the response cache (the one in the directory the
+daemon was started in) stays open.
+
+    $ python armod.py --start
+    $ python armod.py armoread -w -c Aabacus
+    $ python armod.py guildrss -u -g Emerge
+    $ python armod.py --stop
+
+A tool run through armod behaves as if run on its own: its arguments are
+passed on, it runs in the caller's working directory, its output comes back
+on stdout and stderr and its exit status is the client's. Runs are served
+one at a time. Without a daemon running the tool is run in the client
+process, so scripts work either way.
+
+armod.py [options] [tool [tool options]]
+    -h, --help              Show help - what you are reading now.
+    --start                 Start the daemon in the background.
+    --serve                 Run the daemon in the foreground.
+    --stop                  Stop the daemon.
+    --status                Tell whether the daemon is running.
+    -s ..., --socket=...    Unix socket of the daemon (default ~/.armod.sock).
+    tool                    armoread, guildrss, armohistory, armoarchive or
+                            armoindex.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import getopt
+import socket
+import importlib
+
+SOCKET_PATH = "~/.armod.sock"
+TOOLS = ("armoread", "guildrss", "armohistory", "armoarchive", "armoindex")
+# modules imported when the daemon starts, so no run pays for them
+WARM_MODULES = ("armonet", "armocache", "armoxml", "xml.dom.minidom",
+        "codecs", "tempfile") + TOOLS
+START_TIMEOUT = 10.0
+
+
+class NotRunning(Exception):
+    pass
+
+
+def connect(path):
+    """A socket connected to the daemon at path, raises NotRunning if there is
+    none."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error, e:
+        sock.close()
+        if e.args[0] in (errno.ENOENT, errno.ECONNREFUSED):
+            raise NotRunning(path)
+        raise
+    return sock
+
+def request(path, message, stdout=None, stderr=None):
+    """Send message (a dict) to the daemon, copy the output it sends back to
+    stdout and stderr and return the exit status."""
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    sock = connect(path)
+    try:
+        sock.sendall(json.dumps(message) + "\n")
+        reader = sock.makefile('rb')
+        while True:
+            header = reader.readline()
+            if not header:
+                raise IOError("armod: connection lost")
+            channel, size = header.split()
+            data = reader.read(int(size))
+            if channel == "x":
+                return int(data)
+            elif channel == "1":
+                stdout.write(data)
+            else:
+                stderr.write(data)
+    finally:
+        sock.close()
+
+def run(tool, argv, path=None):
+    """Run tool with argv in the daemon, or in this process if no daemon is
+    running. Returns the exit status."""
+    path = path or os.path.expanduser(SOCKET_PATH)
+    message = {"tool": tool, "argv": argv, "cwd": os.getcwd()}
+    try:
+        return request(path, message)
+    except NotRunning:
+        pass
+    try:
+        importlib.import_module(tool)._main(argv)
+    except SystemExit, e:
+        return _get_status(e.code, sys.stderr)
+    return 0
+
+def _get_status(code, stderr):
+    """The exit status for sys.exit(code)."""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print >> stderr, code
+    return 1
+
+
+class _Channel(object):
+    """File like object sending what is written to the client, as frames of
+    one channel: "<channel> <size>\\n" followed by size bytes."""
+
+    softspace = 0
+
+    def __init__(self, wfile, channel):
+        self.wfile = wfile
+        self.channel = channel
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if data:
+            self.wfile.write("%s %d\n%s" % (self.channel, len(data), data))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def isatty(self):
+        return False
+
+
+def _get_handles():
+    """What a run may open and leave set in armoread (and armogear), to be
+    closed once the run is over. A History keeps no file open."""
+    import armoread
+    import armogear
+    return {
+        "item_db": armoread.get_item_db(),
+        "archive": armoread.get_archive(),
+        "index": armoread.get_index(),
+        "exporter": armoread.get_exporter(),
+        "parse_pool": armoread.get_parse_pool(),
+        "stats_db": armogear.get_stats_db(),
+    }
+
+def _save_state():
+    """What a run of a tool may change in armoread (and armogear,
+    armotrace)."""
+    import armoread
+    import armotrace
+    state = _get_handles()
+    state.update({
+        "cache": armoread.get_cache(),
+        "offline": armoread.get_cache().offline,
+        "limiter": armoread.get_session().limiter,
+        "history": armoread.get_history(),
+        "hooks": list(armotrace.hooks),
+    })
+    return state
+
+def _restore_state(state, closed=()):
+    """Put back what a run changed, closing what it opened, but not the
+    handles in 'closed' (by its at_exit functions)."""
+    import armoread
+    import armogear
+    import armotrace
+    handles = _get_handles()
+    armoread.set_cache(state["cache"])
+    state["cache"].offline = state["offline"]
+    armoread.get_session().limiter = state["limiter"]
+    armoread.set_item_db(state["item_db"])
+    armoread.set_archive(state["archive"])
+    armoread.set_history(state["history"])
+    armoread.set_index(state["index"])
+    armoread.set_exporter(state["exporter"])
+    armoread.set_parse_pool(state["parse_pool"])
+    armogear.set_stats_db(state["stats_db"])
+    armotrace.hooks[:] = state["hooks"]
+    closed = set([id(handle) for handle in closed])
+    for name, handle in handles.items():
+        if handle is not None and handle is not state[name] \
+                and id(handle) not in closed:
+            handle.close()
+
+def run_tool(tool, argv, cwd, stdout, stderr):
+    """Run tool's _main(argv) in cwd, with its output going to stdout and
+    stderr, and return the exit status. Called in the daemon."""
+    import traceback
+    import armoread
+    if tool not in TOOLS:
+        print >> stderr, "armod: unknown tool '%s'" % tool
+        return 2
+    state = _save_state()
+    old_cwd = os.getcwd()
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    armoread._exit_funcs = []
+    # what the at_exit functions closed, _restore_state leaves alone
+    closed = []
+    status = 0
+    try:
+        os.chdir(cwd)
+        sys.stdout, sys.stderr = stdout, stderr
+        try:
+            importlib.import_module(tool)._main(argv)
+        except SystemExit, e:
+            status = _get_status(e.code, stderr)
+        except Exception:
+            traceback.print_exc(file=stderr)
+            status = 1
+        for func, args in reversed(armoread._exit_funcs):
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc(file=stderr)
+            if func.__name__ == "close":
+                closed.append(getattr(func, "im_self", None))
+    finally:
+        armoread._exit_funcs = None
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+        os.chdir(old_cwd)
+        _restore_state(state, closed)
+    return status
+
+
+def serve(path):
+    """Serve requests on the unix socket path until asked to stop."""
+    import SocketServer
+    import armocache
+    import armoread
+    try:
+        connect(path).close()
+    except NotRunning:
+        pass
+    else:
+        print >> sys.stderr, "armod: already running on '%s'" % path
+        sys.exit(1)
+    if os.path.exists(path):
+        os.remove(path)
+    for name in WARM_MODULES:
+        importlib.import_module(name)
+    # the cache of the directory started in, whatever directory runs are in
+    armoread.set_cache(armocache.Cache(os.path.abspath(armocache.CACHE_DIR)))
+    armoread.get_session()
+
+    class Handler(SocketServer.StreamRequestHandler):
+        wbufsize = -1
+        def handle(self):
+            message = json.loads(self.rfile.readline())
+            if message.get("stop"):
+                status = 0
+                self.server.stopping = True
+            elif message.get("ping"):
+                status = 0
+            else:
+                status = run_tool(message["tool"], message["argv"],
+                        message["cwd"], _Channel(self.wfile, "1"),
+                        _Channel(self.wfile, "2"))
+            _Channel(self.wfile, "x").write(str(status))
+
+    old_umask = os.umask(0077)
+    try:
+        server = SocketServer.UnixStreamServer(path, Handler)
+    finally:
+        os.umask(old_umask)
+    server.stopping = False
+    try:
+        while not server.stopping:
+            server.handle_request()
+    finally:
+        server.server_close()
+        armoread.get_session().close()
+        if os.path.exists(path):
+            os.remove(path)
+
+def start(path):
+    """Start serving path in a daemon process, return once it is up."""
+    if os.fork():
+        deadline = time.time() + START_TIMEOUT
+        while time.time() < deadline:
+            try:
+                connect(path).close()
+                return
+            except NotRunning:
+                time.sleep(0.05)
+        print >> sys.stderr, "armod: daemon didn't start"
+        sys.exit(1)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(null, fd)
+    try:
+        serve(path)
+    finally:
+        os._exit(0)
+
+
+def usage():
+    print __doc__
+
+def _main(argv):
+    class Flags: pass
+    flags = Flags()
+    flags.socket = os.path.expanduser(SOCKET_PATH)
+    flags.command = None
+    try:
+        opts, args = getopt.getopt(argv, "hs:", ["help", "socket=", "start",
+            "serve", "stop", "status"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ('-s', '--socket'):
+            flags.socket = os.path.expanduser(arg)
+        elif opt in ('--start', '--serve', '--stop', '--status'):
+            flags.command = opt[2:]
+
+    if flags.command == "start":
+        start(flags.socket)
+    elif flags.command == "serve":
+        serve(flags.socket)
+    elif flags.command in ("stop", "status"):
+        try:
+            request(flags.socket, {flags.command == "stop" and "stop" or
+                "ping": True})
+        except NotRunning:
+            print "not running"
+            sys.exit(1)
+        if flags.command == "status":
+            print "running on '%s'" % flags.socket
+    elif args:
+        sys.stdout.flush()
+        sys.exit(run(args[0], args[1:], flags.socket))
+    else:
+        usage()
+        sys.exit(2)
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Columnar export of rosters, characters and items.
+
+Parsed documents (with armoread.set_exporter, or --export on the command
+line) are appended to four tables under the export directory:
+
+    roster      one row per guild member read from a guild-info.xml
+    chars       one row per character sheet, its stats as one column of
+                width len(armoxml.STAT_KEYS)
+    equipped    one row per item worn, per character sheet
+    items       one row per item-info.xml
+
+Each table is a directory with a NumPy .npy file per column, and a CSV
+file of the whole table next to it:
+
+    export/chars/level.npy          int32
+    export/chars/stats.npy          float64, rows x len(STAT_KEYS)
+    export/chars/name.npy           int32 codes into name.json
+    export/chars.csv
+
+Strings are stored as codes into a list of the distinct values (name.json),
+ready for pandas.Categorical.from_codes. Rows are buffered and appended a
+batch at a time, the .npy headers are updated after each batch, so the
+columns can be memory-mapped as they are (numpy.load(path, mmap_mode='r'),
+or load_table) while more is appended. NumPy is only needed to read them.
+
+armoexport.py
+    -h, --help              Show help - what you are reading now.
+    --chars=...             Export the character sheets (XML files) in this
+                            directory, eg chars/.
+    --items=...             Export the item-info.xml files in this directory,
+                            eg items/ (the -tooltip.xml files are skipped).
+    --guilds=...            Export the rosters of the guild-info.xml files in
+                            this directory, eg guilds/.
+    --dir=...               Export directory (default ./export).
+"""
+
+import os
+import csv
+import sys
+import time
+import json
+import getopt
+import struct
+import threading
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import armoxml
+
+EXPORT_DIR = "export/"
+BATCH_ROWS = 1000
+NPY_MAGIC = "\x93NUMPY\x01\x00"
+# room for the .npy header, whatever the shape grows to
+NPY_HEADER_SIZE = 128
+
+# column => (typecode, width), typecode 's' is a string stored as an int
+# code into the column's labels
+TABLES = {
+    "roster": (
+        ("realm", 's', 1), ("guild", 's', 1), ("name", 's', 1),
+        ("level", 'i', 1), ("class_id", 'i', 1), ("race_id", 'i', 1),
+        ("gender_id", 'i', 1), ("ach_points", 'i', 1), ("rank", 'i', 1),
+        ("time", 'd', 1),
+    ),
+    "chars": (
+        ("realm", 's', 1), ("name", 's', 1), ("guild", 's', 1),
+        ("level", 'i', 1), ("class_id", 'i', 1), ("race_id", 'i', 1),
+        ("gender_id", 'i', 1), ("faction_id", 'i', 1), ("ach_points", 'i', 1),
+        ("title_id", 'i', 1), ("last_modified", 's', 1), ("time", 'd', 1),
+        ("stats", 'd', len(armoxml.STAT_KEYS)),
+    ),
+    "equipped": (
+        ("realm", 's', 1), ("name", 's', 1), ("slot", 'i', 1),
+        ("item_id", 'i', 1), ("level", 'i', 1), ("rarity", 'i', 1),
+        ("gem0_id", 'i', 1), ("gem1_id", 'i', 1), ("gem2_id", 'i', 1),
+        ("enchant_id", 'i', 1), ("random_properties_id", 'i', 1),
+        ("durability", 'i', 1), ("max_durability", 'i', 1), ("time", 'd', 1),
+    ),
+    "items": (
+        ("id", 'i', 1), ("name", 's', 1), ("level", 'i', 1),
+        ("quality", 'i', 1), ("type", 's', 1), ("icon", 's', 1),
+        ("time", 'd', 1),
+    ),
+}
+NPY_TYPES = {'i': '<i4', 'd': '<f8', 's': '<i4'}
+ARRAY_TYPES = {'i': 'i', 'd': 'd', 's': 'i'}
+
+
+def write_npy_header(f, typecode, rows, width=1):
+    """Write a .npy header of NPY_HEADER_SIZE bytes at the start of f."""
+    shape = width > 1 and "(%d, %d)" % (rows, width) or "(%d,)" % rows
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': %s, }" % (
+            NPY_TYPES[typecode], shape)
+    size = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+    header = header.ljust(size - 1) + "\n"
+    f.seek(0)
+    f.write(NPY_MAGIC + struct.pack("<H", size) + header)
+
+def read_npy_rows(f):
+    """Number of rows in the header of a .npy file written here."""
+    f.seek(0)
+    header = f.read(NPY_HEADER_SIZE)
+    if len(header) < NPY_HEADER_SIZE or not header.startswith(NPY_MAGIC):
+        return 0
+    shape = header.split("'shape': (", 1)[1].split(")", 1)[0]
+    return int(shape.split(",")[0])
+
+
+def load_labels(path):
+    """The values of a string column, from its .json file."""
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return []
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def get_rows(dir, columns):
+    """Number of rows of a table all its column headers agree on."""
+    rows = None
+    for name, typecode, width in columns:
+        path = os.path.join(dir, name + ".npy")
+        n = 0
+        if os.path.exists(path):
+            f = open(path, 'rb')
+            try:
+                n = read_npy_rows(f)
+            finally:
+                f.close()
+        if rows is None or n < rows:
+            rows = n
+    return rows or 0
+
+
+class Table(object):
+    """A table of 'columns' (see TABLES) in directory 'dir', with its CSV
+    in csv_path."""
+
+    def __init__(self, dir, columns, csv_path=None):
+        self.dir = dir
+        self.columns = columns
+        self.csv_path = csv_path
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        self.labels = {}
+        self._codes = {}
+        for name, typecode, width in columns:
+            if typecode == 's':
+                labels = load_labels(self._get_path(name, ".json"))
+                self.labels[name] = labels
+                self._codes[name] = dict([(v, i) for i, v in enumerate(labels)])
+        self.rows = self._repair()
+        self._pending = []
+
+    def _get_path(self, name, ext=".npy"):
+        return os.path.join(self.dir, name + ext)
+
+    def _save_labels(self, name):
+        path = self._get_path(name, ".json")
+        f = open(path + '.tmp', 'wb')
+        try:
+            json.dump(self.labels[name], f)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+    def _repair(self):
+        """Cut all columns to the rows every header agrees on, in case a
+        crash left some of them ahead. Return the number of rows."""
+        rows = get_rows(self.dir, self.columns)
+        for name, typecode, width in self.columns:
+            path = self._get_path(name)
+            f = open(path, os.path.exists(path) and 'r+b' or 'w+b')
+            try:
+                write_npy_header(f, typecode, rows, width)
+                f.truncate(NPY_HEADER_SIZE +
+                        rows * array(ARRAY_TYPES[typecode]).itemsize * width)
+            finally:
+                f.close()
+        return rows
+
+    def _encode(self, name, value):
+        codes = self._codes[name]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.labels[name])
+            self.labels[name].append(value)
+        return code
+
+    def append(self, row):
+        """Queue a row, a tuple with a value per column (a sequence of
+        'width' values for wide columns). Call flush to write them."""
+        self._pending.append(row)
+
+    def flush(self):
+        """Append the queued rows to the columns and the CSV."""
+        rows = self._pending
+        if not rows:
+            return
+        self._pending = []
+        columns = []
+        for i, (name, typecode, width) in enumerate(self.columns):
+            data = array(ARRAY_TYPES[typecode])
+            if typecode == 's':
+                before = len(self.labels[name])
+                data.extend([self._encode(name, row[i]) for row in rows])
+                if len(self.labels[name]) != before:
+                    self._save_labels(name)
+            elif width > 1:
+                for row in rows:
+                    data.extend(row[i])
+            else:
+                data.extend([row[i] for row in rows])
+            columns.append(data)
+        if sys.byteorder != "little":
+            for data in columns:
+                data.byteswap()
+        # the data first, then the headers: until the headers are written
+        # the new rows aren't there
+        for (name, typecode, width), data in zip(self.columns, columns):
+            f = open(self._get_path(name), 'r+b')
+            try:
+                f.seek(0, 2)
+                data.tofile(f)
+            finally:
+                f.close()
+        self.rows += len(rows)
+        for name, typecode, width in self.columns:
+            f = open(self._get_path(name), 'r+b')
+            try:
+                write_npy_header(f, typecode, self.rows, width)
+            finally:
+                f.close()
+        if self.csv_path:
+            self._write_csv(rows)
+
+    def get_header(self):
+        header = []
+        for name, typecode, width in self.columns:
+            if name == "stats":
+                header.extend(armoxml.STAT_KEYS)
+            elif width > 1:
+                header.extend(["%s%d" % (name, i) for i in range(width)])
+            else:
+                header.append(name)
+        return header
+
+    def _write_csv(self, rows):
+        new = not os.path.exists(self.csv_path)
+        f = open(self.csv_path, 'ab')
+        try:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(self.get_header())
+            for row in rows:
+                values = []
+                for value, (name, typecode, width) in zip(row, self.columns):
+                    if width > 1:
+                        values.extend(value)
+                    elif isinstance(value, unicode):
+                        values.append(value.encode('utf-8'))
+                    else:
+                        values.append(value)
+                writer.writerow(values)
+        finally:
+            f.close()
+
+
+class Exporter(object):
+    """Appends rosters, characters and items to the tables in 'dir', a batch
+    of batch_rows rows at a time. Call close (or flush) when done."""
+
+    def __init__(self, dir=EXPORT_DIR, batch_rows=BATCH_ROWS):
+        self.dir = dir
+        self.batch_rows = batch_rows
+        self._lock = threading.Lock()
+        self.tables = {}
+        for name, columns in TABLES.iteritems():
+            self.tables[name] = Table(os.path.join(dir, name), columns,
+                    os.path.join(dir, name + ".csv"))
+
+    def _append(self, name, rows):
+        self._lock.acquire()
+        try:
+            table = self.tables[name]
+            for row in rows:
+                table.append(row)
+            if len(table._pending) >= self.batch_rows:
+                table.flush()
+        finally:
+            self._lock.release()
+
+    def add_roster(self, guild, timestamp=None):
+        """Export the members of an armoread.Guild."""
+        if timestamp is None:
+            timestamp = time.time()
+        self._append("roster", [(guild.realm, guild.name, m.name, m.level,
+            m.class_id, m.race_id, m.gender_id, m.ach_points, m.rank or 0,
+            timestamp) for m in guild.members])
+
+    def add_char(self, char, timestamp=None):
+        """Export an armoread.Character read from its sheet, and the items it
+        wears."""
+        if timestamp is None:
+            timestamp = time.time()
+        self._append("chars", [(char.realm, char.name, char.guild_name,
+            char.level, char.class_id, char.race_id, char.gender_id,
+            char.faction_id, char.ach_points, char.title_id,
+            char.last_modified, timestamp, char.stats.values)])
+        self._append("equipped", [(char.realm, char.name,
+            item.slot if item.slot is not None else -1, item.id, item.level,
+            item.rarity, item.gems[0], item.gems[1], item.gems[2],
+            item.enchant_id, item.random_properties_id, item.durability,
+            item.max_durability, timestamp) for item in char.items])
+
+    def add_item(self, item, timestamp=None):
+        """Export an armoread.Item read from its item-info.xml. Items without
+        an id are skipped."""
+        id = armoxml.to_int(item.id, None)
+        if id is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        self._append("items", [(id, item.name, item.level,
+            item.rarity, item.type, item.icon, timestamp)])
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            for table in self.tables.values():
+                table.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self.flush()
+
+
+def load_table(name, dir=EXPORT_DIR, decode=True):
+    """{column: values} of an exported table, memory-mapped NumPy arrays if
+    NumPy is installed (arrays otherwise). String columns are decoded to
+    their values, or with decode=False left as codes with the values in
+    column + "_labels"."""
+    table_dir = os.path.join(dir, name)
+    # rows all columns have, a writer may be halfway through a batch
+    rows = get_rows(table_dir, TABLES[name])
+    result = {}
+    for column, typecode, width in TABLES[name]:
+        path = os.path.join(table_dir, column + ".npy")
+        if numpy is not None:
+            data = numpy.load(path, mmap_mode='r')[:rows]
+        else:
+            data = array(ARRAY_TYPES[typecode])
+            f = open(path, 'rb')
+            try:
+                f.seek(NPY_HEADER_SIZE)
+                data.fromfile(f, rows * width)
+            finally:
+                f.close()
+            if sys.byteorder != "little":
+                data.byteswap()
+            if width > 1:
+                data = [data[i * width:(i + 1) * width] for i in xrange(rows)]
+        if typecode == 's':
+            labels = load_labels(os.path.join(table_dir, column + ".json"))
+            if decode:
+                data = [labels[code] for code in data]
+            else:
+                result[column + "_labels"] = labels
+        result[column] = data
+    return result
+
+
+def export_files(exporter, kind, dir):
+    """Export the XML files in dir: kind is "chars", "items" or "guilds".
+    Returns the number of files exported."""
+    import armoread
+    count = 0
+    for filename in sorted(os.listdir(dir)):
+        if not filename.endswith('.xml') or filename.endswith('-tooltip.xml'):
+            continue
+        path = os.path.join(dir, filename)
+        timestamp = os.path.getmtime(path)
+        f = open(path, 'rb')
+        try:
+            if kind == "chars":
+                obj = armoread.Character()
+                obj.parse_reader(f)
+                exporter.add_char(obj, timestamp)
+            elif kind == "items":
+                obj = armoread.Item()
+                obj.parse_reader(f)
+                if obj.id:
+                    exporter.add_item(obj, timestamp)
+            else:
+                obj = armoread.Guild()
+                obj.parse_reader(f)
+                exporter.add_roster(obj, timestamp)
+        finally:
+            f.close()
+        count += 1
+    return count
+
+
+def usage():
+    print __doc__
+
+def _main(argv):
+    class Flags: pass
+    flags = Flags()
+    flags.dir = EXPORT_DIR
+    flags.sources = []
+    try:
+        opts, args = getopt.getopt(argv, "h", ["help", "chars=", "items=",
+            "guilds=", "dir="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ('--chars', '--items', '--guilds'):
+            flags.sources.append((opt[2:], arg))
+        elif opt == '--dir':
+            flags.dir = arg
+
+    exporter = Exporter(flags.dir)
+    try:
+        for kind, dir in flags.sources:
+            count = export_files(exporter, kind, dir)
+            print "%d files exported from '%s'" % (count, dir)
+    finally:
+        exporter.close()
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Poll the character-feed.atom of every member of a guild.
+
+guildrss writes the members' feeds to an OPML for a feed reader to poll.
+armofeed polls them itself and keeps the entries in a SQLite database
+(feeds.db), one row per entry id, so an entry seen in many polls is stored
+once.
+
+Polling a whole guild stays cheap:
+
+    - each feed is polled at its own pace. After a poll that brought new
+      entries the interval is set from how often the feed's entries came in
+      (half the average gap of the last HISTORY_SIZE entries), after a poll
+      that brought none it grows by BACKOFF, within MIN_INTERVAL and
+      MAX_INTERVAL. Intervals are stretched or shrunk at random by up to
+      JITTER, so feeds first polled together drift apart.
+    - polls are conditional GETs (If-None-Match / If-Modified-Since), an
+      unchanged feed is a 304 with no body to read or parse.
+    - feeds are parsed while read, only entries with ids not already stored
+      are kept.
+
+The members are read from the guild roster (armoread.get_guild_dom, so
+through the response cache), feeds of members who left are dropped.
+
+armofeed.py
+    -h, --help              Show help - what you are reading now.
+    -r ..., --realm=...     Set realm.
+    -g ..., --guild=...     Set guild.
+    --eu, --us              Set area (EU or US).
+    -j ..., --jobs=...      Feeds to poll at once (default 4).
+    --loop                  Keep polling, sleeping until the next feed is
+                            due. Without it the feeds that are due are
+                            polled once.
+    -n ...                  Print the newest N entries of the guild.
+    --db=...                Feed database (default ./feeds.db).
+"""
+
+import sys
+import time
+import random
+import sqlite3
+import calendar
+import getopt
+import threading
+
+import armoread
+import armoxml
+import guildrss
+
+FEED_DB = "feeds.db"
+MINUTE = 60
+HOUR = 60 * MINUTE
+MIN_INTERVAL = 15 * MINUTE
+MAX_INTERVAL = 24 * HOUR
+BACKOFF = 1.5
+JITTER = 0.1
+# entries looked at to estimate how often a feed is updated
+HISTORY_SIZE = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS feeds (
+    url TEXT PRIMARY KEY,
+    realm TEXT,
+    guild TEXT,
+    name TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    interval REAL,
+    next_poll REAL,
+    polls INTEGER DEFAULT 0,
+    modified INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id TEXT PRIMARY KEY,
+    feed TEXT,
+    updated REAL,
+    title TEXT,
+    link TEXT,
+    content TEXT,
+    fetched REAL
+);
+CREATE INDEX IF NOT EXISTS entries_feed ON entries (feed, updated);
+CREATE INDEX IF NOT EXISTS feeds_next_poll ON feeds (next_poll);
+"""
+
+
+def parse_time(value):
+    """'2010-05-15T12:00:00+02:00' (Atom, RFC 3339) => seconds since the
+    epoch, 0.0 if it can't be read."""
+    # not time.strptime, its first call isn't thread safe in Python 2
+    value = value.strip()
+    try:
+        seconds = calendar.timegm((int(value[0:4]), int(value[5:7]),
+            int(value[8:10]), int(value[11:13]), int(value[14:16]),
+            int(value[17:19]), 0, 0, 0))
+    except ValueError:
+        return 0.0
+    zone = value[19:].lstrip("0123456789.")
+    if zone[:1] in ("+", "-") and len(zone) >= 6:
+        offset = int(zone[1:3]) * HOUR + int(zone[4:6]) * MINUTE
+        if zone[0] == "+":
+            offset = -offset
+        seconds += offset
+    return float(seconds)
+
+
+class FeedHandler(object):
+    """Collects the entries of an Atom feed that aren't in 'known' (a set of
+    entry ids), as parsed.
+
+    entries -- [{"id", "updated", "title", "link", "content"}, ...]
+    seen -- number of entries in the feed
+    """
+
+    FIELDS = ("id", "updated", "title", "content", "summary")
+
+    def __init__(self, known=()):
+        self.known = known
+        self.entries = []
+        self.seen = 0
+        self._entry = None
+        self._field = None
+        self._text = []
+
+    def start(self, name, attrs):
+        name = name.rsplit(":", 1)[-1]
+        if name == "entry":
+            self._entry = {"link": u'', "content": u''}
+        elif self._entry is not None:
+            if name == "link" and not self._entry["link"]:
+                self._entry["link"] = attrs.get("href", u'')
+            elif name in self.FIELDS and self._field is None:
+                self._field = name
+                self._text = []
+
+    def end(self, name):
+        name = name.rsplit(":", 1)[-1]
+        entry = self._entry
+        if entry is None:
+            return
+        if name == self._field:
+            text = u''.join(self._text)
+            if name == "summary":
+                entry["content"] = entry["content"] or text
+            else:
+                entry[name] = text
+            self._field = None
+        elif name == "entry":
+            self.seen += 1
+            self._entry = None
+            if entry.get("id") and entry["id"] not in self.known:
+                entry["updated"] = parse_time(entry.get("updated", u''))
+                entry.setdefault("title", u'')
+                self.entries.append(entry)
+
+    def text(self, data):
+        if self._field is not None:
+            self._text.append(data)
+
+
+def get_interval(times, old_interval):
+    """Poll interval of a feed, from the update times of its newest entries
+    (newest first) and its current interval."""
+    if len(times) >= 2 and times[0] > times[-1]:
+        gap = (times[0] - times[-1]) / (len(times) - 1)
+        interval = gap / 2
+    else:
+        interval = (old_interval or MIN_INTERVAL) * BACKOFF
+    return min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+
+
+class FeedStore(object):
+    """Feeds and their entries, in the SQLite database 'path'."""
+
+    def __init__(self, path=FEED_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+
+    def _query(self, sql, args=()):
+        self._lock.acquire()
+        try:
+            return self._db.execute(sql, args).fetchall()
+        finally:
+            self._lock.release()
+
+    def _execute(self, sql, args=()):
+        self._lock.acquire()
+        try:
+            cursor = self._db.execute(sql, args)
+            self._db.commit()
+            return cursor.rowcount
+        finally:
+            self._lock.release()
+
+    def set_guild(self, realm, guild, members, base_url, now=None):
+        """Make the feeds of a guild those of 'members' (names). Returns
+        (added, removed) names."""
+        if now is None:
+            now = time.time()
+        old = dict(self._query("SELECT name, url FROM feeds WHERE realm = ? "
+                "AND guild = ?", (realm, guild)))
+        urls = dict([(name, guildrss.get_feed_url(realm, name, base_url))
+                for name in members])
+        added = [name for name in members if name not in old]
+        removed = [name for name in old if name not in urls]
+        # feeds stored under another url (the guild was read from another
+        # area), polled afresh under the new one
+        moved = [name for name in members if name in old and
+                old[name] != urls[name]]
+        self._lock.acquire()
+        try:
+            for name in added:
+                self._db.execute("INSERT OR REPLACE INTO feeds (url, realm, "
+                        "guild, name, interval, next_poll) VALUES (?, ?, ?, "
+                        "?, ?, ?)", (urls[name], realm, guild, name,
+                        MIN_INTERVAL, now))
+            for name in moved:
+                self._db.execute("UPDATE OR REPLACE feeds SET url = ?, "
+                        "etag = NULL, last_modified = NULL, interval = ?, "
+                        "next_poll = ? WHERE url = ?", (urls[name],
+                        MIN_INTERVAL, now, old[name]))
+                self._db.execute("UPDATE entries SET feed = ? WHERE feed = ?",
+                        (urls[name], old[name]))
+            for name in removed:
+                self._db.execute("DELETE FROM feeds WHERE url = ?", (old[name],))
+            self._db.commit()
+        finally:
+            self._lock.release()
+        return added, removed
+
+    def get_due(self, now=None, limit=None):
+        """[(url, etag, last_modified, interval), ...] of the feeds due for a
+        poll, most overdue first."""
+        if now is None:
+            now = time.time()
+        sql = ("SELECT url, etag, last_modified, interval FROM feeds "
+                "WHERE next_poll <= ? ORDER BY next_poll")
+        if limit:
+            sql += " LIMIT %d" % limit
+        return self._query(sql, (now,))
+
+    def get_next_poll(self):
+        """When the next feed is due, None if there are no feeds."""
+        return self._query("SELECT MIN(next_poll) FROM feeds")[0][0]
+
+    def get_known(self, url, limit=100):
+        """The ids of the newest entries of a feed."""
+        return set([row[0] for row in self._query("SELECT id FROM entries "
+                "WHERE feed = ? ORDER BY updated DESC LIMIT ?", (url, limit))])
+
+    def add_entries(self, url, entries, now=None):
+        """Store new entries, ids already stored are skipped. Returns the
+        number stored."""
+        if now is None:
+            now = time.time()
+        added = 0
+        self._lock.acquire()
+        try:
+            for entry in entries:
+                added += self._db.execute("INSERT OR IGNORE INTO entries "
+                        "(id, feed, updated, title, link, content, fetched) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)", (entry["id"], url,
+                        entry["updated"], entry["title"], entry["link"],
+                        entry["content"], now)).rowcount
+            self._db.commit()
+        finally:
+            self._lock.release()
+        return added
+
+    def polled(self, url, interval, etag=None, last_modified=None,
+            modified=False, now=None):
+        """Record a poll of a feed, the next one is about 'interval' from
+        now."""
+        if now is None:
+            now = time.time()
+        next_poll = now + interval * random.uniform(1 - JITTER, 1 + JITTER)
+        self._execute("UPDATE feeds SET interval = ?, next_poll = ?, "
+                "etag = COALESCE(?, etag), last_modified = COALESCE(?, "
+                "last_modified), polls = polls + 1, modified = modified + ? "
+                "WHERE url = ?", (interval, next_poll, etag,
+                last_modified, modified and 1 or 0, url))
+
+    def get_update_times(self, url, limit=HISTORY_SIZE):
+        return [row[0] for row in self._query("SELECT updated FROM entries "
+                "WHERE feed = ? ORDER BY updated DESC LIMIT ?", (url, limit))]
+
+    def get_entries(self, realm, guild, limit=20):
+        """[(updated, name, title, link), ...] of the guild's newest
+        entries."""
+        return self._query("SELECT e.updated, f.name, e.title, e.link FROM "
+                "entries e JOIN feeds f ON e.feed = f.url WHERE f.realm = ? "
+                "AND f.guild = ? ORDER BY e.updated DESC LIMIT ?",
+                (realm, guild, limit))
+
+
+def poll_feed(store, url, etag, last_modified, interval):
+    """Poll one feed (a conditional GET) and store its new entries. Returns
+    the number of new entries."""
+    headers = {}
+    if etag:
+        headers['if-none-match'] = etag
+    if last_modified:
+        headers['if-modified-since'] = last_modified
+    reader = armoread.get_session().open(url, headers)
+    if reader.getcode() == 304:
+        reader.read()
+        store.polled(url, get_interval([], interval))
+        return 0
+    info = reader.info()
+    handler = armoxml.parse(reader, FeedHandler(store.get_known(url)))
+    added = store.add_entries(url, handler.entries)
+    if added:
+        interval = get_interval(store.get_update_times(url), interval)
+    else:
+        interval = get_interval([], interval)
+    store.polled(url, interval, info.getheader('etag'),
+            info.getheader('last-modified'), modified=True)
+    return added
+
+def poll_due(store, pool=None, now=None):
+    """Poll the feeds that are due, on pool (an armonet.FetchPool) if given.
+    Returns (feeds polled, new entries)."""
+    due = store.get_due(now)
+    counts = []
+    def poll(url, etag, last_modified, interval):
+        try:
+            counts.append(poll_feed(store, url, etag, last_modified, interval))
+        except Exception:
+            # back off from failing feeds like from unchanged ones
+            store.polled(url, get_interval([], interval))
+            raise
+    for url, etag, last_modified, interval in due:
+        if pool is None:
+            poll(url, etag, last_modified, interval)
+        else:
+            pool.add(url, poll, url, etag, last_modified, interval)
+    if pool is not None:
+        pool.join()
+    return len(due), sum(counts)
+
+def subscribe_guild(store, realm, guild, base_url):
+    """Follow the feeds of the guild's members (and stop following those of
+    members who left). Returns (added, removed) names."""
+    dom = armoread.get_guild_dom(realm, guild, base_url)
+    members = armoread.Guild(guild, realm, base_url, dom=dom).members
+    return store.set_guild(realm, guild, [m.name for m in members], base_url)
+
+
+def usage():
+    print __doc__
+
+def _main(argv):
+    import armonet
+    flag_verbose = False
+    class Flags: pass
+    flags = Flags()
+    flags.server_area = armoread.SERVER_AREA
+    flags.realm = 'Trollbane'
+    flags.guild = 'Emerge'
+    flags.jobs = armonet.MAX_JOBS
+    flags.loop = False
+    flags.n = 0
+    flags.db = FEED_DB
+    try:
+        opts, args = getopt.getopt(argv, "hvr:g:j:n:", ["help", "verbose",
+            "realm=", "guild=", "eu", "us", "jobs=", "loop", "db="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ('-v', '--verbose'):
+            flag_verbose = True
+        elif opt in ('-r', '--realm'):
+            flags.realm = arg
+        elif opt in ('-g', '--guild'):
+            flags.guild = arg
+        elif opt == '--eu':
+            flags.server_area = 'EU'
+        elif opt == '--us':
+            flags.server_area = 'US'
+        elif opt in ('-j', '--jobs'):
+            flags.jobs = int(arg)
+        elif opt == '--loop':
+            flags.loop = True
+        elif opt == '-n':
+            flags.n = int(arg)
+        elif opt == '--db':
+            flags.db = arg
+
+    base_url = armoread.BASE_URLs[flags.server_area]
+    store = FeedStore(flags.db)
+    try:
+        while True:
+            # the roster is cached, following it each round costs little
+            added, removed = subscribe_guild(store, flags.realm, flags.guild,
+                    base_url)
+            if flag_verbose and (added or removed):
+                print "%d feeds added, %d removed" % (len(added), len(removed))
+            pool = armonet.FetchPool(flags.jobs, verbose=flag_verbose)
+            polled, new = poll_due(store, pool)
+            for url, e in pool.failures:
+                print >> sys.stderr, "failed: '%s' (%s)" % (url, e)
+            if flag_verbose:
+                print "%d feeds polled, %d new entries" % (polled, new)
+            if not flags.loop:
+                break
+            next_poll = store.get_next_poll()
+            time.sleep(max(next_poll is not None and next_poll - time.time()
+                or MIN_INTERVAL, 1))
+        for updated, name, title, link in store.get_entries(flags.realm,
+                flags.guild, flags.n):
+            print ("%s  %-12s %s" % (time.strftime("%Y-%m-%d %H:%M",
+                time.gmtime(updated)), name, title)).encode('utf-8')
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Gear score of characters, computed for many characters at once.
+
+Every item (gems and enchants are items too) is turned into a vector of
+its stats, in the order of STAT_WEIGHTS, read from its item-tooltip.xml.
+Scoring a batch of characters is then:
+
+    item scores = items x stats matrix . weights
+    stat totals = the stat vectors of the items worn, summed per character
+    gear score = stat totals . weights
+
+done with NumPy if it is installed and with plain arrays otherwise. Each
+distinct item is only fetched and weighted once per batch, no matter how
+many characters wear it.
+
+Stat vectors are remembered per item id, in memory and, if set with
+set_stats_db, in an ItemStatsDB (itemstats.db) across runs, so scoring
+characters wearing known items parses no tooltips at all. Stored vectors
+carry the version of the extraction that made them (get_extractor_version):
+changing the extraction, or the tables it uses, makes them be extracted
+again from the tooltips, which stay cached.
+
+http://www.wowwiki.com/Gear_score
+"""
+
+import re
+import sys
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import armoread
+import armoxml
+
+STAT_WEIGHTS = (
+    ("Strength", 1.00),
+    ("Agility", 1.00),
+    ("Stamina", 2.00),
+    ("Intellect", 1.00),
+    ("Spirit", 1.00),
+    ("Arcane Resist", 1.00),
+    ("Fire Resist", 1.00),
+    ("Nature Resist", 1.00),
+    ("Frost Resist", 1.00),
+    ("Shadow Resist", 1.00),
+    ("Defense", 1.00),
+    ("Expertise", 1.00),
+    ("Block", 1.00),
+    ("Block Value", 0.65),
+    ("Dodge", 1.00),
+    ("Parry", 1.00),
+    ("Resilience", 1.00),
+    ("Armor Pen", 1.00),
+    ("Attack Power", 0.50),
+    ("Crit Rating", 1.00),
+    ("Ranged Crit", 1.00),
+    ("To Hit", 1.00),
+    ("Ranged To Hit", 1.00),
+    ("Haste", 1.00),
+    ("Damage Undead", 0.55),
+    ("Arcane Damage", 0.70),
+    ("Fire Damage", 0.70),
+    ("Frost Damage", 0.70),
+    ("Holy Damage", 0.70),
+    ("Nature Damage", 0.70),
+    ("Shadow Damage", 0.70),
+    ("Spell Penetration", 0.80),
+    ("Spell Power", 0.86),
+    ("Health Regen", 2.50),
+    ("Mana Regen", 2.50),
+)
+STAT_NAMES = tuple([name for name, weight in STAT_WEIGHTS])
+STAT_INDEX = dict([(name, i) for i, name in enumerate(STAT_NAMES)])
+WEIGHTS = array('d', [weight for name, weight in STAT_WEIGHTS])
+
+# item-tooltip.xml element => stat
+TOOLTIP_STATS = {
+    "bonusStrength": "Strength",
+    "bonusAgility": "Agility",
+    "bonusStamina": "Stamina",
+    "bonusIntellect": "Intellect",
+    "bonusSpirit": "Spirit",
+    "arcaneResist": "Arcane Resist",
+    "fireResist": "Fire Resist",
+    "natureResist": "Nature Resist",
+    "frostResist": "Frost Resist",
+    "shadowResist": "Shadow Resist",
+    "bonusDefenseSkillRating": "Defense",
+    "bonusExpertiseRating": "Expertise",
+    "bonusBlockRating": "Block",
+    "blockValue": "Block Value",
+    "bonusBlockValue": "Block Value",
+    "bonusDodgeRating": "Dodge",
+    "bonusParryRating": "Parry",
+    "bonusResilienceRating": "Resilience",
+    "bonusArmorPenetration": "Armor Pen",
+    "bonusAttackPower": "Attack Power",
+    "bonusCritRating": "Crit Rating",
+    "bonusCritRangedRating": "Ranged Crit",
+    "bonusHitRating": "To Hit",
+    "bonusHitRangedRating": "Ranged To Hit",
+    "bonusHasteRating": "Haste",
+    "bonusSpellPenetration": "Spell Penetration",
+    "bonusSpellPower": "Spell Power",
+    "bonusHealthRegen": "Health Regen",
+    "bonusManaRegen": "Mana Regen",
+}
+
+# stat names used in gem/enchant texts ("+20 Strength") => stat
+TEXT_STATS = {
+    "Critical Strike Rating": "Crit Rating",
+    "Hit Rating": "To Hit",
+    "Haste Rating": "Haste",
+    "Defense Rating": "Defense",
+    "Dodge Rating": "Dodge",
+    "Parry Rating": "Parry",
+    "Block Rating": "Block",
+    "Expertise Rating": "Expertise",
+    "Resilience Rating": "Resilience",
+    "Armor Penetration Rating": "Armor Pen",
+    "Spell Penetration": "Spell Penetration",
+}
+TEXT_STAT_RE = re.compile(r"\+(\d+) ((?:[A-Z][a-z]+ ?)+)")
+
+MAX_SLOTS = 19
+
+# bump when get_stat_vector changes what it makes of a tooltip
+EXTRACTOR_VERSION = 1
+ITEM_STATS_DB = "itemstats.db"
+# max number of variables in one sqlite statement is 999
+QUERY_BATCH = 500
+
+
+def new_stat_vector():
+    return array('d', [0.0]) * len(STAT_NAMES)
+
+def get_stat_vector(tooltip):
+    """Stat vector of an armoxml.ItemTooltipHandler."""
+    vector = new_stat_vector()
+    for element, text in tooltip.values.iteritems():
+        name = TOOLTIP_STATS.get(element)
+        if name is not None:
+            vector[STAT_INDEX[name]] += armoxml.to_float(text)
+    for text in tooltip.texts:
+        for value, name in TEXT_STAT_RE.findall(text):
+            name = name.strip()
+            name = TEXT_STATS.get(name, name)
+            i = STAT_INDEX.get(name)
+            if i is not None:
+                vector[i] += float(value)
+    return vector
+
+
+def get_extractor_version():
+    """Version of the stat vectors get_stat_vector makes: EXTRACTOR_VERSION
+    and a digest of the stat order and the tables mapping tooltips to it."""
+    tables = repr((STAT_NAMES, sorted(TOOLTIP_STATS.items()),
+        sorted(TEXT_STATS.items()), TEXT_STAT_RE.pattern))
+    return "%d-%s" % (EXTRACTOR_VERSION, hashlib.sha1(tables).hexdigest()[:12])
+
+
+class ItemStatsDB(object):
+    """Stat vectors of items in the SQLite database 'path', by item id.
+
+    Vectors made by another version of the extraction than 'version' are
+    treated as missing, and replaced when the item is extracted again.
+    """
+
+    def __init__(self, path=ITEM_STATS_DB, version=None):
+        self.path = path
+        self.version = version or get_extractor_version()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS item_stats ("
+                "id INTEGER PRIMARY KEY, version TEXT, vector BLOB)")
+        self._db.commit()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+
+    def get_many(self, item_ids):
+        """{id: stat vector} of the ids stored by this version, in one
+        query per QUERY_BATCH ids."""
+        ids = list(set([int(id) for id in item_ids]))
+        result = {}
+        for i in range(0, len(ids), QUERY_BATCH):
+            batch = ids[i:i + QUERY_BATCH]
+            self._lock.acquire()
+            try:
+                rows = self._db.execute("SELECT id, vector FROM item_stats "
+                        "WHERE version = ? AND id IN (%s)" % ", ".join(["?"] *
+                        len(batch)), [self.version] + batch).fetchall()
+            finally:
+                self._lock.release()
+            for id, blob in rows:
+                vector = array('d')
+                vector.fromstring(str(blob))
+                if sys.byteorder != "little":
+                    vector.byteswap()
+                if len(vector) == len(STAT_NAMES):
+                    result[id] = vector
+        return result
+
+    def put(self, item_id, vector):
+        data = array('d', vector)
+        if sys.byteorder != "little":
+            data.byteswap()
+        self._lock.acquire()
+        try:
+            self._db.execute("INSERT OR REPLACE INTO item_stats (id, version, "
+                    "vector) VALUES (?, ?, ?)", (int(item_id), self.version,
+                    sqlite3.Binary(data.tostring())))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+
+_item_stats = {}
+_item_stats_lock = threading.Lock()
+_stats_db = None
+
+def set_stats_db(stats_db):
+    """Keep stat vectors in stats_db (an ItemStatsDB), None keeps them in
+    memory only."""
+    global _stats_db
+    _stats_db = stats_db
+
+def get_stats_db():
+    return _stats_db
+
+def _remember(vectors):
+    _item_stats_lock.acquire()
+    _item_stats.update(vectors)
+    _item_stats_lock.release()
+
+def get_item_stats(item_id, base_url):
+    """Stat vector of an item, from its tooltip. Remembered per item id, in
+    the stats database too if one is set."""
+    item_id = int(item_id)
+    vector = _item_stats.get(item_id)
+    if vector is None and _stats_db is not None:
+        vector = _stats_db.get_many([item_id]).get(item_id)
+        if vector is not None:
+            _remember({item_id: vector})
+    if vector is None:
+        url = armoread.get_itemtooltip_url(item_id, base_url)
+        tooltip = armoxml.parse(armoread.open_url(url), armoxml.ItemTooltipHandler())
+        vector = get_stat_vector(tooltip)
+        if _stats_db is not None:
+            _stats_db.put(item_id, vector)
+        _remember({item_id: vector})
+    return vector
+
+def load_item_stats(item_ids, base_url, pool=None):
+    """{item id: stat vector} for item_ids, each distinct id fetched once.
+
+    pool -- an armonet.FetchPool to fetch with, if given.
+
+    Items that fail to load are left out (and scored as having no stats).
+    """
+    ids = set([int(id) for id in item_ids if id])
+    result = {}
+    for id in ids:
+        if id in _item_stats:
+            result[id] = _item_stats[id]
+    if _stats_db is not None and len(result) < len(ids):
+        # the known ones in a query per batch, not one per item
+        stored = _stats_db.get_many(ids.difference(result))
+        _remember(stored)
+        result.update(stored)
+    ids.difference_update(result)
+    def load(id):
+        result[id] = get_item_stats(id, base_url)
+    for id in ids:
+        if pool is None:
+            try:
+                load(id)
+            except Exception:
+                pass
+        else:
+            pool.add(armoread.get_itemtooltip_url(id, base_url), load, id)
+    if pool is not None:
+        pool.join()
+    return result
+
+def load_characters(names, realm, base_url, pool=None):
+    """[Character, ...] read from their character sheets, see
+    armoread.get_chars."""
+    return armoread.get_chars(names, realm, base_url, pool)
+
+
+class GearScores(object):
+    """Gear scores of a batch of characters.
+
+    names -- the character names, in the order they were given
+    scores -- gear score per character
+    stats -- stat totals per character, each in STAT_NAMES order
+    slots -- score per character and slot, each a list of MAX_SLOTS scores
+    """
+
+    def __init__(self, names, scores, stats, slots):
+        self.names = names
+        self.scores = scores
+        self.stats = stats
+        self.slots = slots
+
+    def ranking(self):
+        """[(score, name), ...], best first."""
+        ranking = zip([float(s) for s in self.scores], self.names)
+        ranking.sort(reverse=True)
+        return ranking
+
+    def get_stats(self, i):
+        """{stat name: total} of the i:th character."""
+        return dict(zip(STAT_NAMES, [float(v) for v in self.stats[i]]))
+
+    def get_slots(self, i):
+        """{slot: score} of the i:th character, for slots with items."""
+        return dict([(slot, float(score))
+            for slot, score in enumerate(self.slots[i]) if score])
+
+
+def score_characters(chars, item_stats):
+    """Score a list of Characters in one go.
+
+    item_stats -- {item id: stat vector}, see load_item_stats. Items missing
+        from it count as having no stats.
+
+    Items in a slot outside 0..MAX_SLOTS-1 (or none) are left out.
+    """
+    names = [char.name for char in chars]
+    columns = {}
+    rows, slots, cols = [], [], []
+    for row, char in enumerate(chars):
+        for slot, id in char.get_item_ids():
+            if slot is None or not 0 <= slot < MAX_SLOTS:
+                continue
+            if id not in columns:
+                columns[id] = len(columns)
+            rows.append(row)
+            slots.append(slot)
+            cols.append(columns[id])
+    vectors = [None] * len(columns)
+    empty = new_stat_vector()
+    for id, col in columns.iteritems():
+        vectors[col] = item_stats.get(id, empty)
+    if numpy is not None:
+        return _score_numpy(names, vectors, rows, slots, cols)
+    return _score_arrays(names, vectors, rows, slots, cols)
+
+def _score_numpy(names, vectors, rows, slots, cols):
+    n = len(names)
+    weights = numpy.array(WEIGHTS)
+    items = numpy.array([list(v) for v in vectors], dtype=float)
+    items = items.reshape((len(vectors), len(STAT_NAMES)))
+    rows = numpy.array(rows, dtype=int)
+    slots = numpy.array(slots, dtype=int)
+    cols = numpy.array(cols, dtype=int)
+    item_scores = items.dot(weights)
+    # summed per character, no characters x items matrix
+    stats = numpy.zeros((n, len(STAT_NAMES)))
+    numpy.add.at(stats, rows, items[cols])
+    slot_scores = numpy.zeros((n, MAX_SLOTS))
+    numpy.add.at(slot_scores, (rows, slots), item_scores[cols])
+    return GearScores(names, stats.dot(weights), stats, slot_scores)
+
+def _score_arrays(names, vectors, rows, slots, cols):
+    nstats = len(STAT_NAMES)
+    item_scores = [sum([v * w for v, w in zip(vector, WEIGHTS)])
+            for vector in vectors]
+    stats = [new_stat_vector() for name in names]
+    slot_scores = [array('d', [0.0]) * MAX_SLOTS for name in names]
+    scores = [0.0] * len(names)
+    for row, slot, col in zip(rows, slots, cols):
+        totals, vector = stats[row], vectors[col]
+        for i in xrange(nstats):
+            totals[i] += vector[i]
+        slot_scores[row][slot] += item_scores[col]
+        scores[row] += item_scores[col]
+    return GearScores(names, scores, stats, slot_scores)
+
+
+def score_guild_chars(names, realm, base_url, pool=None):
+    """Load the named characters and their items, return GearScores."""
+    chars = load_characters(names, realm, base_url, pool)
+    ids = []
+    for char in chars:
+        ids.extend([id for slot, id in char.get_item_ids()])
+    item_stats = load_item_stats(ids, base_url, pool)
+    return score_characters(chars, item_stats)
+
+def print_gearscores(result, verbose=False, out=sys.stdout):
+    index = dict([(name, i) for i, name in enumerate(result.names)])
+    for score, name in result.ranking():
+        print >> out, "%8.1f  %s" % (score, name)
+        if verbose:
+            slots = result.get_slots(index[name])
+            for slot in sorted(slots):
+                print >> out, "          slot %2d: %7.1f" % (slot, slots[slot])
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""History of character stats.
+
+Every time a character sheet is fetched (with armoread.set_history, or
+--history on the command line) a row is appended to a set of column files
+under the history directory, one value (or fixed width group of values)
+per row:
+
+    history/time.d      fetch time, seconds since the epoch (double)
+    history/char.i      index into chars.json, [realm, name] (int)
+    history/guild.i     index into guilds.json, [realm, guild] (int)
+    history/stats.d     armoxml.STAT_KEYS values (doubles)
+    history/ilvl.d      item level per slot, 0 for empty slots (doubles)
+
+Queries read the columns they need (memory-mapped with NumPy if it is
+installed) and never touch the archived XML.
+
+armohistory.py
+    -h, --help              Show help - what you are reading now.
+    -r ..., --realm=...     Set realm.
+    -g ..., --guild=...     Set guild.
+    -d ..., --days=...      Look at the last N days (default 7).
+    --ilvl                  Print the guild's average item level per day.
+    --gain=...              Print who gained the most of a stat, eg
+                            --gain=defenses/armor/effective
+    -n ...                  Number of characters to print (default 10).
+    --dir=...               History directory (default ./history).
+"""
+
+import os
+import sys
+import time
+import json
+import getopt
+import threading
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import armoxml
+
+HISTORY_DIR = "history/"
+DAY = 24 * 60 * 60
+MAX_SLOTS = 19
+# shirt and tabard don't count towards the average item level
+COSMETIC_SLOTS = (3, 18)
+
+# name => (typecode, values per row)
+COLUMNS = {
+    "time": ('d', 1),
+    "char": ('i', 1),
+    "guild": ('i', 1),
+    "stats": ('d', len(armoxml.STAT_KEYS)),
+    "ilvl": ('d', MAX_SLOTS),
+}
+NUMPY_TYPES = {'d': '<f8', 'i': '<i4'}
+
+
+class History(object):
+    """Stat history in directory 'dir'."""
+
+    def __init__(self, dir=HISTORY_DIR):
+        self.dir = dir
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        self._lock = threading.Lock()
+        self.chars = self._load_names("chars.json")
+        self.guilds = self._load_names("guilds.json")
+        self._char_index = dict([(tuple(k), i) for i, k in enumerate(self.chars)])
+        self._guild_index = dict([(tuple(k), i) for i, k in enumerate(self.guilds)])
+        self.rows = self._repair()
+
+    def _get_path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _column_path(self, column):
+        return self._get_path("%s.%s" % (column, COLUMNS[column][0]))
+
+    def _load_names(self, filename):
+        try:
+            f = open(self._get_path(filename), 'rb')
+        except IOError:
+            return []
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def _save_names(self, filename, names):
+        path = self._get_path(filename)
+        f = open(path + '.tmp', 'wb')
+        try:
+            json.dump(names, f)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+    def _repair(self):
+        """Cut all columns to the number of complete rows, in case a crash
+        left some of them a row ahead. Return the number of rows."""
+        rows = None
+        for column, (typecode, width) in COLUMNS.iteritems():
+            path = self._column_path(column)
+            size = os.path.exists(path) and os.path.getsize(path) or 0
+            n = size // (array(typecode).itemsize * width)
+            if rows is None or n < rows:
+                rows = n
+        for column, (typecode, width) in COLUMNS.iteritems():
+            path = self._column_path(column)
+            size = rows * array(typecode).itemsize * width
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                f = open(path, 'r+b')
+                f.truncate(size)
+                f.close()
+        return rows
+
+    def _get_id(self, index, names, key, filename):
+        i = index.get(key)
+        if i is None:
+            i = index[key] = len(names)
+            names.append(list(key))
+            self._save_names(filename, names)
+        return i
+
+    def record(self, char, timestamp=None):
+        """Append a row for an armoread.Character read from its sheet."""
+        if timestamp is None:
+            timestamp = time.time()
+        ilvl = array('d', [0.0]) * MAX_SLOTS
+        for item in char.items:
+            if item.slot is not None and 0 <= item.slot < MAX_SLOTS:
+                ilvl[item.slot] = item.level
+        self._lock.acquire()
+        try:
+            char_id = self._get_id(self._char_index, self.chars,
+                    (char.realm, char.name), "chars.json")
+            guild_id = self._get_id(self._guild_index, self.guilds,
+                    (char.realm, char.guild_name), "guilds.json")
+            values = {
+                "time": array('d', [timestamp]),
+                "char": array('i', [char_id]),
+                "guild": array('i', [guild_id]),
+                "stats": array('d', char.stats.values),
+                "ilvl": ilvl,
+            }
+            for column, data in values.iteritems():
+                f = open(self._column_path(column), 'ab')
+                try:
+                    data.tofile(f)
+                finally:
+                    f.close()
+            self.rows += 1
+        finally:
+            self._lock.release()
+
+    def load(self, column):
+        """A column, as a NumPy array (rows x width, memory-mapped) or, without
+        NumPy, as a list of values (or of arrays for wide columns)."""
+        typecode, width = COLUMNS[column]
+        rows = self.rows
+        path = self._column_path(column)
+        if numpy is not None:
+            if not rows:
+                return numpy.zeros((0, width) if width > 1 else 0)
+            data = numpy.memmap(path, NUMPY_TYPES[typecode], 'r',
+                    shape=(rows * width,))
+            if width > 1:
+                return data.reshape((rows, width))
+            return data
+        data = array(typecode)
+        if rows:
+            f = open(path, 'rb')
+            try:
+                data.fromfile(f, rows * width)
+            finally:
+                f.close()
+        if width == 1:
+            return data.tolist()
+        return [data[i * width:(i + 1) * width] for i in xrange(rows)]
+
+    def _select(self, since, until, guild=None):
+        """Row numbers in [since, until), of the guild's members if given as
+        (realm, guild)."""
+        times = self.load("time")
+        if guild is not None:
+            guild_id = self._guild_index.get(tuple(guild), -1)
+            guilds = self.load("guild")
+        if numpy is not None:
+            mask = (times >= since) & (times < until)
+            if guild is not None:
+                mask &= guilds == guild_id
+            return numpy.nonzero(mask)[0]
+        return [i for i, t in enumerate(times) if since <= t < until
+                and (guild is None or guilds[i] == guild_id)]
+
+    def average_item_level(self, realm, guild, since, until=None):
+        """[(day start, average item level), ...] of the guild's members
+        between since and until, per day."""
+        if until is None:
+            until = time.time()
+        rows = self._select(since, until, (realm, guild))
+        times = self.load("time")
+        ilvl = self.load("ilvl")
+        slots = [s for s in range(MAX_SLOTS) if s not in COSMETIC_SLOTS]
+        if numpy is not None:
+            levels = ilvl[rows][:, slots]
+            worn = (levels > 0).sum(axis=1)
+            means = levels.sum(axis=1) / numpy.maximum(worn, 1)
+            days = (times[rows] // DAY) * DAY
+            result = []
+            for day in numpy.unique(days):
+                result.append((float(day), float(means[days == day].mean())))
+            return result
+        per_day = {}
+        for i in rows:
+            levels = [ilvl[i][s] for s in slots if ilvl[i][s] > 0]
+            mean = levels and sum(levels) / len(levels) or 0.0
+            per_day.setdefault((times[i] // DAY) * DAY, []).append(mean)
+        return [(day, sum(v) / len(v)) for day, v in sorted(per_day.items())]
+
+    def top_gainers(self, stat_key, since, until=None, realm=None, guild=None, n=10):
+        """[(gain, realm, name), ...] of the n characters whose stat_key (see
+        armoxml.STAT_KEYS) went up the most between their first and last row
+        in [since, until)."""
+        if until is None:
+            until = time.time()
+        column = armoxml.STAT_INDEX[stat_key]
+        rows = self._select(since, until, guild is not None and (realm, guild) or None)
+        times = self.load("time")
+        chars = self.load("char")
+        stats = self.load("stats")
+        if numpy is not None:
+            return self._top_gainers_numpy(rows, times, chars, stats, column, n)
+        first, last = {}, {}
+        # rows are appended in time order, but imports may not be
+        for i in rows:
+            char, t, value = chars[i], times[i], stats[i][column]
+            if char not in first or t < first[char][0]:
+                first[char] = (t, value)
+            if char not in last or t >= last[char][0]:
+                last[char] = (t, value)
+        gains = [(float(last[c][1] - first[c][1]),) + tuple(self.chars[c])
+                for c in last]
+        gains.sort(reverse=True)
+        return gains[:n]
+
+    def _top_gainers_numpy(self, rows, times, chars, stats, column, n):
+        if not len(rows) or n <= 0:
+            return []
+        chars = chars[rows]
+        values = stats[rows, column]
+        # by char, then time; the sort is stable so equal times stay in row
+        # order, like the first < / last >= of the loop above
+        order = numpy.lexsort((times[rows], chars))
+        chars = chars[order]
+        values = values[order]
+        starts = numpy.concatenate(([0], numpy.nonzero(numpy.diff(chars))[0] + 1))
+        ends = numpy.concatenate((starts[1:], [len(chars)])) - 1
+        gains = values[ends] - values[starts]
+        ids = chars[starts]
+        # only the best n (and whoever ties with the n-th) get sorted by name
+        if len(gains) > n:
+            cutoff = numpy.partition(gains, -n)[-n]
+            keep = numpy.nonzero(gains >= cutoff)[0]
+            gains, ids = gains[keep], ids[keep]
+        result = [(float(g),) + tuple(self.chars[c]) for g, c in zip(gains, ids)]
+        result.sort(reverse=True)
+        return result[:n]
+
+
+def usage():
+    print __doc__
+
+def _main(argv):
+    class Flags: pass
+    flags = Flags()
+    flags.dir = HISTORY_DIR
+    flags.realm = 'Trollbane'
+    flags.guild = 'Emerge'
+    flags.days = 7
+    flags.ilvl = False
+    flags.gain = None
+    flags.n = 10
+    try:
+        opts, args = getopt.getopt(argv, "hr:g:d:n:", ["help", "realm=",
+            "guild=", "days=", "ilvl", "gain=", "dir="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ('-r', '--realm'):
+            flags.realm = arg
+        elif opt in ('-g', '--guild'):
+            flags.guild = arg
+        elif opt in ('-d', '--days'):
+            flags.days = float(arg)
+        elif opt == '-n':
+            flags.n = int(arg)
+        elif opt == '--ilvl':
+            flags.ilvl = True
+        elif opt == '--gain':
+            flags.gain = arg
+        elif opt == '--dir':
+            flags.dir = arg
+
+    history = History(flags.dir)
+    since = time.time() - flags.days * DAY
+    if flags.ilvl:
+        for day, level in history.average_item_level(flags.realm, flags.guild, since):
+            print "%s %6.1f" % (time.strftime("%Y-%m-%d", time.gmtime(day)), level)
+    if flags.gain:
+        for gain, realm, name in history.top_gainers(flags.gain, since,
+                realm=flags.realm, guild=flags.guild, n=flags.n):
+            print ("%10.1f  %s@%s" % (gain, name, realm)).encode('utf-8')
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Index of who wears what.
+
+Every character sheet read (with armoread.set_index, or --index on the
+command line) is added to an inverted index in a SQLite database
+(index.db): for each term, the characters it applies to. The terms of a
+sheet are
+
+    item:<id>           an item worn, in any slot
+    gem:<id>            a gem socketed, in any item
+    enchant:<id>        a permanent enchant (by enchanting item id)
+    item:<id>@<slot>, gem:<id>@<slot>, enchant:<id>@<slot>
+                        the same, in that slot only
+    glyph:<id>          a glyph
+    profession:<id>     a profession
+
+A newer sheet of a character replaces its terms. Queries combine terms with
+AND, OR, NOT and parentheses, NOT meaning all characters indexed (of the
+realm and guild asked for) but those:
+
+    item:50415 AND NOT gem:41380@0
+    (enchant:44150 OR enchant:44159) AND NOT profession:333
+
+A query is run as one SQL statement, each term a range of the postings'
+primary key and the sets combined by SQLite (INTERSECT, UNION, EXCEPT), so
+it takes milliseconds over tens of thousands of characters.
+
+armoindex.py
+    -h, --help              Show help - what you are reading now.
+    -r ..., --realm=...     Only characters of this realm.
+    -g ..., --guild=...     Only characters of this guild.
+    -q ..., --query=...     Print the characters matching a query.
+    --add=...               Index the character sheets (XML files) in this
+                            directory, eg chars/.
+    --db=...                Index database (default ./index.db).
+"""
+
+import os
+import re
+import sys
+import time
+import getopt
+import sqlite3
+import threading
+
+INDEX_DB = "index.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chars (
+    id INTEGER PRIMARY KEY,
+    realm TEXT,
+    name TEXT,
+    guild TEXT,
+    indexed REAL,
+    UNIQUE (realm, name)
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT,
+    char INTEGER,
+    PRIMARY KEY (term, char)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_char ON postings (char);
+"""
+
+TOKEN = re.compile(r"\s*(\(|\)|[^\s()]+)")
+OPERATORS = ("AND", "OR", "NOT")
+
+
+class QueryError(ValueError):
+    pass
+
+
+def get_terms(char):
+    """The index terms of an armoread.Character read from its sheet."""
+    terms = set()
+    for item in char.items:
+        slot = item.slot
+        values = [("item", item.id), ("enchant", item.enchant_id)]
+        values += [("gem", gem) for gem in item.gems]
+        for kind, id in values:
+            if id:
+                terms.add("%s:%s" % (kind, id))
+                if slot is not None:
+                    terms.add("%s:%s@%s" % (kind, id, slot))
+    for glyph in char.glyphs:
+        if glyph.id:
+            terms.add("glyph:%s" % glyph.id)
+    for profession in char.professions:
+        if profession.id:
+            terms.add("profession:%s" % profession.id)
+    return terms
+
+
+def parse_query(query):
+    """Parse a query into a tree of ("term", term), ("not", q), ("and", q1,
+    q2) and ("or", q1, q2). Operators are case insensitive, NOT binds
+    tightest, then AND, then OR."""
+    tokens = TOKEN.findall(query)
+    pos = [0]
+    def peek():
+        if pos[0] < len(tokens):
+            token = tokens[pos[0]]
+            return token.upper() in OPERATORS and token.upper() or token
+        return None
+    def take():
+        token = peek()
+        pos[0] += 1
+        return token
+    def parse_or():
+        node = parse_and()
+        while peek() == "OR":
+            take()
+            node = ("or", node, parse_and())
+        return node
+    def parse_and():
+        node = parse_not()
+        while peek() == "AND":
+            take()
+            node = ("and", node, parse_not())
+        return node
+    def parse_not():
+        if peek() == "NOT":
+            take()
+            return ("not", parse_not())
+        token = take()
+        if token == "(":
+            node = parse_or()
+            if take() != ")":
+                raise QueryError("missing ')' in %r" % query)
+            return node
+        if token is None or token in OPERATORS or token == ")":
+            raise QueryError("term expected in %r" % query)
+        return ("term", token)
+    node = parse_or()
+    if peek() is not None:
+        raise QueryError("unexpected %r in %r" % (peek(), query))
+    return node
+
+
+class Index(object):
+    """Inverted index of character sheets, in the SQLite database 'path'."""
+
+    def __init__(self, path=INDEX_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+
+    def _query(self, sql, args=()):
+        self._lock.acquire()
+        try:
+            return self._db.execute(sql, args).fetchall()
+        finally:
+            self._lock.release()
+
+    def add(self, char, timestamp=None):
+        """Index an armoread.Character read from its sheet, replacing what was
+        indexed for it before."""
+        if timestamp is None:
+            timestamp = time.time()
+        terms = get_terms(char)
+        self._lock.acquire()
+        try:
+            db = self._db
+            db.execute("INSERT OR IGNORE INTO chars (realm, name) VALUES (?, ?)",
+                    (char.realm, char.name))
+            db.execute("UPDATE chars SET guild = ?, indexed = ? WHERE realm = ? "
+                    "AND name = ?", (char.guild_name, timestamp, char.realm,
+                    char.name))
+            id = db.execute("SELECT id FROM chars WHERE realm = ? AND name = ?",
+                    (char.realm, char.name)).fetchone()[0]
+            db.execute("DELETE FROM postings WHERE char = ?", (id,))
+            db.executemany("INSERT INTO postings (term, char) VALUES (?, ?)",
+                    [(term, id) for term in terms])
+            db.commit()
+        finally:
+            self._lock.release()
+
+    def add_file(self, path):
+        """Index a character-sheet.xml file."""
+        import armoread
+        char = armoread.Character()
+        f = open(path, 'rb')
+        try:
+            char.parse_reader(f)
+        finally:
+            f.close()
+        if char.name:
+            self.add(char, os.path.getmtime(path))
+        return char
+
+    def _get_filter(self, realm=None, guild=None):
+        """SQL condition on chars and its arguments, for realm and guild."""
+        where, args = ["1"], []
+        if realm is not None:
+            where.append("realm = ?")
+            args.append(realm)
+        if guild is not None:
+            where.append("guild = ?")
+            args.append(guild)
+        return " AND ".join(where), args
+
+    def to_sql(self, node, args, realm=None, guild=None):
+        """SQL selecting the character ids of a parsed query (see
+        parse_query), appending its arguments to args. Each term is a range
+        of the postings' primary key, SQLite combines them."""
+        op = node[0]
+        if op == "term":
+            args.append(node[1])
+            return "SELECT char FROM postings WHERE term = ?"
+        if op == "not":
+            where, where_args = self._get_filter(realm, guild)
+            args.extend(where_args)
+            sql = "SELECT id FROM chars WHERE %s" % where
+            return "SELECT * FROM (%s) EXCEPT SELECT * FROM (%s)" % (sql,
+                    self.to_sql(node[1], args, realm, guild))
+        if op == "and" and node[1][0] == "not" and node[2][0] != "not":
+            node = ("and", node[2], node[1])
+        if op == "and" and node[2][0] == "not":
+            # a AND NOT b is a EXCEPT b, without going through all chars
+            left = self.to_sql(node[1], args, realm, guild)
+            right = self.to_sql(node[2][1], args, realm, guild)
+            compound = "EXCEPT"
+        else:
+            left = self.to_sql(node[1], args, realm, guild)
+            right = self.to_sql(node[2], args, realm, guild)
+            compound = op == "and" and "INTERSECT" or "UNION"
+        return "SELECT * FROM (%s) %s SELECT * FROM (%s)" % (left, compound,
+                right)
+
+    def query(self, query, realm=None, guild=None):
+        """[(realm, name), ...] of the characters (of realm and guild, if
+        given) matching a query, sorted."""
+        args = []
+        sql = self.to_sql(parse_query(query), args, realm, guild)
+        where, where_args = self._get_filter(realm, guild)
+        return self._query("SELECT realm, name FROM chars WHERE id IN (%s) "
+                "AND %s ORDER BY realm, name" % (sql, where), args + where_args)
+
+
+def usage():
+    print __doc__
+
+def _main(argv):
+    class Flags: pass
+    flags = Flags()
+    flags.db = INDEX_DB
+    flags.realm = None
+    flags.guild = None
+    flags.queries = []
+    flags.add = []
+    try:
+        opts, args = getopt.getopt(argv, "hr:g:q:", ["help", "realm=", "guild=",
+            "query=", "add=", "db="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ('-r', '--realm'):
+            flags.realm = arg.decode('utf-8')
+        elif opt in ('-g', '--guild'):
+            flags.guild = arg.decode('utf-8')
+        elif opt in ('-q', '--query'):
+            flags.queries.append(arg)
+        elif opt == '--add':
+            flags.add.append(arg)
+        elif opt == '--db':
+            flags.db = arg
+
+    index = Index(flags.db)
+    try:
+        for dir in flags.add:
+            count = 0
+            for filename in sorted(os.listdir(dir)):
+                if filename.endswith('.xml'):
+                    index.add_file(os.path.join(dir, filename))
+                    count += 1
+            print "%d sheets indexed from '%s'" % (count, dir)
+        for query in flags.queries:
+            try:
+                chars = index.query(query, flags.realm, flags.guild)
+            except QueryError, e:
+                print >> sys.stderr, e
+                sys.exit(2)
+            for realm, name in chars:
+                print ("%s@%s" % (name, realm)).encode('utf-8')
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
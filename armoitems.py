@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local item database.
+
+Items don't change, so once an item's item-info.xml and item-tooltip.xml
+have been fetched they are kept in a SQLite database, indexed by item id,
+together with the basic item info (name, level, quality, ...). Both
+documents are fetched together the first time either is asked for.
+
+When set with armoread.set_item_db all item-info/item-tooltip urls opened
+through armoread.open_url are answered from the database. To resolve a lot
+of items at once (all items, gems and enchants of a character sheet, or of
+a whole guild) use resolve: the known ids are read in one query and each
+missing id is fetched once, concurrently if given a pool.
+
+    db = ItemDB("items.db")
+    items = db.resolve_characters(chars, base_url, pool)
+"""
+
+import zlib
+import time
+import sqlite3
+import threading
+import urlparse
+from cStringIO import StringIO
+
+import armoread
+import armoxml
+import armocache
+
+ITEM_DB = "items.db"
+# max number of variables in one sqlite statement is 999
+QUERY_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    level INTEGER,
+    quality INTEGER,
+    type TEXT,
+    icon TEXT,
+    info BLOB,
+    tooltip BLOB,
+    fetched REAL
+)
+"""
+COLUMNS = "id, name, level, quality, type, icon"
+
+RESOURCES = {'item-info.xml': 'info', 'item-tooltip.xml': 'tooltip'}
+
+
+def get_item_id(url):
+    """'http://eu.wowarmory.com/item-info.xml?i=123' => 123"""
+    query = urlparse.parse_qs(urlparse.urlsplit(url)[3])
+    return int(query["i"][0])
+
+def get_base_url(url):
+    """'http://eu.wowarmory.com/item-info.xml?i=123' =>
+    'http://eu.wowarmory.com/'"""
+    scheme, host, path, query, fragment = urlparse.urlsplit(url)
+    return urlparse.urlunsplit((scheme, host, path.rsplit('/', 1)[0] + '/', '', ''))
+
+
+class ItemDB(object):
+    """Items stored in the SQLite database 'path'.
+
+    fetch -- function(url) returning a reader, used for items not in the
+        database. armoread.set_item_db sets it to armoread's own (cached)
+        fetching.
+    """
+
+    def __init__(self, path=ITEM_DB, fetch=None):
+        self.path = path
+        self.fetch = fetch
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute(SCHEMA)
+        self._db.commit()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._db.close()
+        finally:
+            self._lock.release()
+
+    def handles(self, url):
+        return armocache.get_resource(url) in RESOURCES
+
+    def _query(self, sql, args=()):
+        self._lock.acquire()
+        try:
+            return self._db.execute(sql, args).fetchall()
+        finally:
+            self._lock.release()
+
+    def get_document(self, item_id, kind):
+        """The stored 'info' or 'tooltip' document of an item, or None."""
+        rows = self._query("SELECT %s FROM items WHERE id = ?" % kind,
+                (int(item_id),))
+        if not rows or rows[0][0] is None:
+            return None
+        return zlib.decompress(rows[0][0])
+
+    def get_many(self, item_ids):
+        """{id: armoread.Item} for the ids in the database, in one query per
+        QUERY_BATCH ids."""
+        ids = list(set([int(id) for id in item_ids]))
+        result = {}
+        for i in range(0, len(ids), QUERY_BATCH):
+            batch = ids[i:i + QUERY_BATCH]
+            sql = "SELECT %s FROM items WHERE id IN (%s)" % (COLUMNS,
+                    ", ".join(["?"] * len(batch)))
+            for row in self._query(sql, batch):
+                result[row[0]] = self._make_item(row)
+        return result
+
+    def _make_item(self, row):
+        item = armoread.Item(row[0])
+        item.name = row[1].decode('utf-8')
+        item.level = row[2]
+        item.rarity = row[3]
+        item.type = row[4].decode('utf-8')
+        item.icon = row[5].decode('utf-8')
+        return item
+
+    def put(self, item_id, info, tooltip):
+        """Store an item's item-info.xml and item-tooltip.xml documents."""
+        handler = armoxml.ItemInfoHandler()
+        armoxml.parse(StringIO(info), handler)
+        record = handler.info or armoxml.ItemInfo(int(item_id), u'', 0, 0, u'', u'')
+        self._lock.acquire()
+        try:
+            self._db.execute("INSERT OR REPLACE INTO items VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?)", (int(item_id),
+                    record.name.encode('utf-8'), record.level,
+                    record.quality, record.type.encode('utf-8'),
+                    record.icon.encode('utf-8'),
+                    sqlite3.Binary(zlib.compress(info)),
+                    sqlite3.Binary(zlib.compress(tooltip)), time.time()))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def fetch_item(self, item_id, base_url):
+        """Fetch and store an item's documents, return (info, tooltip)."""
+        info = self.fetch(armoread.get_iteminfo_url(item_id, base_url)).read()
+        tooltip = self.fetch(armoread.get_itemtooltip_url(item_id, base_url)).read()
+        self.put(item_id, info, tooltip)
+        self.misses += 1
+        return info, tooltip
+
+    def open_url(self, url):
+        """Return a reader of an item-info.xml or item-tooltip.xml url,
+        fetching the item if it isn't in the database."""
+        item_id = get_item_id(url)
+        kind = RESOURCES[armocache.get_resource(url)]
+        doc = self.get_document(item_id, kind)
+        if doc is None:
+            info, tooltip = self.fetch_item(item_id, get_base_url(url))
+            doc = {'info': info, 'tooltip': tooltip}[kind]
+        else:
+            self.hits += 1
+        return StringIO(doc)
+
+    def resolve(self, item_ids, base_url, pool=None):
+        """{id: armoread.Item} for all item_ids.
+
+        Known items are read in one query, the rest are fetched once each
+        (with pool, an armonet.FetchPool, if given) and stored. Items that
+        fail to fetch are left out."""
+        ids = set([int(id) for id in item_ids if id])
+        result = self.get_many(ids)
+        self.hits += len(result)
+        missing = ids.difference(result)
+        for id in missing:
+            if pool is None:
+                try:
+                    self.fetch_item(id, base_url)
+                except Exception:
+                    pass
+            else:
+                pool.add(armoread.get_iteminfo_url(id, base_url),
+                        self.fetch_item, id, base_url)
+        if pool is not None and missing:
+            pool.join()
+        if missing:
+            result.update(self.get_many(missing))
+        return result
+
+    def resolve_characters(self, chars, base_url, pool=None):
+        """{id: armoread.Item} for every item, gem and enchant worn by any of
+        the Characters."""
+        ids = set()
+        for char in chars:
+            ids.update([id for slot, id in char.get_item_ids()])
+        return self.resolve(ids, base_url, pool)
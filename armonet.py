@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Network helpers for armoread.
+
+Session keeps connections to each host open between requests (HTTP/1.1
+keep-alive) and asks for gzip/deflate compressed responses, which are
+decompressed on the fly while reading:
+
+    session = Session({'user-agent': USER_AGENT})
+    reader = session.open(url)
+    data = reader.read()
+
+A RateLimiter in front of a Session keeps the request rate to each host
+below a token bucket rate, backs off (with jitter) and retries when the
+server answers 503/429 or can't be reached, lowering the rate it allows
+while the host is throttling and raising it again as requests succeed.
+Retries come out of a budget refilled by successful requests, and a host
+failing over and over is cut off for a while (circuit breaker), requests to
+it failing at once with CircuitOpen.
+
+FetchPool runs fetch jobs (typically "download this url and write it to a
+file") on a bounded number of worker threads, with a limit on how many jobs
+may talk to the same host at once. A failing job is recorded and reported
+when the pool is joined, it never aborts the rest of the batch.
+
+    pool = FetchPool(jobs=8)
+    pool.add(url, dump_url_to_file, url, filename, verbose, force)
+    failures = pool.join()
+"""
+
+import sys
+import time
+import zlib
+import random
+import socket
+import httplib
+import urllib2
+import threading
+import Queue
+import urlparse
+
+import armotrace
+
+MAX_JOBS = 4
+MAX_IDLE = 16           # idle connections kept per host
+MAX_REDIRECTS = 5
+TIMEOUT = 30
+CHUNK_SIZE = 16 * 1024
+REDIRECT_CODES = (301, 302, 303, 307)
+THROTTLE_CODES = (429, 503)
+
+RATE = 5.0              # requests per second and host
+BURST = 10              # requests that can be made at once after idling
+MIN_RATE = 0.2
+MAX_RETRIES = 5
+RETRY_BUDGET = 20       # retries available up front ...
+RETRY_RATIO = 0.1       # ... plus this many per successful request
+BACKOFF = 1.0           # seconds, doubled per retry, with full jitter
+MAX_BACKOFF = 60.0
+BREAKER_THRESHOLD = 10  # failures in a row that open the circuit ...
+BREAKER_COOLDOWN = 120  # ... for this many seconds
+
+
+def get_host(url):
+    """'http://eu.wowarmory.com/item-info.xml?i=1' => 'eu.wowarmory.com'"""
+    return urlparse.urlsplit(url)[1].lower()
+
+
+class CircuitOpen(urllib2.URLError):
+    """Raised for requests to a host that has been failing too much."""
+    pass
+
+
+class TokenBucket(object):
+    """Allows 'rate' requests per second on average, 'burst' at once.
+
+    The rate is lowered by slow_down and creeps back up to max_rate by
+    speed_up (additive increase, multiplicative decrease).
+    """
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.max_rate = self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be made."""
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self.tokens = min(self.burst,
+                        self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            finally:
+                self._lock.release()
+            time.sleep(wait)
+
+    def slow_down(self):
+        self._lock.acquire()
+        self.rate = max(MIN_RATE, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+        self._lock.release()
+
+    def speed_up(self):
+        self._lock.acquire()
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+        self._lock.release()
+
+
+class CircuitBreaker(object):
+    """Opens after 'threshold' failures in a row. Once 'cooldown' seconds
+    have passed one request at a time is let through (half open) until one
+    succeeds and closes it again."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self._trying = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        self._lock.acquire()
+        try:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened < self.cooldown or self._trying:
+                return False
+            self._trying = True
+            return True
+        finally:
+            self._lock.release()
+
+    def success(self):
+        self._lock.acquire()
+        self.failures = 0
+        self.opened = None
+        self._trying = False
+        self._lock.release()
+
+    def failure(self):
+        self._lock.acquire()
+        self.failures += 1
+        if self.failures >= self.threshold or self._trying:
+            self.opened = time.time()
+        self._trying = False
+        self._lock.release()
+
+
+class RateLimiter(object):
+    """Token bucket, retries and circuit breaker per host, see Session.
+
+    rate -- requests per second per host, 0 for no limit.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, max_retries=MAX_RETRIES,
+            retry_budget=RETRY_BUDGET, breaker_threshold=BREAKER_THRESHOLD,
+            breaker_cooldown=BREAKER_COOLDOWN):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_budget = self.budget = float(retry_budget)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.retries = 0
+        self.throttled = 0
+        self._buckets = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _get(self, host):
+        self._lock.acquire()
+        try:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.breaker_threshold,
+                        self.breaker_cooldown)
+                if self.rate:
+                    self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return self._buckets.get(host), self._breakers[host]
+        finally:
+            self._lock.release()
+
+    def wait(self, host):
+        """Wait for our turn to make a request to host."""
+        bucket, breaker = self._get(host)
+        if not breaker.allow():
+            raise CircuitOpen("too many failures from '%s', giving it a rest" % host)
+        if bucket is not None:
+            bucket.acquire()
+
+    def success(self, host):
+        bucket, breaker = self._get(host)
+        breaker.success()
+        if bucket is not None:
+            bucket.speed_up()
+        self._lock.acquire()
+        self.budget = min(self.max_budget, self.budget + RETRY_RATIO)
+        self._lock.release()
+
+    def failure(self, host, throttled=False):
+        bucket, breaker = self._get(host)
+        breaker.failure()
+        if throttled:
+            self.throttled += 1
+            if bucket is not None:
+                bucket.slow_down()
+
+    def retry(self, attempt, retry_after=None):
+        """Return the seconds to wait before retry number 'attempt' (0 for
+        the first), or None if out of retries."""
+        self._lock.acquire()
+        try:
+            if attempt >= self.max_retries or self.budget < 1:
+                return None
+            self.budget -= 1
+            self.retries += 1
+        finally:
+            self._lock.release()
+        delay = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+        if retry_after:
+            delay = max(delay, min(MAX_BACKOFF, retry_after))
+        return delay
+
+
+def to_int(value):
+    """int(value), or None if it isn't a number."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Response(object):
+    """File like object reading the body of a response from a Session.
+
+    The body is decompressed while read if the server sent it gzip or
+    deflate encoded. Once the body has been read to the end the connection
+    is handed back to the session to be used for the next request.
+    """
+
+    def __init__(self, session, key, conn, resp, url):
+        self.url = url
+        self.code = resp.status
+        self.msg = resp.reason
+        self.headers = resp.msg
+        self._session = session
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._buf = ''
+        self._eof = False
+        self._transfer = 0.0
+        self._wire = 0
+        encoding = (resp.getheader('content-encoding') or '').lower()
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            # 32 + MAX_WBITS => detect gzip or zlib header by itself
+            self._decomp = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        else:
+            self._decomp = None
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def _release(self):
+        if self._conn is None:
+            return
+        if self._resp.will_close:
+            self._conn.close()
+        else:
+            self._session._put(self._key, self._conn)
+        self._conn = None
+
+    def _read_chunk(self):
+        while not self._eof:
+            start = time.time()
+            raw = self._resp.read(CHUNK_SIZE)
+            self._transfer += time.time() - start
+            self._wire += len(raw)
+            if not raw:
+                self._eof = True
+                self._release()
+                if armotrace.hooks:
+                    armotrace.emit("transfer", self.url, self._transfer, self._wire)
+                if self._decomp:
+                    return self._decomp.flush()
+                return ''
+            if not self._decomp:
+                return raw
+            data = self._decomp.decompress(raw)
+            if data:
+                return data
+        return ''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self._buf]
+            self._buf = ''
+            chunk = self._read_chunk()
+            while chunk:
+                chunks.append(chunk)
+                chunk = self._read_chunk()
+            return ''.join(chunks)
+        while len(self._buf) < size and not self._eof:
+            self._buf += self._read_chunk()
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        while '\n' not in self._buf and not self._eof:
+            self._buf += self._read_chunk()
+        end = self._buf.find('\n') + 1 or len(self._buf)
+        if size is not None and 0 <= size < end:
+            end = size
+        line, self._buf = self._buf[:end], self._buf[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        return list(iter(self.readline, ''))
+
+    def close(self):
+        """Close the response, a connection not read to the end is dropped."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._eof = True
+        self._buf = ''
+
+
+class Session(object):
+    """Keeps idle connections around per host and reuses them.
+
+    headers -- dict of headers sent with every request.
+    max_idle -- max number of idle connections kept per host.
+    limiter -- a RateLimiter for the requests, or None.
+
+    A Session can be shared between threads, each request gets a connection
+    of its own.
+    """
+
+    def __init__(self, headers=None, max_idle=MAX_IDLE, timeout=TIMEOUT,
+            limiter=None):
+        self.headers = {'accept-encoding': 'gzip, deflate'}
+        self.headers.update(headers or {})
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.limiter = limiter
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        """Return (connection, reused) for key = (scheme, host)."""
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        finally:
+            self._lock.release()
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def _put(self, key, conn):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def _request(self, url, headers):
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        selector = path or '/'
+        if query:
+            selector += '?' + query
+        key = (scheme.lower(), host.lower())
+        while True:
+            conn, reused = self._get(key)
+            try:
+                if armotrace.hooks and not reused:
+                    start = time.time()
+                    conn.connect()
+                    armotrace.emit("connect", url, time.time() - start)
+                start = time.time()
+                conn.request('GET', selector, headers=headers)
+                resp = conn.getresponse()
+                if armotrace.hooks:
+                    armotrace.emit("ttfb", url, time.time() - start)
+                return key, conn, resp
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # the server may have dropped an idle connection, try again
+                # with a new one before giving up
+                if not reused:
+                    raise urllib2.URLError(e)
+
+    def _request_limited(self, url, headers):
+        """_request, waiting for the limiter and retrying throttled and
+        failed requests."""
+        limiter = self.limiter
+        if limiter is None:
+            return self._request(url, headers)
+        host = get_host(url)
+        attempt = 0
+        while True:
+            limiter.wait(host)
+            try:
+                key, conn, resp = self._request(url, headers)
+            except urllib2.URLError:
+                limiter.failure(host)
+                delay = limiter.retry(attempt)
+                if delay is None:
+                    raise
+            else:
+                if resp.status not in THROTTLE_CODES:
+                    if resp.status >= 500:
+                        limiter.failure(host)
+                    else:
+                        limiter.success(host)
+                    return key, conn, resp
+                limiter.failure(host, throttled=True)
+                retry_after = to_int(resp.getheader('retry-after'))
+                delay = limiter.retry(attempt, retry_after)
+                if delay is None:
+                    return key, conn, resp
+                Response(self, key, conn, resp, url).read()
+            time.sleep(delay)
+            attempt += 1
+
+    def open(self, url, headers=None):
+        """GET url and return a Response.
+
+        Redirects are followed. Status codes >= 400 raise
+        urllib2.HTTPError, like urllib2 does.
+        """
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+        for i in range(MAX_REDIRECTS + 1):
+            key, conn, resp = self._request_limited(url, request_headers)
+            response = Response(self, key, conn, resp, url)
+            location = resp.getheader('location')
+            if resp.status in REDIRECT_CODES and location:
+                response.read()
+                url = urlparse.urljoin(url, location)
+                continue
+            if resp.status >= 400:
+                raise urllib2.HTTPError(url, resp.status, resp.reason,
+                        resp.msg, response)
+            return response
+        raise urllib2.HTTPError(url, resp.status, "too many redirects",
+                resp.msg, response)
+
+    def close(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+
+class FetchPool(object):
+    """Run jobs on a pool of worker threads.
+
+    jobs -- number of worker threads, ie max number of jobs running at once.
+    per_host -- max number of jobs running at once against the same host,
+        default jobs (all of them, as they usually go to the one armory).
+    """
+
+    def __init__(self, jobs=MAX_JOBS, per_host=None, verbose=False):
+        self.jobs = max(1, jobs)
+        self.per_host = max(1, per_host or self.jobs)
+        self.verbose = verbose
+        self.failures = []
+        self.done = 0
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._host_slots = {}
+        self._threads = []
+
+    def _get_host_slot(self, host):
+        self._lock.acquire()
+        try:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+        finally:
+            self._lock.release()
+
+    def _start(self):
+        while len(self._threads) < self.jobs:
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                url, func, args, kwargs = task
+                slot = self._get_host_slot(get_host(url))
+                slot.acquire()
+                try:
+                    func(*args, **kwargs)
+                except Exception, e:
+                    self._lock.acquire()
+                    self.failures.append((url, e))
+                    self._lock.release()
+                    if self.verbose:
+                        sys.stderr.write("failed '%s': %s\n" % (url, e))
+                else:
+                    self._lock.acquire()
+                    self.done += 1
+                    self._lock.release()
+                finally:
+                    slot.release()
+            finally:
+                self._queue.task_done()
+
+    def add(self, url, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) as a job fetching 'url'.
+
+        'url' is only used to pick the per host limit and to report failures.
+        """
+        self._start()
+        self._queue.put((url, func, args, kwargs))
+
+    def join(self):
+        """Wait for all queued jobs to finish and stop the workers.
+
+        Returns a list of (url, exception) for the jobs that failed.
+        """
+        self._queue.join()
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        return self.failures
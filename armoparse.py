@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Parsing on a pool of processes.
+
+Parsing XML is CPU bound and, with the GIL, a single process parses on one
+core no matter how many fetch threads it runs. ParsePool hands raw
+documents to worker processes, which send back the plain records of
+armoxml.parse_document (namedtuples and arrays, no DOM objects).
+
+At most max_pending documents are handed out and not yet collected with
+get, submit blocks until there is room. That keeps fetching from running
+ahead of parsing and bounds the memory held by both queues.
+
+    parse_pool = ParsePool()
+    for key, record, error in parse_pool.imap("char", documents):
+        ...
+
+fetch_and_parse runs the two stages together: FetchPool workers fetch,
+the documents are parsed on the ParsePool and the records come back to
+the calling thread as they are done.
+"""
+
+import Queue
+import threading
+import multiprocessing
+
+import armoread
+import armoxml
+
+MAX_PENDING_PER_PROCESS = 8
+
+_END = object()
+
+
+def _parse(key, kind, data):
+    """Run in the worker processes, errors are returned instead of raised
+    (Python 2 has no error callback for apply_async)."""
+    try:
+        return key, armoxml.parse_document(kind, data), None
+    except Exception, e:
+        return key, None, "%s: %s" % (e.__class__.__name__, e)
+
+
+class ParsePool(object):
+    """Parse documents on 'processes' worker processes (default one per
+    core), with at most max_pending documents submitted and not yet
+    collected. With processes=0 documents are parsed in the submitting
+    thread."""
+
+    def __init__(self, processes=None, max_pending=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        if max_pending is None:
+            max_pending = max(processes, 1) * MAX_PENDING_PER_PROCESS
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._results = Queue.Queue()
+        self._pool = None
+        if processes:
+            self._pool = multiprocessing.Pool(processes)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def submit(self, kind, data, key=None, block=True):
+        """Parse data (a str) as a document of kind (see
+        armoxml.parse_document). Blocks while max_pending documents are
+        waiting to be collected, unless not 'block', then returns False
+        without submitting."""
+        if not self._slots.acquire(block):
+            return False
+        if self._pool is None:
+            self._results.put(_parse(key, kind, data))
+        else:
+            self._pool.apply_async(_parse, (key, kind, data),
+                    callback=self._results.put)
+        return True
+
+    def get(self):
+        """(key, record, error) of the next parsed document, in the order
+        they are done. record is None and error a message if it failed."""
+        result = self._results.get()
+        if result is not _END:
+            self._slots.release()
+        return result
+
+    def imap(self, kind, documents):
+        """Yield (key, record, error) for each (key, data) of documents,
+        in the order they are done. documents is consumed only as fast as
+        the results are, it may be a generator reading them off the
+        network."""
+        pending = 0
+        for key, data in documents:
+            while not self.submit(kind, data, key, block=False):
+                pending -= 1
+                yield self.get()
+            pending += 1
+        for i in range(pending):
+            yield self.get()
+
+
+def fetch_and_parse(jobs, fetch_pool, parse_pool):
+    """Fetch and parse documents, yield (key, record, error) as they are
+    parsed.
+
+    jobs -- [(key, url, kind), ...]
+    fetch_pool -- armonet.FetchPool fetching the urls, failed fetches end
+        up in its failures (and yield nothing).
+    parse_pool -- ParsePool parsing the documents. Fetch workers wait for
+        room in it, so fetching never runs far ahead of parsing.
+    """
+    submitted = []
+    def fetch(key, url, kind):
+        data = armoread.open_url(url).read()
+        parse_pool.submit(kind, data, key)
+        submitted.append(key)
+    def feed():
+        try:
+            for key, url, kind in jobs:
+                fetch_pool.add(url, fetch, key, url, kind)
+            fetch_pool.join()
+        finally:
+            parse_pool._results.put(_END)
+    feeder = threading.Thread(target=feed)
+    feeder.setDaemon(True)
+    feeder.start()
+    received = 0
+    while True:
+        result = parse_pool.get()
+        if result is _END:
+            break
+        received += 1
+        yield result
+    # everything is fetched and submitted, collect what is still parsing
+    for i in range(len(submitted) - received):
+        yield parse_pool.get()
+    feeder.join()
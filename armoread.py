@@ -8,6 +8,10 @@ armoread.py
     -v, --verbose           Be verbose and print what's being done.
     -w                      Write stuff to file(s)
     -f, --force             Force writing (ie overwrite file if already exist).
+                            Without it existing files are left alone (and
+                            not fetched again). Files are written to a
+                            temporary file and renamed when complete, so
+                            there are never half written files.
     -r ..., --realm=...     Set realm.
     -g ..., --guild=...     Set guild.
                             If -w is specified AND neither -c nor -i is,
@@ -22,7 +26,49 @@ armoread.py
                                 <itemid>-tooltip.xml
     --eu, --us              Set area (EU or US). Used to pick which armory
                             to read from.
-    --gs, --gearscore       Calculate the gear score for involved characters.
+    --gs, --gearscore       Calculate the gear score for involved characters
+                            (the -c chars, or every member of the guild) and
+                            print them best first, instead of dumping.
+                            With -v the score per slot is printed too.
+                            Item stats are kept in ./itemstats.db (unless
+                            --no-cache), known items cost no request.
+    -j ..., --jobs=...      Number of downloads to run at once (default 4).
+                            A failed download is reported at the end, it
+                            doesn't stop the others.
+    --rate=...              Max requests per second to each armory host
+                            (default 5, 0 for no limit). Throttled (503/429)
+                            and failed requests are retried with backoff.
+    --no-online             Don't go online! Only serve what is in the
+                            response cache (./cache), no matter how old.
+    --no-cache              Don't use the response cache.
+    --itemdb=...            Keep items in (and read them from) this SQLite
+                            item database.
+    --archive               With -w, add snapshots to the archive in
+                            ./archive (see armoarchive.py) instead of
+                            writing loose files.
+    --stats                 Print how much time went to each stage
+                            (connect, first byte, transfer, cache, parse,
+                            model, write) and the slowest urls at exit.
+    --profile               Profile the run (all threads) with cProfile,
+                            print the top functions at exit and save the
+                            stats to ./armoread.prof.
+    --parse-jobs=...        Parse character sheets on this many processes
+                            (default 0, in the download threads).
+    --history               Add the stats and item levels of every character
+                            sheet read to the history in ./history (see
+                            armohistory.py).
+    --index                 Add the items, gems, enchants, glyphs and
+                            professions of every character sheet read to
+                            the index in ./index.db (see armoindex.py).
+    --export                Append the rosters, character sheets and items
+                            read to the columnar tables in ./export (see
+                            armoexport.py).
+    --sync                  Sync the guild incrementally: compare its roster
+                            to the last sync and only fetch the character
+                            sheets of members who joined or changed.
+                            Changes are printed, with -w the sheets are
+                            written to ./chars and the changes appended to
+                            ./guilds/<realm> - <guild>.log.
 
 Status: far from done, slightly useful =)
 Working: grabbing char-info and dump it to xml file.
@@ -31,99 +77,200 @@ Working: grabbing char-info and dump it to xml file.
     => Aabacus.xml Absolutus.xml
 
 TODO:
-    -f
-        Force overwriting of files.
-    --gs, --gearscore
-        Calculate gear score for selected chars.
     --gdir, --cdir, --idir
         Support flag to specify subdirectories (now hard coded to ./items,
     --mkdir
         Make dirs if they don't exist.
     ./guilds, ./chars)
-    --no-online
-        Don't go online! Read what can be read from existing files.
 """
 
+import os
 import sys
+import time
+import atexit
 import getopt
-import codecs
-import urllib2
-import xml.dom.minidom as xdm
+import threading
+import importlib
+import armotrace
+
+
+class _LazyModule(object):
+    """Stands in for a module until one of its attributes is used, then
+    imports it and takes its place in armoread's globals.
+
+    The network (armonet, armocache: httplib, urllib2, ...) and XML
+    (armoxml, minidom) layers cost more to import than most short runs spend
+    working, and url building or OPML updates need neither of them."""
+
+    def __init__(self, name, alias=None):
+        self._name = name
+        self._alias = alias or name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+armonet = _LazyModule("armonet")
+armocache = _LazyModule("armocache")
+armoxml = _LazyModule("armoxml")
+xdm = _LazyModule("xml.dom.minidom", "xdm")
+codecs = _LazyModule("codecs")
+tempfile = _LazyModule("tempfile")
+urllib = _LazyModule("urllib")
 
 #USER_AGENT = 'Mozilla/5.0 (Windows; U; Windows NT 5.0; en-GB; rv:1.8.1.4) Gecko/20070515 Firefox/2.0.0.4'
 USER_AGENT = 'Mozilla/5.0 (X11; U; Linux x86_64; en-US; rv:1.9.1.8) Gecko/20101337 Gentoo Firefox/3.5.8'
 BASE_URLs = {'EU':'http://eu.wowarmory.com/', 'US':'http://www.wowarmory.com/'}
 SERVER_AREA = 'EU'
 FILE_ENCODING = "utf-8"
+CHUNK_SIZE = 16 * 1024
+PROFILE_FILE = "armoread.prof"
+
+_stdout_lock = threading.Lock()
+_state_lock = threading.Lock()
+_umask = os.umask(0)
+os.umask(_umask)
+# made on first use, see get_session and get_cache
+_session = None
+_cache = None
+_use_cache = True
+# functions to run at the end of the run, None to leave them to atexit
+# (armod collects them to run at the end of each request)
+_exit_funcs = None
+_item_db = None
+_archive = None
+_history = None
+_index = None
+_exporter = None
+_parse_pool = None
+
+def emit_model(start, url=None):
+    """Report building a model, started at 'start', to the armotrace hooks."""
+    if armotrace.hooks:
+        armotrace.emit("model", url, time.time() - start)
+
+
+def lazy_property(name, load, doc=None):
+    """Property kept in the slot '_' + name, calling load(obj) to fill it in
+    the first time it is read while still None. Assigning to it works like
+    assigning an attribute."""
+    slot = "_" + name
+    def get(obj):
+        value = getattr(obj, slot)
+        if value is None:
+            load(obj)
+            value = getattr(obj, slot)
+        return value
+    def set(obj, value):
+        setattr(obj, slot, value)
+    return property(get, set, doc=doc)
+
 
 class Guild(object):
+    """A guild and its members, read from a guild-info.xml.
+
+    The parse_<element name> methods are called with the attributes of each
+    element of the document, either while it is streamed (parse_reader) or
+    by walking a minidom tree (parse). Only the attributes are kept, members
+    become Character objects that read their character sheets only when
+    their stats, items, ... are used.
+
+    Nothing but name and realm is read until used: the guild-info.xml is
+    fetched (or the dom given walked) the first time battle_group, faction,
+    member_count or members is.
+    """
+
+    __slots__ = ("base_url", "realm", "name", "_battle_group", "_faction",
+            "_member_count", "_members", "_dom")
 
     def __init__(self, guild='', realm='', base_url=BASE_URLs[SERVER_AREA], dom=None):
-        self.dom = dom
         self.base_url = base_url
         self.realm = realm
         self.name = guild
+        self._battle_group = self._faction = self._member_count = None
+        self._members = None
+        self._dom = dom
+
+    def _load(self):
+        """Read the guild-info.xml, from the dom given or the armory."""
+        if self._dom is not None:
+            self.parse(self._dom)
+        elif self.name:
+            self.parse_reader(open_url(get_guildinfo_url(self.name, self.realm,
+                self.base_url)))
+        else:
+            self._reset()
+
+    def _reset(self):
+        self._battle_group = ''
+        self._faction = self._member_count = 0
+        self._members = []
+
+    battle_group = lazy_property("battle_group", _load)
+    faction = lazy_property("faction", _load)
+    member_count = lazy_property("member_count", _load)
+    members = lazy_property("members", _load)
 
     def parse(self, node):
-        elements = [e for e in dom.childNodes
-                if e.nodeType == e.ELEMENT_NODE]
-        for node in elements:
-            method = getattr(self, "parse_%s" % node.__class__.__name__)
-            method(node)
+        start = time.time()
+        self._reset()
+        armoxml.walk_dom(node, self)
+        self._dom = None
+        emit_model(start)
 
-    def parse_page(self, node):
-        for node in node.getElementsByTagName("guildInfo"):
-            parse_guildInfo(node)
+    def parse_reader(self, reader):
+        self._reset()
+        armoxml.parse(reader, self)
 
-    def parse_guildInfo(self, node):
-        pass
+    def start(self, name, attrs):
+        method = getattr(self, "parse_%s" % name, None)
+        if method:
+            method(attrs)
 
-    def parse_guild(self, node):
-        pass
+    def parse_guildHeader(self, attrs):
+        header = armoxml.make_record(armoxml.GuildHeader, attrs,
+                armoxml.GUILD_HEADER_INTS)
+        self.name = header.name or self.name
+        self.realm = header.realm or self.realm
+        self.battle_group = header.battleGroup
+        self.faction = header.faction
 
-    def parse_members(self, node):
-        pass
+    def parse_members(self, attrs):
+        self.member_count = armoxml.to_int(attrs.get("memberCount"))
 
-    def parse_character(self, node):
-        pass
+    def parse_character(self, attrs):
+        record = armoxml.make_record(armoxml.RosterCharacter, attrs,
+                armoxml.ROSTER_CHARACTER_INTS)
+        self._members.append(Character.from_roster(record, self.realm, self.base_url))
 
 
 class Stats(object):
-    def __init__(self):
-        e_character = {
-            "battleGroup": "Reckoning / Abrechnung",
-            "charUrl": "r=Trollbane&amp;cn=Aabacus",
-            "class": "Warrior",
-            "classId": "1",
-            "classUrl": "c=Warrior",
-            "faction": "Alliance",
-            "factionId": "0",
-            "gender": "Female",
-            "genderId": "1",
-            "guildName": "Emerge",
-            "guildUrl": "r=Trollbane&amp;gn=Emerge",
-            "lastModified": "May 15, 2010",
-            "level": "80",
-            "name": "Aabacus",
-            "points": "3080",
-            "prefix": "",
-            "race": "Night Elf",
-            "raceId": "4",
-            "realm": "Trollbane",
-            "suffix": " the Patient",
-            "titleId": "137"
-            }
-        e_active_talentSpecs = 1
-        e_talentSpecs_1 = [14, 3, 54]
-            #"active"="1" 
-            #"icon"="inv_shield_06" "prim"="Protection" "treeOne"="14" "treeThree"="54" "treeTwo"="3"}
-        e_talentSpecs_2 = [19, 52, 0]
-            #"icon"="ability_warrior_innerrage" "prim"="Fury" "treeOne"="19" "treeThree"="0" "treeTwo"="52"}
-        e_professions = {
-                "0": {"id": "164", "key": "blacksmithing", "max": "450", "name": "Blacksmithing", "value": "450"},
-                "1": {"id": "755", "key": "jewelcrafting", "max": "450", "name": "Jewelcrafting", "value": "450"}
-            }
-        """
+    """The numeric stats of a character sheet, kept in one array of doubles.
+
+    Values are looked up by 'section/element/attribute' (see
+    armoxml.STAT_KEYS), eg stats["baseStats/stamina/effective"]. Missing
+    values are 0.0 and -1 means "not applicable", as on the armory.
+
+    Example of a character sheet:
+
+        <character battleGroup="Reckoning / Abrechnung"
+            charUrl="r=Trollbane&amp;cn=Aabacus" class="Warrior" classId="1"
+            classUrl="c=Warrior" faction="Alliance" factionId="0"
+            gender="Female" genderId="1" guildName="Emerge"
+            guildUrl="r=Trollbane&amp;gn=Emerge" lastModified="May 15, 2010"
+            level="80" name="Aabacus" points="3080" prefix="" race="Night Elf"
+            raceId="4" realm="Trollbane" suffix=" the Patient" titleId="137"/>
+        <talentSpecs>
+            <talentSpec active="1" group="1" icon="inv_shield_06"
+                prim="Protection" treeOne="14" treeThree="54" treeTwo="3"/>
+            <talentSpec group="2" icon="ability_warrior_innerrage" prim="Fury"
+                treeOne="19" treeThree="0" treeTwo="52"/>
+        </talentSpecs>
+        <professions>
+            <skill id="164" key="blacksmithing" max="450" name="Blacksmithing" value="450"/>
+            <skill id="755" key="jewelcrafting" max="450" name="Jewelcrafting" value="450"/>
+        </professions>
 			<characterBars>
 				<health effective="44226"/>
 				<secondBar casting="-1" effective="100" notCasting="-1" perFive="-1" type="r"/>
@@ -206,106 +353,430 @@ class Stats(object):
 				<glyph effect="Increases the range of your Charge ability by 5 yards." icon="ui-glyph-rune-5" id="485" name="Glyph of Charge" type="minor"/>
 				<glyph effect="Increases the chance for your Taunt ability to succeed by 8%." icon="ui-glyph-rune-15" id="506" name="Glyph of Taunt" type="major"/>
 			</glyphs>
-            """
+    """
+
+    __slots__ = ("values",)
+
+    def __init__(self, values=None):
+        if values is None:
+            values = armoxml.new_stats()
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[armoxml.STAT_INDEX[key]]
+
+    def get(self, key, default=None):
+        i = armoxml.STAT_INDEX.get(key)
+        if i is None:
+            return default
+        return self.values[i]
+
+    def items(self):
+        return zip(armoxml.STAT_KEYS, self.values)
+
 
 class Character(object):
+    """A character, read from a character-sheet.xml or a guild roster.
+
+    Numeric attributes are ints, stats is a Stats and items a list of Item.
+
+    The heavier parts of the sheet, stats, items, talent_specs, professions
+    and glyphs, are only read when first used: a character from a roster
+    (from_roster) or made from a name fetches its character sheet then, a
+    character made from a dom walks it then (only the <character> element
+    is read up front). Once read they are kept, so filtering on name,
+    level, class or rank never costs a character sheet.
+    """
+
+    __slots__ = ("base_url", "realm", "name", "battle_group", "guild_name",
+            "level", "class_id", "race_id", "gender_id", "faction_id",
+            "class_name", "race", "gender", "faction", "ach_points",
+            "title_id", "prefix", "suffix", "last_modified", "rank",
+            "_stats", "_items", "_talent_specs", "_professions", "_glyphs",
+            "_dom")
 
     def __init__(self, character_name="", realm='', base_url=BASE_URLs[SERVER_AREA], dom=None):
-        self.dom = dom
         self.base_url = base_url
         self.realm = realm
         self.name = character_name
-        if self.dom:
-            self.parse_dom(self.dom)
+        self.battle_group = self.guild_name = u''
+        self.class_name = self.race = self.gender = self.faction = u''
+        self.prefix = self.suffix = self.last_modified = u''
+        self.level = self.class_id = self.race_id = self.gender_id = 0
+        self.faction_id = self.ach_points = self.title_id = 0
+        self.rank = None
+        self._stats = self._items = self._talent_specs = None
+        self._professions = self._glyphs = None
+        self._dom = dom
+        if dom:
+            elems = dom.getElementsByTagName("character")
+            if elems:
+                self.load_info(armoxml.make_record(armoxml.CharacterInfo,
+                    dict(elems[0].attributes.items()),
+                    armoxml.CHARACTER_INFO_INTS))
+
+    @classmethod
+    def from_roster(cls, record, realm, base_url=BASE_URLs[SERVER_AREA]):
+        """Character from an armoxml.RosterCharacter."""
+        char = cls(record.name, realm, base_url)
+        char.level = record.level
+        char.class_id = record.classId
+        char.race_id = record.raceId
+        char.gender_id = record.genderId
+        char.ach_points = record.achPoints
+        char.rank = record.rank
+        return char
+
+    def _load_sheet(self):
+        """Read the character sheet, from the dom given or the armory."""
+        if self._dom is not None:
+            self.parse_dom(self._dom)
+        elif self.name:
+            self.parse_reader(open_url(get_charactersheet_url(self.name,
+                self.realm, self.base_url)))
+            record_char(self)
+        else:
+            self._stats = Stats()
+            self._items = []
+            self._talent_specs = []
+            self._professions = []
+            self._glyphs = []
+
+    stats = lazy_property("stats", _load_sheet)
+    items = lazy_property("items", _load_sheet)
+    talent_specs = lazy_property("talent_specs", _load_sheet)
+    professions = lazy_property("professions", _load_sheet)
+    glyphs = lazy_property("glyphs", _load_sheet)
+
+    def is_loaded(self):
+        """True once the heavier parts of the sheet have been read."""
+        return self._stats is not None
 
     def parse_dom(self, dom):
-        """TODO"""
-        pass
-
-    def get_gearscore(self):
-        """Oh yeah!
-
-        TODO!
-
-        http://www.wowwiki.com/Gear_score"""
-        stat_weights = {
-            "Strength": 1.00,
-            "Agility": 1.00,
-            "Stamina": 2.00,
-            "Intellect": 1.00,
-            "Spirit": 1.00,
-            "Arcane Resist": 1.00,
-            "Fire Resist": 1.00,
-            "Nature Resist": 1.00,
-            "Frost Resist": 1.00,
-            "Shadow Resist": 1.00,
-            "Defense": 1.00,
-            "Expertise": 1.00,
-            "Block": 1.00,
-            "Block Value": 0.65,
-            "Dodge": 1.00,
-            "Parry": 1.00,
-            "Resilience": 1.00,
-            "Armor Pen": 1.00,
-            "Attack Power": 0.50,
-            "Crit Rating": 1.00,
-            "Ranged Crit": 1.00,
-            "To Hit": 1.00,
-            "Ranged To Hit": 1.00,
-            "Haste": 1.00,
-            "Damage Undead": 0.55,
-            "Arcane Damage": 0.70,
-            "Fire Damage": 0.70,
-            "Frost Damage": 0.70,
-            "Holy Damage": 0.70,
-            "Nature Damage": 0.70,
-            "Shadow Damage": 0.70,
-            "Spell Penetration": 0.80,
-            "Spell Power": 0.86,
-            "Health Regen": 2.50,
-            "Mana Regen": 2.50 
-        }
-        return 0
+        """Read a character-sheet.xml minidom document."""
+        start = time.time()
+        self.load(armoxml.walk_dom(dom, armoxml.CharacterSheetHandler()))
+        emit_model(start)
+
+    def parse_reader(self, reader):
+        """Read a character-sheet.xml while it is read from reader."""
+        sheet = armoxml.parse(reader, armoxml.CharacterSheetHandler())
+        start = time.time()
+        self.load(sheet)
+        emit_model(start, armotrace.get_url(reader))
+
+    def load(self, sheet):
+        """Fill in from an armoxml.CharacterSheetHandler (or
+        CharacterSheet)."""
+        if sheet.info is not None:
+            self.load_info(sheet.info)
+        self._dom = None
+        self.stats = Stats(sheet.stats)
+        self.items = [Item.from_equipped(record) for record in sheet.items]
+        self.talent_specs = sheet.talent_specs
+        self.professions = sheet.professions
+        self.glyphs = sheet.glyphs
+
+    def load_info(self, info):
+        """Fill in from an armoxml.CharacterInfo."""
+        self.name = info.name or self.name
+        self.realm = info.realm or self.realm
+        self.battle_group = info.battleGroup
+        self.guild_name = info.guildName
+        self.level = info.level
+        self.class_id = info.classId
+        self.race_id = info.raceId
+        self.gender_id = info.genderId
+        self.faction_id = info.factionId
+        self.class_name = info.className
+        self.race = info.race
+        self.gender = info.gender
+        self.faction = info.faction
+        self.ach_points = info.points
+        self.title_id = info.titleId
+        self.prefix = info.prefix
+        self.suffix = info.suffix
+        self.last_modified = info.lastModified
+
+    def get_item_ids(self):
+        """[(slot, item id), ...] for all items, gems and enchants worn."""
+        ids = []
+        for item in self.items:
+            for id in (item.id, item.enchant_id) + tuple(item.gems):
+                if id:
+                    ids.append((item.slot, id))
+        return ids
+
+    def get_active_spec(self):
+        for spec in self.talent_specs:
+            if spec.active:
+                return spec
+        return None
+
+    def get_gearscore(self, item_stats=None):
+        """Return the gear score, see armogear.
+
+        item_stats -- {item id: stat vector}, fetched if not given. To score
+            many characters use armogear.score_characters instead."""
+        import armogear
+        if item_stats is None:
+            ids = [id for slot, id in self.get_item_ids()]
+            item_stats = armogear.load_item_stats(ids, self.base_url)
+        return armogear.score_characters([self], item_stats).scores[0]
 
 
 class Item(object):
-    """TODO"""
+    """An item, either equipped (from a character sheet <item> element) or
+    read from an item-info.xml.
+
+    gems is a tuple of the gem item ids (0 for empty sockets).
+    """
+
+    __slots__ = ("id", "name", "level", "slot", "rarity", "gems",
+            "enchant_id", "random_properties_id", "durability",
+            "max_durability", "type", "icon")
 
     def __init__(self, id=None, dom=None, dom_tooltip=None):
         self.id = id
-        self.dom = dom
-        self.dom_tooltip = dom_tooltip
+        self.name = u''
+        self.level = self.rarity = 0
+        self.slot = None
+        self.gems = ()
+        self.enchant_id = self.random_properties_id = 0
+        self.durability = self.max_durability = 0
+        self.type = self.icon = u''
+        if dom:
+            self.parse_dom(dom)
+
+    @classmethod
+    def from_equipped(cls, record):
+        """Item from an armoxml.EquippedItem."""
+        item = cls(record.id)
+        item.name = record.name
+        item.level = record.level
+        item.slot = record.slot
+        item.rarity = record.rarity
+        item.gems = (record.gem0Id, record.gem1Id, record.gem2Id)
+        item.enchant_id = record.permanentEnchantItemId
+        item.random_properties_id = record.randomPropertiesId
+        item.durability = record.durability
+        item.max_durability = record.maxDurability
+        return item
 
     def init_from_char_item_element(self, elem):
         # example of an element:
 		#<item displayInfoId="64570" durability="100" gem0Id="41380" gem1Id="40141" gem2Id="0" gemIcon0="inv_jewelcrafting_shadowspirit_02" gemIcon1="inv_jewelcrafting_gem_40" icon="inv_helmet_158" id="51218" level="264" maxDurability="100" name="Sanctified Ymirjar Lord's Greathelm" permanentEnchantIcon="ability_warrior_swordandboard" permanentEnchantItemId="44150" permanentenchant="3818" pickUp="PickUpLargeChain" putDown="PutDownLArgeChain" randomPropertiesId="0" rarity="4" seed="0" slot="0"/>
-        pass
+        record = armoxml.make_record(armoxml.EquippedItem,
+                dict(elem.attributes.items()), armoxml.EQUIPPED_ITEM_INTS)
+        other = Item.from_equipped(record)
+        for attr in Item.__slots__:
+            setattr(self, attr, getattr(other, attr))
+        self.icon = elem.getAttribute("icon")
+
+    def parse_dom(self, dom):
+        """Read an item-info.xml minidom document."""
+        start = time.time()
+        self.load(armoxml.walk_dom(dom, armoxml.ItemInfoHandler()))
+        emit_model(start)
 
+    def parse_reader(self, reader):
+        handler = armoxml.parse(reader, armoxml.ItemInfoHandler())
+        start = time.time()
+        self.load(handler)
+        emit_model(start, armotrace.get_url(reader))
+
+    def load(self, handler):
+        info = handler.info
+        if info is None:
+            return
+        self.id = info.id
+        self.name = info.name
+        self.level = info.level
+        self.rarity = info.quality
+        self.type = info.type
+        self.icon = info.icon
 
 
 def get_dom(reader):
     xml_str = reader.read()
+    start = time.time()
     dom = xdm.parseString(xml_str)
+    if armotrace.hooks:
+        armotrace.emit("parse", armotrace.get_url(reader), time.time() - start,
+                len(xml_str))
     return dom
 
+def write_atomically(filename, write, encoding=None):
+    """Call write(outfile) with a temporary file in the same directory as
+    filename, and rename it to filename once written. If anything goes wrong
+    the temporary file is removed and filename is left untouched."""
+    if isinstance(filename, unicode):
+        filename = filename.encode(FILE_ENCODING)
+    dir, name = os.path.split(filename)
+    start = time.time()
+    fd, tmp_path = tempfile.mkstemp(dir=dir or '.', prefix='.' + name + '.')
+    try:
+        outfile = os.fdopen(fd, 'wb')
+        if encoding:
+            outfile = codecs.getwriter(encoding)(outfile)
+        try:
+            write(outfile)
+        finally:
+            outfile.close()
+        os.chmod(tmp_path, 0666 & ~_umask)
+        os.rename(tmp_path, filename)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if armotrace.hooks:
+        armotrace.emit("write", filename, time.time() - start,
+                os.path.getsize(filename))
+
 def write_str_to_file(str, filename):
-    outfile = codecs.open(filename.encode(FILE_ENCODING), 'w')
-    outfile.write(str)
-    outfile.close()
+    write_atomically(filename, lambda outfile: outfile.write(str))
 
 def do_write_to_file(data, filename):
-    outfile = codecs.open(filename.encode(FILE_ENCODING), 'w')
-    outfile.write(data.read())
-    outfile.close()
+    """Copy what is read from data to filename, a chunk at a time."""
+    def write(outfile):
+        chunk = data.read(CHUNK_SIZE)
+        while chunk:
+            outfile.write(chunk)
+            chunk = data.read(CHUNK_SIZE)
+    write_atomically(filename, write)
+
+def get_session():
+    """The armonet.Session all requests go through, made on first use."""
+    global _session
+    if _session is None:
+        _state_lock.acquire()
+        try:
+            if _session is None:
+                _session = armonet.Session({'user-agent': USER_AGENT},
+                        limiter=armonet.RateLimiter(armonet.RATE))
+        finally:
+            _state_lock.release()
+    return _session
+
+def set_cache(cache):
+    """Use cache (an armocache.Cache) for open_url, None turns caching off."""
+    global _cache, _use_cache
+    _cache = cache
+    _use_cache = cache is not None
+
+def get_cache():
+    """The cache in use, by default an armocache.Cache in ./cache made on
+    first use. None if caching is off."""
+    global _cache
+    if _cache is None and _use_cache:
+        _state_lock.acquire()
+        try:
+            if _cache is None and _use_cache:
+                _cache = armocache.Cache()
+        finally:
+            _state_lock.release()
+    return _cache
+
+def set_item_db(item_db):
+    """Answer item urls from item_db (an armoitems.ItemDB), None turns it
+    off."""
+    global _item_db
+    if item_db is not None and item_db.fetch is None:
+        item_db.fetch = fetch_url
+    _item_db = item_db
+
+def get_item_db():
+    return _item_db
+
+def set_archive(archive):
+    """Write snapshots to archive (an armoarchive.Archive) instead of loose
+    files, None turns it off."""
+    global _archive
+    _archive = archive
+
+def get_archive():
+    return _archive
+
+def set_history(history):
+    """Record every Character read from a sheet in history (an
+    armohistory.History), None turns it off."""
+    global _history
+    _history = history
+
+def get_history():
+    return _history
+
+def set_index(index):
+    """Add every Character read from a sheet to index (an armoindex.Index),
+    None turns it off."""
+    global _index
+    _index = index
+
+def get_index():
+    return _index
+
+def set_exporter(exporter):
+    """Export every Guild, Character and Item read to exporter (an
+    armoexport.Exporter), None turns it off."""
+    global _exporter
+    _exporter = exporter
 
-def open_url(url):
-    opener = urllib2.build_opener()
-    opener.addheaders = [('user-agent', USER_AGENT)]
-    req = urllib2.Request(url)
-    return opener.open(req)
+def get_exporter():
+    return _exporter
+
+def record_char(char):
+    """Add a Character just read from its sheet to the history, the index
+    and the export, if set."""
+    if _history is not None:
+        _history.record(char)
+    if _index is not None:
+        _index.add(char)
+    if _exporter is not None:
+        _exporter.add_char(char)
+
+def set_parse_pool(parse_pool):
+    """Parse the character sheets of get_chars on parse_pool (an
+    armoparse.ParsePool), None parses them in the fetching threads."""
+    global _parse_pool
+    _parse_pool = parse_pool
+
+def get_parse_pool():
+    return _parse_pool
+
+def at_exit(func, *args):
+    """Run func(*args) when the run is over: at exit, or when run by armod
+    at the end of the request."""
+    if _exit_funcs is None:
+        atexit.register(func, *args)
+    else:
+        _exit_funcs.append((func, args))
+
+def fetch_url(url, max_age=None):
+    """Like open_url, but never answered from the item database."""
+    cache = get_cache()
+    if cache is not None:
+        return cache.open(url, get_session(), max_age)
+    return get_session().open(url)
+
+def open_url(url, max_age=None):
+    """Return a file like object reading url.
+
+    Item urls are answered from the item database if one is set. Other
+    responses come from the cache if it has a fresh enough copy. Connections
+    are kept alive and reused between calls and the response is
+    transparently decompressed if sent gzip/deflate encoded.
+
+    max_age -- max age in seconds of a cached response, 0 makes sure the
+        response is up to date (a conditional request if cached)."""
+    if _item_db is not None and _item_db.handles(url):
+        return _item_db.open_url(url)
+    return fetch_url(url, max_age)
 
 def dump_url_to_file(url, filename, verbose, force):
-    #TODO: check if file exists and only overwrite if 'force' is set
+    if not force and os.path.exists(filename):
+        if verbose:
+            print "'%s' exists, skipping (use -f to overwrite)" % filename
+        return
     if verbose:
         print "opening url '%s'..." % url,
     try:
@@ -323,28 +794,47 @@ def dump_url_to_file(url, filename, verbose, force):
 
 
 def write_dom_to_xmlfile(dom, filename, dir="", pretty=False):
-    try:
-        path = dir + filename
-        outfile = codecs.open(path.encode(FILE_ENCODING), 'w', FILE_ENCODING)
+    """Write dom to dir + filename, serialised straight into the file."""
+    def write(outfile):
         if pretty:
-            outfile.write(dom.toprettyxml())
+            dom.writexml(outfile, "", "\t", "\n", encoding=FILE_ENCODING)
         else:
-            outfile.write(dom.toxml())
-    finally:
-        outfile.close()
+            dom.writexml(outfile, encoding=FILE_ENCODING)
+    write_atomically(dir + filename, write, FILE_ENCODING)
 
 def write_iteminfo(dom, item_id):
+    if _exporter is not None:
+        _exporter.add_item(Item(item_id, dom=dom))
+    if _archive is not None:
+        _archive.put("item", '', item_id, dom.toxml(FILE_ENCODING))
+        return
     filename = item_id + '.xml'
     write_dom_to_xmlfile(dom, filename, "items/")
 
-def write_charactersheet(dom, character):
+def write_charactersheet(dom, character, realm=''):
+    if _exporter is not None:
+        _exporter.add_char(Character(character, realm, dom=dom))
+    if _archive is not None:
+        _archive.put("char", realm, character, dom.toxml(FILE_ENCODING))
+        return
     filename = character + '.xml'
     write_dom_to_xmlfile(dom, filename, "chars/")
 
 def write_guildinfo(dom, realm, guild):
+    if _exporter is not None:
+        _exporter.add_roster(Guild(guild, realm, dom=dom))
+    if _archive is not None:
+        _archive.put("guild", realm, guild, dom.toxml(FILE_ENCODING))
+        return
     filename = realm + ' - ' + guild + '.xml'
-    write_dom_to_xmlfile(dom, filename, "guild/")
+    write_dom_to_xmlfile(dom, filename, "guilds/")
+
 
+def quote_query(value):
+    """value (unicode or utf-8) encoded for the query string of a url."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return urllib.quote_plus(value)
 
 def get_iteminfo_url(item_id, base_url):
     item_url = '%s%s?i=%s' % (
@@ -364,44 +854,90 @@ def get_charactersheet_url(character, realm, base_url):
     character_url = '%s%s?r=%s&n=%s' % (
         base_url,
         'character-sheet.xml',
-        realm.replace(' ', '+'),
-        character.replace(' ', '+'))
+        quote_query(realm),
+        quote_query(character))
     return character_url
 
 def get_guildinfo_url(guild, realm, base_url):
     guild_url = '%s%s?r=%s&n=%s' % (
         base_url,
         "guild-info.xml",
-        realm.replace(' ', '+'),
-        guild.replace(' ', '+'))
+        quote_query(realm),
+        quote_query(guild))
     return guild_url
 
 
-def do_dump(url, filename, verbose, force, write):
-    if write:
-        filename = "items/" + id + '.xml'
+def dump_url_to_archive(url, key, verbose):
+    """Add what is read from url to the archive as a snapshot of key,
+    (kind, realm, name)."""
+    if verbose:
+        print "archiving '%s' as %s..." % (url, "/".join(key)),
+    data = open_url(url).read()
+    kind, realm, name = key
+    _archive.put(kind, realm, name, data)
+    if verbose:
+        print "done!"
+
+def do_dump(url, filename, verbose, force, write, pool=None, key=None):
+    """Dump url to filename (or stdout if not 'write').
+
+    If an archive is set (see set_archive) and 'key' (kind, realm, name) is
+    given, the dump is added to the archive instead of written to filename.
+    If a pool (armonet.FetchPool) is given the dump is queued on it and this
+    returns at once, errors then end up in the pool's failures.
+    """
+    if pool is not None:
+        pool.add(url, do_dump, url, filename, verbose, force, write, None, key)
+    elif write and _archive is not None and key is not None:
+        dump_url_to_archive(url, key, verbose)
+    elif write:
         dump_url_to_file(url, filename, verbose, force)
     else:
-        data = open_url(url)
-        sys.stdout.write(data.read())
+        data = open_url(url).read()
+        _stdout_lock.acquire()
+        try:
+            sys.stdout.write(data)
+        finally:
+            _stdout_lock.release()
 
-def dump_item(id, base_url, verbose, force, write):
+def dump_item(id, base_url, verbose, force, write, pool=None):
     url = get_iteminfo_url(id, base_url)
+    if _exporter is not None:
+        # read the item for the export first, the dump is then answered
+        # from the cache
+        if pool is not None:
+            pool.add(url, dump_item, id, base_url, verbose, force, write)
+            return
+        get_item(id, base_url)
     filename = "items/" + id + '.xml'
-    do_dump(url, filename, verbose, force, write)
+    do_dump(url, filename, verbose, force, write, pool, ("item", '', id))
     url2 = get_itemtooltip_url(id, base_url)
     filename2 = "items/" + id + '-tooltip.xml'
-    do_dump(url2, filename2, verbose, force, write)
+    do_dump(url2, filename2, verbose, force, write, pool, ("tooltip", '', id))
 
-def dump_char(charname, realm, base_url, verbose, force, write):
+def dump_char(charname, realm, base_url, verbose, force, write, pool=None):
     url = get_charactersheet_url(charname, realm, base_url)
+    if _history is not None or _index is not None or _exporter is not None:
+        # read the sheet for the history, index and export first, the dump
+        # is then answered from the cache
+        if pool is not None:
+            pool.add(url, dump_char, charname, realm, base_url, verbose, force, write)
+            return
+        get_char(charname, realm, base_url)
     filename = "chars/" + charname + '.xml'
-    do_dump(url, filename, verbose, force, write)
+    do_dump(url, filename, verbose, force, write, pool, ("char", realm, charname))
 
-def dump_guild(realm, guild, base_url, verbose, force, write):
+def dump_guild(realm, guild, base_url, verbose, force, write, pool=None):
     url = get_guildinfo_url(guild, realm, base_url)
+    if _exporter is not None:
+        # read the roster for the export first, the dump is then answered
+        # from the cache
+        if pool is not None:
+            pool.add(url, dump_guild, realm, guild, base_url, verbose, force, write)
+            return
+        get_guild(realm, guild, base_url)
     filename = "guilds/" + realm + ' - ' + guild + '.xml'
-    do_dump(url, filename, verbose, force, write)
+    do_dump(url, filename, verbose, force, write, pool, ("guild", realm, guild))
 
 
 def get_itemtooltip_dom(id, base_url):
@@ -417,13 +953,124 @@ def get_item_dom(id, base_url):
 def get_char_dom(charname, realm, base_url):
     url = get_charactersheet_url(charname, realm, base_url)
     reader = open_url(url)
-    return get_dom(reader)
+    dom = get_dom(reader)
+    if _index is not None:
+        char = Character(charname, realm, base_url, dom=dom)
+        _index.add(char)
+    return dom
 
 def get_guild_dom(realm, guild, base_url):
     url = get_guildinfo_url(guild, realm, base_url)
     reader = open_url(url)
     return get_dom(reader)
 
+def iter_guild_roster(realm, guild, base_url):
+    """Yield an armoxml.RosterCharacter per guild member, parsed while read."""
+    url = get_guildinfo_url(guild, realm, base_url)
+    return armoxml.iter_roster(open_url(url))
+
+def iter_char_sheet(charname, realm, base_url):
+    """Yield the armoxml.CharacterInfo and EquippedItem records of a
+    character sheet, parsed while read."""
+    url = get_charactersheet_url(charname, realm, base_url)
+    return armoxml.iter_character_sheet(open_url(url))
+
+def get_item(id, base_url):
+    """Return an Item read from item-info.xml."""
+    item = Item(id)
+    item.parse_reader(open_url(get_iteminfo_url(id, base_url)))
+    if _exporter is not None:
+        _exporter.add_item(item)
+    return item
+
+def get_char(charname, realm, base_url):
+    """Return a Character read from its character sheet."""
+    char = Character(charname, realm, base_url)
+    char.parse_reader(open_url(get_charactersheet_url(charname, realm, base_url)))
+    record_char(char)
+    return char
+
+def get_chars(names, realm, base_url, pool=None):
+    """[Character, ...] read from their character sheets, in 'names' order.
+
+    pool -- an armonet.FetchPool to fetch the sheets with, if given. If a
+        parse pool is set (see set_parse_pool) the sheets are parsed on it
+        while fetched.
+
+    Characters that fail to load are left out."""
+    chars = {}
+    if pool is not None and _parse_pool is not None:
+        import armoparse
+        jobs = [(name, get_charactersheet_url(name, realm, base_url), "char")
+                for name in names]
+        for name, sheet, error in armoparse.fetch_and_parse(jobs, pool, _parse_pool):
+            if error is not None:
+                pool.failures.append((get_charactersheet_url(name, realm,
+                    base_url), ValueError(error)))
+                continue
+            char = Character(name, realm, base_url)
+            char.load(sheet)
+            record_char(char)
+            chars[name] = char
+        return [chars[name] for name in names if name in chars]
+    def load(name):
+        chars[name] = get_char(name, realm, base_url)
+    for name in names:
+        if pool is None:
+            try:
+                load(name)
+            except Exception:
+                pass
+        else:
+            pool.add(get_charactersheet_url(name, realm, base_url), load, name)
+    if pool is not None:
+        pool.join()
+    return [chars[name] for name in names if name in chars]
+
+def resolve_items(chars, base_url, pool=None):
+    """Read the item-info.xml of every item, gem and enchant worn by any of
+    the Characters, return {id: Item}.
+
+    Each distinct id is read once, however many characters wear it, and
+    through the item database if one is set (see set_item_db), so a known
+    item costs no request at all. The characters' equipped Items get their
+    type and icon filled in. Items that fail to load are left out."""
+    ids = set()
+    for char in chars:
+        ids.update([id for slot, id in char.get_item_ids()])
+    if _item_db is not None:
+        items = _item_db.resolve(ids, base_url, pool)
+    else:
+        items = {}
+        def load(id):
+            items[id] = get_item(id, base_url)
+        for id in ids:
+            if pool is None:
+                try:
+                    load(id)
+                except Exception:
+                    pass
+            else:
+                pool.add(get_iteminfo_url(id, base_url), load, id)
+        if pool is not None:
+            pool.join()
+    for char in chars:
+        for equipped in char.items:
+            info = items.get(equipped.id)
+            if info is not None:
+                equipped.type = info.type
+                equipped.icon = equipped.icon or info.icon
+                equipped.name = equipped.name or info.name
+    return items
+
+def get_guild(realm, guild, base_url):
+    """Return a Guild, with its members, read from guild-info.xml."""
+    g = Guild(guild, realm, base_url)
+    g.parse_reader(open_url(get_guildinfo_url(guild, realm, base_url)))
+    if _exporter is not None:
+        _exporter.add_roster(g)
+    return g
+
 
 def usage():
     print __doc__
@@ -440,9 +1087,24 @@ def _main(argv):
     flags.guild = 'Emerge'
     flags.chars = []
     flags.items = []
+    flags.jobs = armonet.MAX_JOBS
+    flags.offline = False
+    flags.cache = True
+    flags.gearscore = False
+    flags.itemdb = None
+    flags.sync = False
+    flags.archive = False
+    flags.history = False
+    flags.index = False
+    flags.export = False
+    flags.stats = False
+    flags.parse_jobs = 0
+    flags.profile = False
     try:
-        opts, args = getopt.getopt(argv, "hvwfr:g:c:i:", ["help", "verbose",
-            "force", "realm", "guild", "char=", "itemid=", "eu", "us", ])
+        opts, args = getopt.getopt(argv, "hvwfr:g:c:i:j:", ["help", "verbose",
+            "force", "realm", "guild", "char=", "itemid=", "eu", "us",
+            "jobs=", "rate=", "no-online", "no-cache", "gs", "gearscore",
+            "itemdb=", "sync", "archive", "history", "index", "export", "stats", "profile", "parse-jobs=", ])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -469,27 +1131,127 @@ def _main(argv):
             flags.chars.append(arg)
         elif opt in ('-i', '--itemid'):
             flags.items.append(arg)
+        elif opt in ('-j', '--jobs'):
+            flags.jobs = int(arg)
+        elif opt == '--rate':
+            get_session().limiter = armonet.RateLimiter(float(arg))
+        elif opt == '--no-online':
+            flags.offline = True
+        elif opt == '--no-cache':
+            flags.cache = False
+        elif opt in ('--gs', '--gearscore'):
+            flags.gearscore = True
+        elif opt == '--itemdb':
+            flags.itemdb = arg
+        elif opt == '--sync':
+            flags.sync = True
+        elif opt == '--archive':
+            flags.archive = True
+        elif opt == '--history':
+            flags.history = True
+        elif opt == '--index':
+            flags.index = True
+        elif opt == '--export':
+            flags.export = True
+        elif opt == '--stats':
+            flags.stats = True
+        elif opt == '--profile':
+            flags.profile = True
+        elif opt == '--parse-jobs':
+            flags.parse_jobs = int(arg)
 
     flags.base_url = BASE_URLs[flags.server_area]
+    if flags.stats:
+        stats = armotrace.Stats()
+        armotrace.add_hook(stats)
+        at_exit(stats.print_summary)
+    if flags.profile:
+        armotrace.start_profile()
+        at_exit(armotrace.stop_profile, PROFILE_FILE)
+    if not flags.cache:
+        if flags.offline:
+            print >> sys.stderr, "--no-online needs the cache"
+            sys.exit(2)
+        set_cache(None)
+    elif flags.offline:
+        get_cache().offline = True
+    if flags.itemdb:
+        import armoitems
+        set_item_db(armoitems.ItemDB(flags.itemdb))
+    if flags.archive:
+        import armoarchive
+        set_archive(armoarchive.Archive())
+    if flags.history:
+        import armohistory
+        set_history(armohistory.History())
+    if flags.index:
+        import armoindex
+        set_index(armoindex.Index())
+    if flags.export:
+        import armoexport
+        exporter = armoexport.Exporter()
+        set_exporter(exporter)
+        at_exit(exporter.close)
+    if flags.parse_jobs:
+        import armoparse
+        parse_pool = armoparse.ParsePool(flags.parse_jobs)
+        set_parse_pool(parse_pool)
+        at_exit(parse_pool.close)
+    pool = armonet.FetchPool(flags.jobs, verbose=flag_verbose)
+
+    if flags.sync:
+        import armosync
+        changes = armosync.sync_guild(flags.realm, flags.guild, flags.base_url,
+                pool, write=flag_write, verbose=flag_verbose)
+        for change, name, details in changes:
+            print ("%-7s %s %s" % (change, name, details)).encode(FILE_ENCODING)
+        for url, e in pool.failures:
+            print >> sys.stderr, "failed: '%s' (%s)" % (url, e)
+        return
+
+    if flags.gearscore:
+        import armogear
+        if flags.cache:
+            stats_db = armogear.ItemStatsDB()
+            armogear.set_stats_db(stats_db)
+            at_exit(stats_db.close)
+        names = flags.chars
+        if not names:
+            guild = get_guild(flags.realm, flags.guild, flags.base_url)
+            names = [member.name for member in guild.members]
+        result = armogear.score_guild_chars(names, flags.realm, flags.base_url, pool)
+        armogear.print_gearscores(result, flag_verbose)
+        for url, e in pool.failures:
+            print >> sys.stderr, "failed: '%s' (%s)" % (url, e)
+        return
 
     # guild
     if not (flags.chars or flags.items):
         if flag_verbose:
             print "realm: '%s', guild: '%s'" % (flags.realm, flags.guild)
-        dump_guild(flags.realm, flags.guild, flags.base_url, flag_verbose, flag_force, flag_write)
+        dump_guild(flags.realm, flags.guild, flags.base_url, flag_verbose, flag_force, flag_write, pool)
 
     # chars
     if flag_verbose:
         print "chars: '%s'" % (flags.chars or "<no chars!>")
     for char in flags.chars:
-        dump_char(char, flags.realm, flags.base_url, flag_verbose, flag_force, flag_write)
+        dump_char(char, flags.realm, flags.base_url, flag_verbose, flag_force, flag_write, pool)
 
     # items
     if flag_verbose:
         print "items: '%s'" % (flags.items or "<no items!>")
     for id in flags.items:
-        dump_item(id, flags.base_url, flag_verbose, flag_force, flag_write)
+        dump_item(id, flags.base_url, flag_verbose, flag_force, flag_write, pool)
+
+    failures = pool.join()
+    for url, e in failures:
+        print >> sys.stderr, "failed: '%s' (%s)" % (url, e)
+    if failures:
+        sys.exit(1)
 
 if __name__ == "__main__":
-    _main(sys.argv[1:])
+    # run main in the importable module, so modules importing armoread
+    # share its state (session, cache) with the command line
+    import armoread
+    armoread._main(sys.argv[1:])
 
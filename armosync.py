@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Incremental guild sync.
+
+Keeps a snapshot of a guild's roster and only refetches the character
+sheets of members that joined or whose roster entry changed since the last
+sync. A member's fingerprint is its level and achievement points, which
+change whenever the character is played in a way that shows on the sheet;
+rank changes are logged but don't need the sheet. Written with 'write' (-w
+on the command line):
+
+    guilds/<realm> - <guild>.json   the snapshot
+    guilds/<realm> - <guild>.log    one line per change, appended to
+    chars/<name>.xml                refetched character sheets
+
+Refetched sheets are also recorded in the history, the index and the
+export, if set (see armoread.record_char).
+
+A sync costs one (conditional) roster request plus one request per changed
+member, instead of one per member.
+"""
+
+import os
+import time
+import json
+import errno
+from cStringIO import StringIO
+
+import armoread
+import armoxml
+
+SNAPSHOT_DIR = "guilds/"
+CHARS_DIR = "chars/"
+FINGERPRINT = ("level", "achPoints")
+
+
+def get_snapshot_path(realm, guild, dir=SNAPSHOT_DIR):
+    return os.path.join(dir, realm + ' - ' + guild + '.json')
+
+def get_log_path(realm, guild, dir=SNAPSHOT_DIR):
+    return os.path.join(dir, realm + ' - ' + guild + '.log')
+
+def load_snapshot(path):
+    """Return the snapshot in path, or an empty one."""
+    try:
+        f = open(path, 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {"time": None, "members": {}}
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def save_snapshot(snapshot, path):
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        json.dump(snapshot, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+def get_member_entry(record):
+    """Snapshot entry of an armoxml.RosterCharacter."""
+    entry = dict(zip(record._fields, record))
+    del entry["name"]
+    return entry
+
+def get_fingerprint(entry):
+    return tuple([entry.get(field) for field in FINGERPRINT])
+
+
+def diff_roster(old_members, new_members):
+    """Compare two {name: entry} rosters.
+
+    Returns (changes, refetch) where changes is a list of (change, name,
+    details), change being "joined", "left", "changed" or "rank", and
+    refetch the names whose character sheets need fetching.
+    """
+    changes = []
+    refetch = []
+    for name in sorted(new_members):
+        new = new_members[name]
+        old = old_members.get(name)
+        if old is None:
+            changes.append(("joined", name, "level %s" % new["level"]))
+            refetch.append(name)
+            continue
+        if get_fingerprint(old) != get_fingerprint(new):
+            details = ", ".join(["%s %s -> %s" % (field, old.get(field), new[field])
+                for field in FINGERPRINT if old.get(field) != new[field]])
+            changes.append(("changed", name, details))
+            refetch.append(name)
+        if old.get("rank") != new["rank"]:
+            changes.append(("rank", name, "%s -> %s" % (old.get("rank"), new["rank"])))
+    for name in sorted(old_members):
+        if name not in new_members:
+            changes.append(("left", name, ""))
+    return changes, refetch
+
+
+def fetch_sheet(name, realm, base_url, entry, write, chars_dir=CHARS_DIR):
+    """Fetch an up to date character sheet, write it to chars_dir if
+    'write' and remember its lastModified in entry."""
+    url = armoread.get_charactersheet_url(name, realm, base_url)
+    data = armoread.open_url(url, max_age=0).read()
+    for record in armoxml.iter_character_sheet(StringIO(data)):
+        if isinstance(record, armoxml.CharacterInfo):
+            entry["lastModified"] = record.lastModified
+        break
+    char = armoread.Character(name, realm, base_url)
+    char.parse_reader(StringIO(data))
+    armoread.record_char(char)
+    if write:
+        armoread.write_str_to_file(data, os.path.join(chars_dir, name + '.xml'))
+
+
+def sync_guild(realm, guild, base_url, pool=None, write=True, verbose=False,
+        snapshot_dir=SNAPSHOT_DIR, chars_dir=CHARS_DIR):
+    """Sync a guild against its last snapshot, return the list of changes
+    (see diff_roster).
+
+    The snapshot is only updated for members whose sheet could be fetched,
+    the others will be fetched again by the next sync. Unless 'write', the
+    changes are only returned: the snapshot, the log and the sheets are
+    left as they were.
+    """
+    path = get_snapshot_path(realm, guild, snapshot_dir)
+    snapshot = load_snapshot(path)
+    old_members = snapshot["members"]
+    url = armoread.get_guildinfo_url(guild, realm, base_url)
+    new_members = {}
+    for record in armoxml.iter_roster(armoread.open_url(url, max_age=0)):
+        new_members[record.name] = get_member_entry(record)
+    changes, refetch = diff_roster(old_members, new_members)
+
+    # unchanged members keep what we knew from their sheets
+    for name, entry in new_members.iteritems():
+        if name in old_members and name not in refetch:
+            if "lastModified" in old_members[name]:
+                entry["lastModified"] = old_members[name]["lastModified"]
+
+    failed = set()
+    def fetch(name):
+        try:
+            fetch_sheet(name, realm, base_url, new_members[name], write, chars_dir)
+        except:
+            failed.add(name)
+            raise
+    for name in refetch:
+        if verbose:
+            print "fetching '%s'" % name
+        if pool is None:
+            try:
+                fetch(name)
+            except Exception, e:
+                print "failed: '%s' (%s)" % (name, e)
+        else:
+            pool.add(armoread.get_charactersheet_url(name, realm, base_url), fetch, name)
+    if pool is not None:
+        pool.join()
+    for name in failed:
+        # keep the old entry (or none) so the next sync retries it
+        if name in old_members:
+            new_members[name] = old_members[name]
+        else:
+            del new_members[name]
+
+    snapshot = {"realm": realm, "guild": guild, "time": time.time(),
+            "members": new_members}
+    if write:
+        save_snapshot(snapshot, path)
+        write_changelog(changes, get_log_path(realm, guild, snapshot_dir))
+    return changes
+
+def write_changelog(changes, path, now=None):
+    if not changes:
+        return
+    stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+    f = open(path, 'ab')
+    try:
+        for change, name, details in changes:
+            f.write(("%s %-7s %s %s\n" % (stamp, change, name, details)).encode('utf-8'))
+    finally:
+        f.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Timing hooks for the fetch/parse/write path.
+
+The armo modules report each stage of the work they do as an Event to the
+hooks added with add_hook:
+
+    connect     opening a new connection (DNS lookup included)
+    ttfb        sending a request until the response headers are in
+    transfer    reading the response body, bytes is the size on the wire
+    cache       a response cache lookup, cached is True (hit, or revalidated
+                with a 304) or False (miss)
+    parse       XML parsing (expat or minidom), the reads feeding the
+                parser are not included
+    model       building Character/Item objects from parsed documents
+    write       writing a file, url is the filename
+
+url is the url the event is about, or None where it isn't known. Hooks are
+called in the thread doing the work, and nothing is timed while there are
+no hooks.
+
+    stats = Stats()
+    add_hook(stats)
+    ...
+    stats.print_summary()
+
+start_profile/stop_profile run cProfile over the main thread and every
+thread started in between (the fetch workers), and tracemalloc where it
+exists (not in Python 2).
+"""
+
+import sys
+import time
+import threading
+from collections import namedtuple
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+STAGES = ("connect", "ttfb", "transfer", "cache", "parse", "model", "write")
+
+Event = namedtuple("Event", "stage url seconds bytes cached")
+
+hooks = []
+
+
+def add_hook(hook):
+    """Call hook(event) for every Event."""
+    hooks.append(hook)
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+def emit(stage, url, seconds, bytes=0, cached=None):
+    event = Event(stage, url, seconds, bytes, cached)
+    for hook in hooks:
+        hook(event)
+
+def get_url(reader):
+    """The url of a reader (an armonet.Response), if it has one."""
+    geturl = getattr(reader, "geturl", None)
+    return geturl and geturl() or None
+
+
+class Stats(object):
+    """Hook keeping count, time and bytes per stage, and the cache hits.
+
+    slowest -- number of slowest events kept per stage.
+    """
+
+    def __init__(self, slowest=3):
+        self.slowest = slowest
+        self.count = dict([(stage, 0) for stage in STAGES])
+        self.seconds = dict([(stage, 0.0) for stage in STAGES])
+        self.bytes = dict([(stage, 0) for stage in STAGES])
+        self.worst = dict([(stage, []) for stage in STAGES])
+        self.hits = self.misses = 0
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        self._lock.acquire()
+        try:
+            stage = event.stage
+            self.count[stage] = self.count.get(stage, 0) + 1
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + event.seconds
+            self.bytes[stage] = self.bytes.get(stage, 0) + event.bytes
+            if event.cached is True:
+                self.hits += 1
+            elif event.cached is False:
+                self.misses += 1
+            worst = self.worst.setdefault(stage, [])
+            worst.append((event.seconds, event.url))
+            worst.sort(reverse=True)
+            del worst[self.slowest:]
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        """Lines of text summing up the events so far."""
+        lines = ["%-9s %7s %10s %10s %12s" % ("stage", "count", "total s",
+            "avg ms", "bytes")]
+        for stage in STAGES:
+            count = self.count[stage]
+            if not count:
+                continue
+            lines.append("%-9s %7d %10.3f %10.2f %12d" % (stage, count,
+                self.seconds[stage], self.seconds[stage] / count * 1000,
+                self.bytes[stage]))
+        lines.append("cache: %d hits, %d misses" % (self.hits, self.misses))
+        lines.append("wall time: %.3f s" % (time.time() - self._start))
+        for stage in STAGES:
+            for seconds, url in self.worst[stage]:
+                if url:
+                    lines.append("slowest %-9s %8.2f ms  %s" % (stage,
+                        seconds * 1000, url))
+        return lines
+
+    def print_summary(self, out=None):
+        out = out or sys.stderr
+        for line in self.summary():
+            print >> out, line
+
+
+_profiles = []
+_profiles_lock = threading.Lock()
+
+def _profile_thread(frame, event, arg):
+    """threading.setprofile hook: start a profiler in each new thread."""
+    import cProfile
+    sys.setprofile(None)
+    profile = cProfile.Profile()
+    _profiles_lock.acquire()
+    _profiles.append(profile)
+    _profiles_lock.release()
+    profile.enable()
+
+def start_profile():
+    """Profile this thread and all threads started from now on."""
+    import cProfile
+    profile = cProfile.Profile()
+    _profiles.append(profile)
+    threading.setprofile(_profile_thread)
+    if tracemalloc is not None:
+        tracemalloc.start()
+    profile.enable()
+
+def stop_profile(filename=None, out=None, limit=25):
+    """Stop profiling, print the top functions (by cumulative time) to out
+    and save the stats of all threads to filename, if given."""
+    import pstats
+    out = out or sys.stderr
+    threading.setprofile(None)
+    _profiles[0].disable()
+    _profiles_lock.acquire()
+    try:
+        profiles = list(_profiles)
+        del _profiles[:]
+    finally:
+        _profiles_lock.release()
+    for profile in profiles:
+        profile.create_stats()
+    stats = pstats.Stats(profiles[0], stream=out)
+    for profile in profiles[1:]:
+        stats.add(profile)
+    if filename:
+        stats.dump_stats(filename)
+    stats.sort_stats("cumulative").print_stats(limit)
+    if tracemalloc is not None:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print >> out, "traced memory: %d kB, peak %d kB" % (current // 1024,
+                peak // 1024)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Streaming parsing of armory XML.
+
+Instead of building a xml.dom.minidom tree of the whole document, the
+response is fed to expat a chunk at a time as it is read and only the
+attributes of the elements asked for are kept, as small namedtuples with
+numeric attributes already converted to int. Memory use doesn't depend on
+the size of the document.
+
+    for member in iter_roster(armoread.open_url(guild_url)):
+        print member.name, member.rank
+
+Whole documents are parsed by a handler object with start(name, attrs) and
+(optionally) end(name) and text(data) methods, called for every element
+either by expat (parse) or by walking an already parsed minidom tree
+(walk_dom).
+CharacterSheetHandler collects everything of a character-sheet.xml into
+compact records, the numeric stats end up in one array of doubles indexed
+by STAT_KEYS.
+"""
+
+import time
+import xml.parsers.expat
+from array import array
+from collections import namedtuple
+from cStringIO import StringIO
+
+import armotrace
+
+CHUNK_SIZE = 16 * 1024
+
+# guild-info.xml
+#   <character achPoints="105" classId="1" genderId="1" level="80"
+#       name="Aabacus" raceId="4" rank="1" url="r=Trollbane&amp;cn=Aabacus"/>
+RosterCharacter = namedtuple("RosterCharacter",
+        "name rank level classId genderId raceId achPoints url")
+ROSTER_CHARACTER_INTS = ("rank", "level", "classId", "genderId", "raceId",
+        "achPoints")
+
+# character-sheet.xml, see armoread.Stats
+CharacterInfo = namedtuple("CharacterInfo",
+        "name realm battleGroup guildName level classId raceId genderId "
+        "factionId points titleId prefix suffix lastModified className race "
+        "gender faction")
+CHARACTER_INFO_INTS = ("level", "classId", "raceId", "genderId", "factionId",
+        "points", "titleId")
+
+EquippedItem = namedtuple("EquippedItem",
+        "id slot level name rarity gem0Id gem1Id gem2Id "
+        "permanentEnchantItemId randomPropertiesId durability maxDurability")
+EQUIPPED_ITEM_INTS = ("id", "slot", "level", "rarity", "gem0Id", "gem1Id",
+        "gem2Id", "permanentEnchantItemId", "randomPropertiesId",
+        "durability", "maxDurability")
+
+TalentSpec = namedtuple("TalentSpec",
+        "group active prim icon treeOne treeTwo treeThree")
+TALENT_SPEC_INTS = ("group", "active", "treeOne", "treeTwo", "treeThree")
+
+Profession = namedtuple("Profession", "id key name value max")
+PROFESSION_INTS = ("id", "value", "max")
+
+Glyph = namedtuple("Glyph", "id name type icon effect")
+GLYPH_INTS = ("id",)
+
+# guild-info.xml
+GuildHeader = namedtuple("GuildHeader", "name realm battleGroup faction count")
+GUILD_HEADER_INTS = ("faction", "count")
+
+# item-info.xml
+#   <item icon="inv_helmet_158" id="51218" level="264" name="..."
+#       quality="4" type="Plate">
+ItemInfo = namedtuple("ItemInfo", "id name level quality type icon")
+ITEM_INFO_INTS = ("id", "level", "quality")
+
+# fields named differently than the attribute they are read from
+ATTR_NAMES = {"className": "class"}
+
+# numeric attributes of the stat sections of a character sheet, as
+# (path below the section, attributes), see armoread.Stats for an example.
+SCHOOLS = ("arcane", "fire", "frost", "holy", "nature", "shadow")
+STAT_LAYOUT = (
+    ("characterBars/health", "effective"),
+    ("characterBars/secondBar", "casting effective notCasting perFive"),
+    ("baseStats/strength", "attack base block effective"),
+    ("baseStats/agility", "armor attack base critHitPercent effective"),
+    ("baseStats/stamina", "base effective health petBonus"),
+    ("baseStats/intellect", "base critHitPercent effective mana petBonus"),
+    ("baseStats/spirit", "base effective healthRegen manaRegen"),
+    ("baseStats/armor", "base effective percent petBonus"),
+    ) + tuple([("resistances/" + s, "petBonus value") for s in SCHOOLS]) + (
+    ("melee/mainHandDamage", "dps max min percent speed"),
+    ("melee/offHandDamage", "dps max min percent speed"),
+    ("melee/mainHandSpeed", "hastePercent hasteRating value"),
+    ("melee/offHandSpeed", "hastePercent hasteRating value"),
+    ("melee/power", "base effective increasedDps"),
+    ("melee/hitRating", "increasedHitPercent penetration reducedArmorPercent value"),
+    ("melee/critChance", "percent plusPercent rating"),
+    ("melee/expertise", "additional percent rating value"),
+    ("ranged/weaponSkill", "rating value"),
+    ("ranged/damage", "dps max min percent speed"),
+    ("ranged/speed", "hastePercent hasteRating value"),
+    ("ranged/power", "base effective increasedDps petAttack petSpell"),
+    ("ranged/hitRating", "increasedHitPercent penetration reducedArmorPercent value"),
+    ("ranged/critChance", "percent plusPercent rating"),
+    ) + tuple([("spell/bonusDamage/" + s, "value") for s in SCHOOLS]) + (
+    ("spell/bonusDamage/petBonus", "attack damage"),
+    ("spell/bonusHealing", "value"),
+    ("spell/hitRating", "increasedHitPercent penetration reducedResist value"),
+    ("spell/critChance", "rating"),
+    ) + tuple([("spell/critChance/" + s, "percent") for s in SCHOOLS]) + (
+    ("spell/penetration", "value"),
+    ("spell/manaRegen", "casting notCasting"),
+    ("spell/hasteRating", "hastePercent hasteRating"),
+    ("defenses/armor", "base effective percent petBonus"),
+    ("defenses/defense", "decreasePercent increasePercent plusDefense rating value"),
+    ("defenses/dodge", "increasePercent percent rating"),
+    ("defenses/parry", "increasePercent percent rating"),
+    ("defenses/block", "increasePercent percent rating"),
+    ("defenses/resilience", "damagePercent hitPercent value"),
+)
+STAT_KEYS = tuple(["%s/%s" % (path, attr)
+        for path, attrs in STAT_LAYOUT for attr in attrs.split()])
+STAT_INDEX = dict([(key, i) for i, key in enumerate(STAT_KEYS)])
+STAT_SECTIONS = frozenset([key.split("/", 1)[0] for key in STAT_KEYS])
+
+
+def to_int(value, default=0):
+    """int(value) or default for missing/empty or non-numeric values."""
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return int(float(value))
+    except (ValueError, OverflowError):
+        return default
+
+def make_record(record_type, attrs, ints=()):
+    """Make a record_type namedtuple from an element's attribute dict.
+
+    Attributes named in 'ints' are converted to int, missing ones are 0 or
+    u''."""
+    values = []
+    for field in record_type._fields:
+        if field in ints:
+            values.append(to_int(attrs.get(field)))
+        else:
+            values.append(attrs.get(ATTR_NAMES.get(field, field), u''))
+    return record_type._make(values)
+
+def to_float(value, default=0.0):
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+def new_stats():
+    """An array of doubles with room for every STAT_KEYS value."""
+    return array('d', [0.0]) * len(STAT_KEYS)
+
+
+def parse(reader, handler, chunk_size=CHUNK_SIZE):
+    """Feed the document read from reader to handler, a chunk at a time."""
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = handler.start
+    if hasattr(handler, "end"):
+        parser.EndElementHandler = handler.end
+    if hasattr(handler, "text"):
+        parser.CharacterDataHandler = handler.text
+    if not armotrace.hooks:
+        while True:
+            data = reader.read(chunk_size)
+            parser.Parse(data, not data)
+            if not data:
+                break
+        return handler
+    seconds = 0.0
+    size = 0
+    while True:
+        data = reader.read(chunk_size)
+        start = time.time()
+        parser.Parse(data, not data)
+        seconds += time.time() - start
+        size += len(data)
+        if not data:
+            break
+    armotrace.emit("parse", armotrace.get_url(reader), seconds, size)
+    return handler
+
+def walk_dom(node, handler):
+    """Call handler for every element below a minidom node, like parse."""
+    end = getattr(handler, "end", None)
+    text = getattr(handler, "text", None)
+    for child in node.childNodes:
+        if child.nodeType in (child.TEXT_NODE, child.CDATA_SECTION_NODE):
+            if text:
+                text(child.data)
+            continue
+        if child.nodeType != child.ELEMENT_NODE:
+            continue
+        handler.start(child.tagName, dict(child.attributes.items()))
+        walk_dom(child, handler)
+        if end:
+            end(child.tagName)
+    return handler
+
+
+class CharacterSheetHandler(object):
+    """Collects a character-sheet.xml.
+
+    info -- CharacterInfo
+    stats -- array of doubles, indexed by STAT_INDEX
+    items -- [EquippedItem, ...]
+    talent_specs, professions, glyphs -- lists of records
+    """
+
+    def __init__(self):
+        self.info = None
+        self.stats = new_stats()
+        self.items = []
+        self.talent_specs = []
+        self.professions = []
+        self.glyphs = []
+        self._stack = []
+        self._section = None
+
+    def start(self, name, attrs):
+        stack = self._stack
+        if self._section is not None:
+            path = "/".join(stack[self._section:] + [name])
+            for attr, value in attrs.iteritems():
+                i = STAT_INDEX.get(path + "/" + attr)
+                if i is not None:
+                    self.stats[i] = to_float(value)
+        elif name in STAT_SECTIONS:
+            self._section = len(stack)
+        elif name == "item" and stack and stack[-1] == "items":
+            self.items.append(make_record(EquippedItem, attrs, EQUIPPED_ITEM_INTS))
+        elif name == "character" and self.info is None:
+            self.info = make_record(CharacterInfo, attrs, CHARACTER_INFO_INTS)
+        elif name == "talentSpec":
+            self.talent_specs.append(make_record(TalentSpec, attrs, TALENT_SPEC_INTS))
+        elif name == "skill" and stack and stack[-1] == "professions":
+            self.professions.append(make_record(Profession, attrs, PROFESSION_INTS))
+        elif name == "glyph":
+            self.glyphs.append(make_record(Glyph, attrs, GLYPH_INTS))
+        stack.append(name)
+
+    def end(self, name):
+        self._stack.pop()
+        if self._section == len(self._stack):
+            self._section = None
+
+
+class ItemInfoHandler(object):
+    """Collects the ItemInfo of an item-info.xml."""
+
+    def __init__(self):
+        self.info = None
+
+    def start(self, name, attrs):
+        if name == "item" and self.info is None:
+            self.info = make_record(ItemInfo, attrs, ITEM_INFO_INTS)
+
+
+def iter_elements(reader, tags, chunk_size=CHUNK_SIZE):
+    """Yield (tag, attrs) for each element in 'tags', in document order.
+
+    reader -- a file like object, read chunk_size bytes at a time.
+    """
+    found = []
+    def start_element(name, attrs):
+        if name in tags:
+            found.append((name, attrs))
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    while True:
+        data = reader.read(chunk_size)
+        parser.Parse(data, not data)
+        for elem in found:
+            yield elem
+        del found[:]
+        if not data:
+            break
+
+def iter_roster(reader):
+    """Yield a RosterCharacter for each member in a guild-info.xml."""
+    for tag, attrs in iter_elements(reader, ("character",)):
+        yield make_record(RosterCharacter, attrs, ROSTER_CHARACTER_INTS)
+
+def iter_character_sheet(reader):
+    """Yield the CharacterInfo and then an EquippedItem per item in a
+    character-sheet.xml."""
+    for tag, attrs in iter_elements(reader, ("character", "item")):
+        if tag == "character":
+            yield make_record(CharacterInfo, attrs, CHARACTER_INFO_INTS)
+        else:
+            yield make_record(EquippedItem, attrs, EQUIPPED_ITEM_INTS)
+
+
+class ItemTooltipHandler(object):
+    """Collects the text content of an item-tooltip.xml.
+
+    values -- {element name: text} of the elements right below <itemTooltip>,
+        eg {"id": u"51218", "bonusStamina": u"121", ...}
+    texts -- free text describing stats, from <gemProperties> and <desc>
+        elements, eg [u"+20 Strength and +10 Stamina"]
+    """
+
+    TEXT_ELEMENTS = ("gemProperties", "desc")
+
+    def __init__(self):
+        self.values = {}
+        self.texts = []
+        self._stack = []
+        self._text = []
+
+    def start(self, name, attrs):
+        self._stack.append(name)
+        self._text = []
+
+    def text(self, data):
+        self._text.append(data)
+
+    def end(self, name):
+        self._stack.pop()
+        text = u"".join(self._text).strip()
+        self._text = []
+        if not text:
+            return
+        if self._stack and self._stack[-1] == "itemTooltip":
+            self.values[name] = text
+        if name in self.TEXT_ELEMENTS:
+            self.texts.append(text)
+
+
+# whole documents parsed by parse_document, plain records that can be
+# pickled (eg sent back from a worker process)
+CharacterSheet = namedtuple("CharacterSheet",
+        "info stats items talent_specs professions glyphs")
+ItemTooltip = namedtuple("ItemTooltip", "values texts")
+
+def parse_document(kind, data):
+    """Parse a whole document, data (a str), of kind:
+
+        "roster"    guild-info.xml => [RosterCharacter, ...]
+        "char"      character-sheet.xml => CharacterSheet
+        "item"      item-info.xml => ItemInfo, or None
+        "tooltip"   item-tooltip.xml => ItemTooltip
+    """
+    if kind == "roster":
+        return list(iter_roster(StringIO(data)))
+    if kind == "char":
+        sheet = parse(StringIO(data), CharacterSheetHandler())
+        return CharacterSheet(sheet.info, sheet.stats, sheet.items,
+                sheet.talent_specs, sheet.professions, sheet.glyphs)
+    if kind == "item":
+        return parse(StringIO(data), ItemInfoHandler()).info
+    if kind == "tooltip":
+        tooltip = parse(StringIO(data), ItemTooltipHandler())
+        return ItemTooltip(tooltip.values, tooltip.texts)
+    raise ValueError("unknown kind of document %r" % (kind,))
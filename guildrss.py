@@ -5,6 +5,32 @@
 Parses a XML file containing a guild to make a OPML file outlining based on
 the guild ranks.
 
+The OPML is streamed to the file while the roster is read (write_opml), with
+the members of each group spooled to a temporary file until the roster is
+done, so memory use doesn't grow with the guild. With -u an existing OPML is
+updated instead (update_opml): only members that joined, left or changed
+group are touched, and the file isn't written at all if none did.
+
+guildrss.py
+    -h, --help              Show help - what you are reading now.
+    -m ..., --map=...       Rank groups, see below. Ranks in no group are
+                            left out.
+    -r ..., --realm=...     Set realm.
+    -g ..., --guild=...     Set guild.
+    --eu, --us              Set area (EU or US).
+    -u, --update            Update the OPML file if it exists.
+    --guilds=...            Make OPMLs of all guilds in a JSON list like
+                                [{"area": "EU", "realm": "Trollbane",
+                                  "guild": "Emerge", "map": "0135 6 8 279"},
+                                 ...]
+                            The rosters are read at once (through the
+                            cache), one opml-<guild>-<realm>.xml is written
+                            per guild (or updated with -u).
+    --combined=...          With --guilds, write one OPML to this file
+                            instead, outlined by realm, guild and rank group.
+                            Characters already listed are left out.
+    -j ..., --jobs=...      Rosters to read at once (default 4).
+
 TODO
 ----
 * Make it read rank mapping from argv. For example
@@ -21,11 +47,20 @@ Look into supporting other output formats than OPML
     OML, XOXO, XBEL
 """
 
+import os
+import re
 import sys
+import json
 import getopt
-import xml.dom.minidom as xdm
+import tempfile
 import armoread
 
+DEFAULT_RANK_MAP = "0 1 2 3 4 5 6 7 8 9"
+FEED_URL = "%scharacter-feed.atom?r=%s&cn=%s"
+INDENT = "    "
+ENCODING = "utf-8"
+CHUNK_SIZE = 16 * 1024
+
 #<?xml version="1.0" encoding="UTF-8"?>
 #<opml version="1.0">
 #    <head>
@@ -50,21 +85,18 @@ def add_group_outlines(group_names, body, doc):
         outline.setAttribute("text", "%s" % gn)
         group_names[gn]["outline"] = outline
 
-def add_char(rank_mappings, character, doc, realm_name):
-    character_rank = character.getAttribute("rank")
-    character_name = character.getAttribute("name")
+def add_char(rank_mappings, character, doc, realm_name, base_url):
+    """character -- an armoxml.RosterCharacter"""
+    character_rank = str(character.rank)
+    character_name = character.name
     outline = rank_mappings[character_rank]["outline"]
     char = doc.createElement("outline")
     outline.appendChild(char)
     char.setAttribute("text", "WoW Feed for %s@%s" % (character_name, realm_name))
     char.setAttribute("title", "WoW Feed for %s@%s" % (character_name, realm_name))
     char.setAttribute("type", "rss")
-    char.setAttribute("xmlUrl",
-            "http://eu.wowarmory.com/character-feed.atom?r=%s&cn=%s" %
-            (realm_name, character_name))
-    char.setAttribute("htmlUrl",
-            "http://eu.wowarmory.com/character-feed.atom?r=%s&cn=%s" %
-            (realm_name, character_name))
+    char.setAttribute("xmlUrl", get_feed_url(realm_name, character_name, base_url))
+    char.setAttribute("htmlUrl", get_feed_url(realm_name, character_name, base_url))
 
 def get_opml_doc(rank_mappings, group_names, realm, guild, base_url):
     """return a xml.dom.minidom document
@@ -76,6 +108,7 @@ def get_opml_doc(rank_mappings, group_names, realm, guild, base_url):
         GROUP_NAME -- is the concatenation of each rank name in that group.
         OUTLINE -- is an outline element
     """
+    import xml.dom.minidom as xdm
     doc = xdm.Document()
     opml = doc.createElement("opml")
     opml.setAttribute("version", "1.0")
@@ -91,13 +124,326 @@ def get_opml_doc(rank_mappings, group_names, realm, guild, base_url):
 
     add_group_outlines(group_names, body, doc)
 
-    guild_dom = armoread.get_guild_dom(realm, guild, base_url)
-    for char in guild_dom.getElementsByTagName("character"):
-        add_char(rank_mappings, char, doc, realm)
+    for char in armoread.iter_guild_roster(realm, guild, base_url):
+        add_char(rank_mappings, char, doc, realm, base_url)
 
     return doc
 
 
+def get_feed_url(realm, name, base_url):
+    return FEED_URL % (base_url, armoread.quote_query(realm),
+            armoread.quote_query(name))
+
+def escape(data, entities={}):
+    """Like xml.sax.saxutils.escape, which isn't imported as it pulls in
+    urllib (and the socket and ssl modules) with it."""
+    data = data.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    for key, value in entities.items():
+        data = data.replace(key, value)
+    return data
+
+def quote(value):
+    """value as a double quoted, escaped and encoded attribute value."""
+    return '"%s"' % escape(value, {'"': "&quot;"}).encode(ENCODING)
+
+def format_group(group, depth=2, empty=False):
+    """The opening tag line of a group outline, self closing if 'empty'."""
+    name = quote(group["name"])
+    return "%s<outline text=%s title=%s%s>\n" % (INDENT * depth, name, name,
+            empty and "/" or "")
+
+def format_char(realm, name, base_url, depth=3):
+    """The outline line of a member's feed."""
+    url = quote(get_feed_url(realm, name, base_url))
+    title = quote(u"WoW Feed for %s@%s" % (name, realm))
+    return "%s<outline htmlUrl=%s text=%s title=%s type=\"rss\" xmlUrl=%s/>\n" % (
+            INDENT * depth, url, title, title, url)
+
+def get_groups(group_names):
+    """The groups of parse_ranks, in the order they were given."""
+    groups = group_names.values()
+    groups.sort(key=lambda group: group.get("index", group["name"]))
+    return groups
+
+def write_opml(outfile, rank_mappings, group_names, realm, guild, base_url,
+        roster=None):
+    """Write an OPML of the guild to outfile, streamed while the roster is
+    read.
+
+    roster -- armoxml.RosterCharacter records, default read from the
+        armory. Members of ranks not in rank_mappings are left out.
+    """
+    if roster is None:
+        roster = armoread.iter_guild_roster(realm, guild, base_url)
+    spools = {}
+    try:
+        for group in group_names.values():
+            spools[group["name"]] = tempfile.TemporaryFile()
+        for character in roster:
+            group = rank_mappings.get(str(character.rank))
+            if group is not None:
+                spools[group["name"]].write(format_char(realm, character.name, base_url))
+        outfile.write('<?xml version="1.0" encoding="%s"?>\n' % ENCODING)
+        outfile.write('<opml version="1.0">\n')
+        outfile.write("%s<head>\n" % INDENT)
+        outfile.write("%s<title>%s</title>\n" % (INDENT * 2,
+            escape(u"%s@%s" % (guild, realm)).encode(ENCODING)))
+        outfile.write("%s</head>\n" % INDENT)
+        outfile.write("%s<body>\n" % INDENT)
+        for group in get_groups(group_names):
+            spool = spools[group["name"]]
+            if not spool.tell():
+                outfile.write(format_group(group, empty=True))
+                continue
+            outfile.write(format_group(group))
+            spool.seek(0)
+            chunk = spool.read(CHUNK_SIZE)
+            while chunk:
+                outfile.write(chunk)
+                chunk = spool.read(CHUNK_SIZE)
+            outfile.write("%s</outline>\n" % (INDENT * 2))
+        outfile.write("%s</body>\n" % INDENT)
+        outfile.write("</opml>\n")
+    finally:
+        for spool in spools.values():
+            spool.close()
+
+def write_opml_file(filename, rank_mappings, group_names, realm, guild, base_url,
+        roster=None):
+    def write(outfile):
+        write_opml(outfile, rank_mappings, group_names, realm, guild, base_url,
+                roster)
+    armoread.write_atomically(filename, write)
+
+
+_GROUP_RE = re.compile(r'^\s*<outline text="([^"]*)" title="[^"]*"(/?)>\s*$')
+_FEED_RE = re.compile(r'^\s*<outline htmlUrl=.* xmlUrl="([^"]*)"/>\s*$')
+_END_GROUP_RE = re.compile(r'^\s*</outline>\s*$')
+
+def read_opml_feeds(filename):
+    """{feed url (as written, escaped): group name} of an OPML written by
+    write_opml, or None if it isn't laid out like one."""
+    feeds = {}
+    group = None
+    f = open(filename, 'rb')
+    try:
+        for line in f:
+            m = _FEED_RE.match(line)
+            if m:
+                if group is None:
+                    return None
+                feeds[m.group(1)] = group
+                continue
+            m = _GROUP_RE.match(line)
+            if m:
+                group = not m.group(2) and m.group(1) or None
+            elif _END_GROUP_RE.match(line):
+                group = None
+    finally:
+        f.close()
+    return feeds
+
+def update_opml(filename, rank_mappings, group_names, realm, guild, base_url,
+        roster=None):
+    """Update the OPML in filename to the guild's current roster, changing
+    only the lines of members that joined, left or moved to another group.
+    The file is rewritten from scratch if it doesn't exist or wasn't written
+    by write_opml. Returns (added, removed), lists of member names, or None
+    if the file was rewritten."""
+    feeds = None
+    if os.path.exists(filename):
+        feeds = read_opml_feeds(filename)
+    groups = dict([(quote(group["name"])[1:-1], group)
+        for group in group_names.values()])
+    if feeds is None or not set(feeds.values()) <= set(groups):
+        write_opml_file(filename, rank_mappings, group_names, realm, guild,
+                base_url, roster)
+        return None
+    if roster is None:
+        roster = armoread.iter_guild_roster(realm, guild, base_url)
+    # kept for the rewrite, should the file turn out not to fit
+    roster = list(roster)
+    wanted = {}
+    names = {}
+    for character in roster:
+        group = rank_mappings.get(str(character.rank))
+        if group is not None:
+            url = quote(get_feed_url(realm, character.name, base_url))[1:-1]
+            wanted[url] = quote(group["name"])[1:-1]
+            names[url] = character.name
+    removed = [url for url, group in feeds.items() if wanted.get(url) != group]
+    added = [url for url, group in wanted.items() if feeds.get(url) != group]
+    if not added and not removed:
+        return [], []
+    removed_set = set(removed)
+    additions = {}
+    for url in added:
+        additions.setdefault(wanted[url], []).append(
+                format_char(realm, names[url], base_url))
+    def write(outfile):
+        group = None
+        infile = open(filename, 'rb')
+        try:
+            for line in infile:
+                m = _FEED_RE.match(line)
+                if m and m.group(1) in removed_set:
+                    continue
+                m = _GROUP_RE.match(line)
+                if m:
+                    group = m.group(1)
+                    if m.group(2):
+                        # an empty group, opened up if it gets members
+                        new = additions.pop(group, None)
+                        if new:
+                            outfile.write(format_group(groups[group]))
+                            outfile.writelines(new)
+                            outfile.write("%s</outline>\n" % (INDENT * 2))
+                            continue
+                        group = None
+                elif group is not None and _END_GROUP_RE.match(line):
+                    outfile.writelines(additions.pop(group, []))
+                    group = None
+                outfile.write(line)
+        finally:
+            infile.close()
+        if additions:
+            # a group the file doesn't have
+            raise ValueError("groups %s not in '%s'" % (", ".join(additions), filename))
+    try:
+        armoread.write_atomically(filename, write)
+    except ValueError:
+        write_opml_file(filename, rank_mappings, group_names, realm, guild,
+                base_url, iter(roster))
+        return None
+    import urllib
+    name_of = lambda url: names.get(url) or urllib.unquote_plus(
+            url.rsplit("cn=", 1)[-1]).decode(ENCODING)
+    return [name_of(url) for url in added], [name_of(url) for url in removed]
+
+
+def read_guild_list(filename):
+    """[{"area", "realm", "guild", "map"}, ...] of a JSON guild list, with
+    area (default armoread.SERVER_AREA) and map (default DEFAULT_RANK_MAP)
+    filled in."""
+    f = open(filename, 'rb')
+    try:
+        guilds = json.load(f)
+    finally:
+        f.close()
+    for entry in guilds:
+        entry["area"] = entry.get("area", armoread.SERVER_AREA).upper()
+        entry.setdefault("map", DEFAULT_RANK_MAP)
+    return guilds
+
+def get_guild_key(entry):
+    return entry["area"], entry["realm"], entry["guild"]
+
+def fetch_rosters(guilds, pool=None):
+    """{(area, realm, guild): [RosterCharacter, ...]} of the guilds, each
+    distinct guild read once (however many maps it is listed with),
+    concurrently if given a pool (an armonet.FetchPool). Guilds that fail
+    to load are left out."""
+    rosters = {}
+    def fetch(key):
+        area, realm, guild = key
+        rosters[key] = list(armoread.iter_guild_roster(realm, guild,
+            armoread.BASE_URLs[area]))
+    for key in set([get_guild_key(entry) for entry in guilds]):
+        if pool is None:
+            fetch(key)
+        else:
+            area, realm, guild = key
+            pool.add(armoread.get_guildinfo_url(guild, realm,
+                armoread.BASE_URLs[area]), fetch, key)
+    if pool is not None:
+        pool.join()
+    return rosters
+
+def write_combined_opml(outfile, guilds, rosters, title):
+    """Write one OPML of all guilds to outfile, with an outline per realm,
+    per guild in it and per rank group in that. A character listed by
+    several guilds (or the same guild with several maps) only appears the
+    first time. Guilds without a roster (see fetch_rosters) are left out
+    and reported on stderr."""
+    seen = set()
+    realms = []
+    by_realm = {}
+    missing = set()
+    for entry in guilds:
+        key = get_guild_key(entry)
+        if key not in rosters:
+            if key not in missing:
+                missing.add(key)
+                print >> sys.stderr, ("left out: '%s@%s' (%s), its roster "
+                        "couldn't be read" % (entry["guild"], entry["realm"],
+                        entry["area"])).encode(ENCODING)
+            continue
+        realm_key = (entry["area"], entry["realm"])
+        if realm_key not in by_realm:
+            realms.append(realm_key)
+            by_realm[realm_key] = []
+        by_realm[realm_key].append(entry)
+    outfile.write('<?xml version="1.0" encoding="%s"?>\n' % ENCODING)
+    outfile.write('<opml version="1.0">\n')
+    outfile.write("%s<head>\n" % INDENT)
+    outfile.write("%s<title>%s</title>\n" % (INDENT * 2,
+        escape(title).encode(ENCODING)))
+    outfile.write("%s</head>\n" % INDENT)
+    outfile.write("%s<body>\n" % INDENT)
+    for area, realm in realms:
+        base_url = armoread.BASE_URLs[area]
+        outfile.write(format_group({"name": u"%s (%s)" % (realm, area)}))
+        for entry in by_realm[(area, realm)]:
+            roster = rosters[get_guild_key(entry)]
+            outfile.write(format_group({"name": entry["guild"]}, 3))
+            rank_mappings, group_names = parse_ranks(entry["map"])
+            members = dict([(group["name"], []) for group in group_names.values()])
+            for character in roster:
+                group = rank_mappings.get(str(character.rank))
+                key = (area, realm, character.name)
+                if group is None or key in seen:
+                    continue
+                seen.add(key)
+                members[group["name"]].append(format_char(realm,
+                    character.name, base_url, 5))
+            for group in get_groups(group_names):
+                lines = members[group["name"]]
+                if not lines:
+                    continue
+                outfile.write(format_group(group, 4))
+                outfile.writelines(lines)
+                outfile.write("%s</outline>\n" % (INDENT * 4))
+            outfile.write("%s</outline>\n" % (INDENT * 3))
+        outfile.write("%s</outline>\n" % (INDENT * 2))
+    outfile.write("%s</body>\n" % INDENT)
+    outfile.write("</opml>\n")
+
+def write_guild_opmls(guilds, rosters, update=False):
+    """Write (or update) opml-<guild>-<realm>.xml for each guild, return the
+    filenames. A guild listed with several maps gets several files,
+    opml-<guild>-<realm>-2.xml and so on."""
+    filenames = []
+    for entry in guilds:
+        roster = rosters.get(get_guild_key(entry))
+        if roster is None:
+            continue
+        filename = "opml-%s-%s.xml" % (entry["guild"], entry["realm"])
+        n = 2
+        while filename in filenames:
+            filename = "opml-%s-%s-%d.xml" % (entry["guild"], entry["realm"], n)
+            n += 1
+        rank_mappings, group_names = parse_ranks(entry["map"])
+        base_url = armoread.BASE_URLs[entry["area"]]
+        if update:
+            update_opml(filename, rank_mappings, group_names, entry["realm"],
+                    entry["guild"], base_url, iter(roster))
+        else:
+            write_opml_file(filename, rank_mappings, group_names,
+                    entry["realm"], entry["guild"], base_url, iter(roster))
+        filenames.append(filename)
+    return filenames
+
+
 def usage():
     print __doc__
 
@@ -115,7 +461,7 @@ def parse_ranks(arg):
     for str_grp in _str_groups:
         ranks = [rank_names[int(rank)] for rank in str_grp]
         group_name = ", ".join(ranks)
-        group = {"name": group_name, "elems": []}
+        group = {"name": group_name, "elems": [], "index": len(_groups)}
         _groups.append((str_grp, group))
         res_group_names[group["name"]] = group
 
@@ -136,11 +482,15 @@ def _main(argv):
     flags.server_area = armoread.SERVER_AREA
     flags.realm = 'Trollbane'
     flags.guild = 'Emerge'
-    flags.rank_mappings = {}
-    flags.group_names = {}
+    flags.rank_mappings, flags.group_names = parse_ranks(DEFAULT_RANK_MAP)
+    flags.update = False
+    flags.guilds = None
+    flags.combined = None
+    flags.jobs = None
     try:
-        opts, args = getopt.getopt(argv, "hvm:rgwf", ["help", "verbose",
-            "map", "realm", "guild", "char=", "itemid=", "eu", "us", "force"])
+        opts, args = getopt.getopt(argv, "hvm:r:g:wfuj:", ["help", "verbose",
+            "map=", "realm=", "guild=", "char=", "itemid=", "eu", "us", "force",
+            "update", "guilds=", "combined=", "jobs="])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -165,14 +515,49 @@ def _main(argv):
             flag_write = True
         elif opt in ('-f', '--force'):
             flag_force = True
+        elif opt in ('-u', '--update'):
+            flags.update = True
+        elif opt == '--guilds':
+            flags.guilds = arg
+        elif opt == '--combined':
+            flags.combined = arg
+        elif opt in ('-j', '--jobs'):
+            flags.jobs = int(arg)
 
     flags.base_url = armoread.BASE_URLs[flags.server_area]
 
-    opml_doc = get_opml_doc(flags.rank_mappings, flags.group_names, flags.realm, flags.guild, flags.base_url)
-    pretty_xml = opml_doc.toprettyxml(encoding="utf-8", indent="    ")
-    filename = "opml-" + flags.guild + "-" + flags.realm + ".xml"
-    armoread.write_str_to_file(pretty_xml, filename)
+    if flags.guilds:
+        import armonet
+        guilds = read_guild_list(flags.guilds)
+        pool = armonet.FetchPool(flags.jobs or armonet.MAX_JOBS,
+                verbose=flag_verbose)
+        rosters = fetch_rosters(guilds, pool)
+        for url, e in pool.failures:
+            print >> sys.stderr, "failed: '%s' (%s)" % (url, e)
+        if flags.combined:
+            def write(outfile):
+                write_combined_opml(outfile, guilds, rosters,
+                        u"%d guilds" % len(rosters))
+            armoread.write_atomically(flags.combined, write)
+        else:
+            filenames = write_guild_opmls(guilds, rosters, flags.update)
+            if flag_verbose:
+                print "wrote %s" % ", ".join(filenames)
+        if pool.failures:
+            sys.exit(1)
+        return
 
+    filename = "opml-" + flags.guild + "-" + flags.realm + ".xml"
+    if flags.update:
+        changes = update_opml(filename, flags.rank_mappings, flags.group_names,
+                flags.realm, flags.guild, flags.base_url)
+        if flag_verbose and changes is not None:
+            added, removed = changes
+            print ("added: %s" % ", ".join(added)).encode(ENCODING)
+            print ("removed: %s" % ", ".join(removed)).encode(ENCODING)
+    else:
+        write_opml_file(filename, flags.rank_mappings, flags.group_names,
+                flags.realm, flags.guild, flags.base_url)
 
 if __name__ == "__main__":
     _main(sys.argv[1:])
@@ -0,0 +1,87 @@
+import os
+import shutil
+import unittest
+import tempfile
+
+import armoarchive
+
+
+def make_doc(changed=-1):
+    return "<page>%s</page>" % "".join(['<item id="%d" level="%d"/>'
+            % (i, i == changed and 999 or 200 + i % 50) for i in range(3000)])
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.archive = armoarchive.Archive(self.dir)
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.dir)
+
+    def get_size(self):
+        return sum([os.path.getsize(os.path.join(self.dir, name))
+                for name in os.listdir(self.dir) if name.endswith(".dat")])
+
+    def test_split_blocks(self):
+        data = make_doc()
+        blocks = armoarchive.split_blocks(data)
+        self.assertEqual("".join(blocks), data)
+        self.assertTrue(len(blocks) > 10)
+        self.assertTrue(max(map(len, blocks)) <= armoarchive.MAX_BLOCK + 100)
+        # a change only touches the blocks around it
+        changed = armoarchive.split_blocks(make_doc(1500))
+        self.assertTrue(len(set(changed) - set(blocks)) <= 2)
+
+    def test_round_trip(self):
+        archive = self.archive
+        archive.put("char", u"Trollbane", u"\xc5sa", make_doc(), 100.0)
+        archive.put("char", u"Trollbane", u"\xc5sa", make_doc(7), 200.0)
+        archive.put("item", "", "19019", "<page/>", 150.0)
+        archive.close()
+        archive = self.archive = armoarchive.Archive(self.dir)
+        self.assertEqual(archive.get("char", "Trollbane", u"\xc5sa"), make_doc(7))
+        self.assertEqual(archive.get("char", "Trollbane", u"\xc5sa", 199.0),
+                make_doc())
+        self.assertEqual(archive.get("char", "Trollbane", u"\xc5sa", 99.0), None)
+        self.assertEqual(archive.get("item", "", "19019"), "<page/>")
+        self.assertEqual(archive.history("char", "Trollbane", u"\xc5sa"),
+                [(100.0, len(make_doc())), (200.0, len(make_doc(7)))])
+        self.assertEqual(archive.names("item"), ["19019"])
+
+    def test_dedup(self):
+        self.archive.put("char", "Trollbane", "Aabacus", make_doc(), 100.0)
+        size = self.get_size()
+        self.archive.put("char", "Trollbane", "Aabacus", make_doc(), 200.0)
+        self.assertEqual(self.get_size(), size)
+        self.archive.put("char", "Trollbane", "Aabacus", make_doc(1500), 300.0)
+        self.assertTrue(self.get_size() - size < size / 5)
+        self.assertEqual(self.archive.get("char", "Trollbane", "Aabacus", 250.0),
+                make_doc())
+
+    def test_segments(self):
+        self.archive.close()
+        archive = self.archive = armoarchive.Archive(self.dir, segment_size=4096)
+        for i in range(5):
+            archive.put("char", "Trollbane", "Char%d" % i, make_doc(i), 100.0)
+        self.assertTrue(len([name for name in os.listdir(self.dir)
+                if name.endswith(".dat")]) > 1)
+        for i in range(5):
+            self.assertEqual(archive.get("char", "Trollbane", "Char%d" % i),
+                    make_doc(i))
+
+    def test_key_from_filename(self):
+        key = armoarchive.get_key_from_filename
+        self.assertEqual(key("dump/items/", "19019-tooltip.xml"),
+                ("tooltip", "", "19019"))
+        self.assertEqual(key("dump/items", "19019.xml"), ("item", "", "19019"))
+        self.assertEqual(key("guilds", "Trollbane - Emerge.xml"),
+                ("guild", "Trollbane", "Emerge"))
+        self.assertEqual(key("chars", "Aabacus.xml", "Trollbane"),
+                ("char", "Trollbane", "Aabacus"))
+
+
+if __name__ == "__main__":
+    unittest.main()
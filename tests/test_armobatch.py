@@ -0,0 +1,115 @@
+import os
+import shutil
+import sqlite3
+import unittest
+import tempfile
+import urllib2
+from StringIO import StringIO
+
+import armoread
+import armobatch
+
+
+class WorkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "batch.db")
+        self.out = os.path.join(self.dir, "out")
+        self.open_url = armoread.open_url
+        armoread.open_url = self.fake_open_url
+        self.fail = armobatch.WorkQueue.fail
+        self.stall_timeout = armobatch.STALL_TIMEOUT
+        self.retry_delay = armobatch.RETRY_DELAY
+        armobatch.RETRY_DELAY = 0.0
+
+    def tearDown(self):
+        armoread.open_url = self.open_url
+        armobatch.WorkQueue.fail = self.fail
+        armobatch.STALL_TIMEOUT = self.stall_timeout
+        armobatch.RETRY_DELAY = self.retry_delay
+        shutil.rmtree(self.dir)
+
+    def fake_open_url(self, url, max_age=None):
+        if url.endswith("=2"):
+            raise urllib2.URLError("no item 2")
+        return StringIO("<page/>")
+
+    def add(self, jobs):
+        queue = armobatch.WorkQueue(self.path)
+        try:
+            queue.add(jobs)
+        finally:
+            queue.close()
+
+    def counts(self):
+        queue = armobatch.WorkQueue(self.path)
+        try:
+            return queue.counts()
+        finally:
+            queue.close()
+
+    def test_failing_bookkeeping(self):
+        self.add([("item", "EU", u"", u"1"), ("item", "EU", u"", u"2")])
+        calls = []
+        fail = self.fail
+        def locked_once(queue, job_id, error):
+            calls.append(job_id)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError("database is locked")
+            fail(queue, job_id, error)
+        armobatch.WorkQueue.fail = locked_once
+        armobatch.work(self.path, self.out, jobs=2)
+        counts = self.counts()
+        self.assertEqual((counts["done"], counts["failed"], counts["running"]),
+                (1, 1, 0))
+        self.assertEqual(len(calls), armobatch.MAX_ATTEMPTS + 1)
+
+    def test_stuck_running(self):
+        self.add([("item", "EU", u"", u"1")])
+        # claimed by a process that is alive but will never finish it
+        db = sqlite3.connect(self.path)
+        db.execute("UPDATE jobs SET state = ?, host = ?, pid = ?",
+                (armobatch.RUNNING, armobatch.socket.gethostname(),
+                os.getppid()))
+        db.commit()
+        db.close()
+        armobatch.STALL_TIMEOUT = 0.2
+        armobatch.work(self.path, self.out, jobs=2)
+        self.assertEqual(self.counts()["running"], 1)
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.queue = armobatch.WorkQueue(os.path.join(self.dir, "batch.db"))
+        self.time = armobatch.time.time
+        self.now = 1000.0
+        armobatch.time.time = lambda: self.now
+
+    def tearDown(self):
+        armobatch.time.time = self.time
+        self.queue.close()
+        shutil.rmtree(self.dir)
+
+    def test_backoff(self):
+        self.queue.add([("item", "EU", u"", u"1")])
+        delays = []
+        for attempt in range(armobatch.MAX_ATTEMPTS - 1):
+            job = self.queue.claim(1)[0]
+            self.queue.fail(job[0], "URLError")
+            start = self.now
+            while not self.queue.claim(1):
+                self.now += 1.0
+            delays.append(self.now - start)
+            self.queue.release()
+        self.assertEqual(delays, [armobatch.RETRY_DELAY,
+                armobatch.RETRY_DELAY * 2])
+        job = self.queue.claim(1)[0]
+        self.queue.fail(job[0], "URLError")
+        self.assertEqual(self.queue.counts()["failed"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+import urllib2
+
+import armoxml
+import armoread
+import armobench
+
+
+class ArmoryServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = armobench.ArmoryServer(members=3, items=2)
+        self.server.start()
+        self.base_url = self.server.get_base_url()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, url):
+        return urllib2.urlopen(url)
+
+    def test_guild_name(self):
+        url = armoread.get_guildinfo_url("Some Guild", "Trollbane",
+                self.base_url)
+        records = list(armoxml.iter_roster(self.get(url)))
+        self.assertEqual(len(records), 3)
+        self.assertTrue('name="Some Guild"' in self.get(url).read())
+
+    def test_character_name(self):
+        url = armoread.get_charactersheet_url("Aabacus", "Trollbane",
+                self.base_url)
+        for record in armoxml.iter_character_sheet(self.get(url)):
+            self.assertEqual(record.name, u"Aabacus")
+            break
+
+
+if __name__ == "__main__":
+    unittest.main()
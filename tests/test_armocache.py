@@ -0,0 +1,107 @@
+import os
+import shutil
+import unittest
+import tempfile
+import urllib2
+import mimetools
+from StringIO import StringIO
+
+import armocache
+
+
+class Reader(StringIO):
+    def info(self):
+        return mimetools.Message(StringIO("\r\n"))
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = armocache.Cache(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def store(self, url, body):
+        path = self.cache._get_path(url)
+        self.cache._store(url, path, Reader(body)).close()
+
+    def expire(self, url, **values):
+        meta, path = self.cache.get(url)
+        meta["fetched"] = 0
+        meta.update(values)
+        self.cache._write_meta(path, meta)
+
+    def test_refetch_size(self):
+        url = "http://eu.wowarmory.com/item-info.xml?i=1"
+        self.store(url, "x" * 100)
+        self.store("http://eu.wowarmory.com/item-info.xml?i=2", "y" * 10)
+        self.store(url, "x" * 40)
+        self.store(url, "x" * 70)
+        self.assertEqual(self.cache._size, 80)
+        self.assertEqual(self.cache._size,
+                sum([e[1] for e in self.cache._entries()]))
+
+    def test_missing_fetched_is_stale(self):
+        url = "http://eu.wowarmory.com/item-info.xml?i=1"
+        self.assertFalse(self.cache.is_fresh({"url": url}, url))
+        self.assertTrue(self.cache.is_fresh({"fetched": 100}, url, now=160))
+
+    def test_revalidate(self):
+        url = "http://eu.wowarmory.com/character-sheet.xml?r=a&n=b"
+        self.store(url, "old")
+        self.expire(url, etag='"1"')
+        session = Session(NotModified(""))
+        self.assertEqual(self.cache.open(url, session).read(), "old")
+        self.assertEqual(session.headers, {'if-none-match': '"1"'})
+        self.assertEqual(self.cache.revalidated, 1)
+        self.assertTrue(self.cache.is_fresh(self.cache.get(url)[0], url))
+
+    def test_offline(self):
+        url = "http://eu.wowarmory.com/character-sheet.xml?r=a&n=b"
+        self.store(url, "old")
+        self.expire(url)
+        self.cache.offline = True
+        self.assertEqual(self.cache.open(url, None).read(), "old")
+        self.assertRaises(armocache.NotCached, self.cache.open,
+                url.replace("n=b", "n=c"), None)
+
+    def test_stale_on_error(self):
+        url = "http://eu.wowarmory.com/character-sheet.xml?r=a&n=b"
+        self.store(url, "old")
+        self.expire(url)
+        error = urllib2.URLError("connection refused")
+        self.assertEqual(self.cache.open(url, Session(error)).read(), "old")
+        error = urllib2.HTTPError(url, 503, "busy", None, None)
+        self.assertEqual(self.cache.open(url, Session(error)).read(), "old")
+        self.assertEqual(self.cache.stale, 2)
+        error = urllib2.HTTPError(url, 404, "gone", None, None)
+        self.assertRaises(urllib2.HTTPError,
+                self.cache.open, url, Session(error))
+        other = "http://eu.wowarmory.com/character-sheet.xml?r=a&n=c"
+        self.assertRaises(urllib2.URLError,
+                self.cache.open, other, Session(urllib2.URLError("down")))
+
+
+class NotModified(Reader):
+    def getcode(self):
+        return 304
+
+
+class Session(object):
+    """Answers every request with 'result', or raises it."""
+
+    def __init__(self, result):
+        self.result = result
+        self.headers = None
+
+    def open(self, url, headers=None):
+        self.headers = headers
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+if __name__ == "__main__":
+    unittest.main()
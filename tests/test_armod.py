@@ -0,0 +1,96 @@
+import os
+import shutil
+import unittest
+import tempfile
+from cStringIO import StringIO
+
+import armod
+import armoparse
+import armoexport
+import armoread
+import armogear
+import armotrace
+
+
+class Handle(object):
+    closed = False
+    fetch = None
+    def close(self):
+        self.closed = True
+
+
+def count_closes(cls, closes):
+    close = cls.close
+    def counting_close(self):
+        closes.append(self)
+        close(self)
+    counting_close.__name__ = "close"
+    cls.close = counting_close
+    return close
+
+
+class RunToolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def run_tool(self, argv):
+        stdout, stderr = StringIO(), StringIO()
+        return armod.run_tool("armoread", argv, self.dir, stdout, stderr)
+
+    def test_hooks_restored(self):
+        hooks = list(armotrace.hooks)
+        for i in range(3):
+            self.run_tool(["--stats", "--no-online", "-i", "1"])
+            self.assertEqual(armotrace.hooks, hooks)
+
+    def test_handles_closed(self):
+        state = armod._save_state()
+        handles = dict([(name, Handle()) for name in ("item_db", "archive",
+                "index", "exporter", "parse_pool", "stats_db")])
+        armoread.set_item_db(handles["item_db"])
+        armoread.set_archive(handles["archive"])
+        armoread.set_index(handles["index"])
+        armoread.set_exporter(handles["exporter"])
+        armoread.set_parse_pool(handles["parse_pool"])
+        armogear.set_stats_db(handles["stats_db"])
+        armod._restore_state(state)
+        for name, handle in handles.items():
+            self.assertTrue(handle.closed, name)
+        self.assertEqual(armoread.get_archive(), state["archive"])
+        self.assertEqual(armogear.get_stats_db(), state["stats_db"])
+
+    def test_closed_once(self):
+        closes = []
+        exporter_close = count_closes(armoexport.Exporter, closes)
+        pool_close = count_closes(armoparse.ParsePool, closes)
+        try:
+            self.run_tool(["--export", "--parse-jobs", "1", "--no-online",
+                    "-i", "1"])
+        finally:
+            armoexport.Exporter.close = exporter_close
+            armoparse.ParsePool.close = pool_close
+        self.assertEqual(sorted([type(h).__name__ for h in closes]),
+                ["Exporter", "ParsePool"])
+        self.assertEqual(armoread.get_exporter(), None)
+        self.assertEqual(armoread.get_parse_pool(), None)
+
+    def test_kept_handles_not_closed(self):
+        archive = Handle()
+        armoread.set_archive(archive)
+        try:
+            state = armod._save_state()
+            armod._restore_state(state)
+            self.assertFalse(archive.closed)
+        finally:
+            armoread.set_archive(None)
+
+
+if __name__ == "__main__":
+    unittest.main()
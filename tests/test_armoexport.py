@@ -0,0 +1,55 @@
+import os
+import csv
+import shutil
+import unittest
+import tempfile
+from cStringIO import StringIO
+
+import armoread
+import armobench
+import armoexport
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_slot_zero(self):
+        char = armoread.Character(u"Char1", u"Trollbane")
+        char.parse_reader(StringIO(armobench.make_character_sheet("Char1",
+                "Trollbane", 3)))
+        self.assertEqual([item.slot for item in char.items], [0, 1, 2])
+        exporter = armoexport.Exporter(self.dir)
+        exporter.add_char(char, 0.0)
+        exporter.close()
+        table = armoexport.load_table("equipped", self.dir)
+        self.assertEqual(list(table["slot"]), [0, 1, 2])
+        self.assertEqual(list(table["item_id"]), [50000, 50001, 50002])
+        rows = list(csv.reader(open(os.path.join(self.dir, "equipped.csv"))))
+        self.assertEqual([row[1:4] for row in rows[1:]], [
+                ["Char1", "0", "50000"], ["Char1", "1", "50001"],
+                ["Char1", "2", "50002"]])
+
+    def test_items(self):
+        exporter = armoexport.Exporter(self.dir)
+        for id, name in (("19019", u"Thunderfury"), ("", u"No id"),
+                (None, u"None"), (u"17182", "Sulfuras")):
+            item = armoread.Item(id)
+            item.name = name
+            item.type = None
+            exporter.add_item(item, 0.0)
+        exporter.close()
+        table = armoexport.load_table("items", self.dir)
+        self.assertEqual(list(table["id"]), [19019, 17182])
+        self.assertEqual(table["name"], [u"Thunderfury", "Sulfuras"])
+        rows = list(csv.reader(open(os.path.join(self.dir, "items.csv"))))
+        self.assertEqual([row[:2] + row[4:5] for row in rows[1:]],
+                [["19019", "Thunderfury", ""], ["17182", "Sulfuras", ""]])
+
+
+if __name__ == "__main__":
+    unittest.main()
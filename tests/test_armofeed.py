@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sqlite3
+import unittest
+import tempfile
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+import armoread
+import armofeed
+import guildrss
+
+REALM = u"Argent Dawn"
+MEMBERS = [u"Aabacus", u"Aabacús"]
+FEED = (u'<?xml version="1.0" encoding="UTF-8"?>'
+        u'<feed xmlns="http://www.w3.org/2005/Atom"><entry><id>%s-1</id>'
+        u'<updated>2010-05-15T12:00:00Z</updated><title>%s@%s</title>'
+        u'</entry></feed>')
+
+
+class FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path)[3])
+        realm = query["r"][0].decode("utf-8")
+        name = query["cn"][0].decode("utf-8")
+        self.server.requested.append((realm, name))
+        body = (FEED % (name, name, realm)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/atom+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FeedUrlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = armofeed.FeedStore(os.path.join(self.dir, "feeds.db"))
+        self.server = FeedServer(("127.0.0.1", 0), FeedHandler)
+        self.server.requested = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.base_url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+    def tearDown(self):
+        armoread.get_session().close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def test_get_feed_url(self):
+        self.assertEqual(guildrss.get_feed_url(REALM, u"Aabacús",
+                "http://eu.wowarmory.com/"), "http://eu.wowarmory.com/"
+                "character-feed.atom?r=Argent+Dawn&cn=Aabac%C3%BAs")
+
+    def test_poll(self):
+        self.store.set_guild(REALM, u"Emerge", MEMBERS, self.base_url)
+        polled, added = armofeed.poll_due(self.store)
+        self.assertEqual((polled, added), (2, 2))
+        self.assertEqual(sorted(self.server.requested),
+                [(REALM, name) for name in MEMBERS])
+
+    def test_moved_urls_replaced(self):
+        db = sqlite3.connect(self.store.path)
+        for name in MEMBERS:
+            db.execute("INSERT INTO feeds (url, realm, guild, name, interval, "
+                    "next_poll) VALUES (?, ?, ?, ?, ?, ?)",
+                    (guildrss.get_feed_url(REALM, name,
+                    "http://www.wowarmory.com/"), REALM, u"Emerge", name,
+                    60.0, 0.0))
+        db.commit()
+        db.close()
+        self.assertEqual(self.store.set_guild(REALM, u"Emerge", MEMBERS,
+                self.base_url), ([], []))
+        polled, added = armofeed.poll_due(self.store)
+        self.assertEqual((polled, added), (2, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
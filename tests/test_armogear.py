@@ -0,0 +1,171 @@
+import os
+import shutil
+import unittest
+import urllib2
+import tempfile
+from StringIO import StringIO
+
+import armonet
+import armoxml
+import armoread
+import armogear
+
+BASE_URL = "http://eu.wowarmory.com/"
+TOOLTIP = ('<page><itemTooltips><itemTooltip><id>%s</id>'
+        '<bonusStamina>53</bonusStamina></itemTooltip></itemTooltips></page>')
+
+
+class LoadItemStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.open_url = armoread.open_url
+        armoread.open_url = self.fake_open_url
+        armogear._item_stats.clear()
+
+    def tearDown(self):
+        armoread.open_url = self.open_url
+        armogear._item_stats.clear()
+
+    def fake_open_url(self, url, max_age=None):
+        id = url.rsplit("=", 1)[1]
+        if id == "2":
+            raise urllib2.URLError("no item 2")
+        return StringIO(TOOLTIP % id)
+
+    def check(self, pool):
+        stats = armogear.load_item_stats([1, 2, 3], BASE_URL, pool)
+        self.assertEqual(sorted(stats), [1, 3])
+
+    def test_serial(self):
+        self.check(None)
+
+    def test_pool(self):
+        self.check(armonet.FetchPool(2))
+
+
+def make_vector(**stats):
+    vector = armogear.new_stat_vector()
+    for name, value in stats.items():
+        vector[armogear.STAT_INDEX[name.replace("_", " ")]] = value
+    return vector
+
+
+class Item(object):
+    enchant_id = 0
+    gems = ()
+    def __init__(self, slot, id):
+        self.slot = slot
+        self.id = id
+
+
+class Char(object):
+    def __init__(self, name, ids):
+        self.name = name
+        self.items = [Item(slot, id) for slot, id in ids]
+    def get_item_ids(self):
+        return [(item.slot, item.id) for item in self.items]
+
+
+class ScoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = armogear.numpy
+
+    def tearDown(self):
+        armogear.numpy = self.numpy
+
+    def score(self):
+        item_stats = {
+            1: make_vector(Strength=10, Stamina=5),
+            2: make_vector(Attack_Power=40),
+            3: make_vector(Spell_Power=50),
+        }
+        chars = [
+            Char("a", [(0, 1), (0, 2), (1, 1)]),
+            # unknown items count as nothing, bad slots are left out
+            Char("b", [(2, 3), (3, 99), (None, 1), (19, 2), (-1, 1)]),
+            Char("c", []),
+        ]
+        return armogear.score_characters(chars, item_stats)
+
+    def check(self, result):
+        self.assertEqual(result.names, ["a", "b", "c"])
+        self.assertEqual([float(s) for s in result.scores], [60.0, 43.0, 0.0])
+        self.assertEqual(result.ranking(), [(60.0, "a"), (43.0, "b"),
+                (0.0, "c")])
+        self.assertEqual(result.get_slots(0), {0: 40.0, 1: 20.0})
+        self.assertEqual(result.get_slots(1), {2: 43.0})
+        stats = result.get_stats(0)
+        self.assertEqual((stats["Strength"], stats["Stamina"],
+                stats["Attack Power"]), (20.0, 10.0, 40.0))
+        self.assertEqual(sum(result.get_stats(2).values()), 0.0)
+
+    def test_numpy(self):
+        if armogear.numpy is None:
+            return
+        self.check(self.score())
+
+    def test_arrays(self):
+        armogear.numpy = None
+        self.check(self.score())
+
+    def test_stat_vector(self):
+        tooltip = armoxml.ItemTooltipHandler()
+        tooltip.values = {"bonusStrength": u"20", "bonusStamina": u"x",
+                "name": u"Helm"}
+        tooltip.texts = [u"+12 Critical Strike Rating and +8 Spirit",
+                u"+5 Nonsense"]
+        self.assertEqual(armogear.get_stat_vector(tooltip), make_vector(
+                Strength=20, Crit_Rating=12, Spirit=8))
+
+
+class ItemStatsDBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "itemstats.db")
+        self.urls = []
+        self.open_url = armoread.open_url
+        armoread.open_url = self.fake_open_url
+        armogear._item_stats.clear()
+
+    def tearDown(self):
+        armoread.open_url = self.open_url
+        armogear.set_stats_db(None)
+        armogear._item_stats.clear()
+        shutil.rmtree(self.dir)
+
+    def fake_open_url(self, url, max_age=None):
+        self.urls.append(url)
+        return StringIO(TOOLTIP % url.rsplit("=", 1)[1])
+
+    def test_round_trip(self):
+        db = armogear.ItemStatsDB(self.path)
+        db.put(1, make_vector(Strength=1.5))
+        db.put(2, make_vector(Haste=7))
+        db.close()
+        db = armogear.ItemStatsDB(self.path)
+        vectors = db.get_many(["1", 2, 3])
+        self.assertEqual(sorted(vectors), [1, 2])
+        self.assertEqual(vectors[1], make_vector(Strength=1.5))
+        db.close()
+        db = armogear.ItemStatsDB(self.path, version="other")
+        self.assertEqual(db.get_many([1, 2]), {})
+        db.close()
+
+    def test_no_refetch(self):
+        armogear.set_stats_db(armogear.ItemStatsDB(self.path))
+        stats = armogear.load_item_stats([1, 2], BASE_URL)
+        self.assertEqual(stats[1], make_vector(Stamina=53))
+        self.assertEqual(len(self.urls), 2)
+        armogear.get_stats_db().close()
+        armogear._item_stats.clear()
+        armogear.set_stats_db(armogear.ItemStatsDB(self.path))
+        stats = armogear.load_item_stats([1, 2, 3], BASE_URL)
+        self.assertEqual(sorted(stats), [1, 2, 3])
+        self.assertEqual(len(self.urls), 3)
+        armogear.get_stats_db().close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import shutil
+import unittest
+import tempfile
+
+import armoxml
+import armohistory
+
+KEY = armoxml.STAT_KEYS[0]
+DAY = armohistory.DAY
+
+
+class Stats(object):
+    def __init__(self, value):
+        self.values = armoxml.new_stats()
+        self.values[0] = value
+
+
+class Item(object):
+    def __init__(self, slot, level):
+        self.slot = slot
+        self.level = level
+
+
+class Character(object):
+    def __init__(self, name, value, levels=(), realm="Trollbane", guild="Emerge"):
+        self.name = name
+        self.realm = realm
+        self.guild_name = guild
+        self.stats = Stats(value)
+        self.items = [Item(slot, level) for slot, level in levels]
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.numpy = armohistory.numpy
+
+    def tearDown(self):
+        armohistory.numpy = self.numpy
+        shutil.rmtree(self.dir)
+
+    def fill(self):
+        history = armohistory.History(self.dir)
+        record = history.record
+        record(Character("a", 10, [(0, 200), (3, 1), (17, 100)]), DAY + 1)
+        record(Character("b", 50, [(0, 180), (99, 500)]), DAY + 2)
+        record(Character("c", 5, [], guild="Other"), DAY + 3)
+        # out of time order, like an import of old sheets
+        record(Character("a", 30, [(0, 210)]), 2 * DAY + 1)
+        record(Character("a", 1, [(0, 190)]), DAY)
+        record(Character("b", 40, [(None, 10)]), 2 * DAY + 5)
+        record(Character("d", 7), 2 * DAY + 6)
+        record(Character("d", 9), 2 * DAY + 6)
+        record(Character("c", 100, guild="Other"), 2 * DAY + 7)
+        return history
+
+    def test_round_trip(self):
+        self.fill()
+        history = armohistory.History(self.dir)
+        self.assertEqual(history.rows, 9)
+        self.assertEqual(history.chars, [["Trollbane", "a"], ["Trollbane", "b"],
+                ["Trollbane", "c"], ["Trollbane", "d"]])
+        self.assertEqual(list(history.load("char")), [0, 1, 2, 0, 0, 1, 3, 3, 2])
+        self.assertEqual(list(history.load("stats")[3])[:2], [30.0, 0.0])
+        self.assertEqual(list(history.load("ilvl")[1])[:2], [180.0, 0.0])
+
+    def test_repair(self):
+        history = self.fill()
+        f = open(history._column_path("time"), 'ab')
+        f.write("\0" * 8)
+        f.close()
+        self.assertEqual(armohistory.History(self.dir).rows, 9)
+
+    def check_queries(self):
+        history = self.fill()
+        levels = history.average_item_level("Trollbane", "Emerge", 0, 3 * DAY)
+        self.assertEqual(levels, [(float(DAY), (150.0 + 180 + 190) / 3),
+                (2 * DAY, (210.0 + 0 + 0 + 0) / 4)])
+        self.assertEqual(history.top_gainers(KEY, 0, 3 * DAY), [
+                (95.0, "Trollbane", "c"), (29.0, "Trollbane", "a"),
+                (2.0, "Trollbane", "d"), (-10.0, "Trollbane", "b")])
+        self.assertEqual(history.top_gainers(KEY, 0, 3 * DAY, n=2,
+                realm="Trollbane", guild="Emerge"),
+                [(29.0, "Trollbane", "a"), (2.0, "Trollbane", "d")])
+        self.assertEqual(history.top_gainers(KEY, DAY + 2, 2 * DAY),
+                [(0.0, "Trollbane", "c"), (0.0, "Trollbane", "b")])
+        self.assertEqual(history.top_gainers(KEY, 10 * DAY, 11 * DAY), [])
+
+    def test_queries(self):
+        if armohistory.numpy is None:
+            return
+        self.check_queries()
+
+    def test_queries_without_numpy(self):
+        armohistory.numpy = None
+        self.check_queries()
+
+
+if __name__ == "__main__":
+    unittest.main()
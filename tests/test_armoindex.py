@@ -0,0 +1,82 @@
+import os
+import shutil
+import unittest
+import tempfile
+from collections import namedtuple
+
+import armoindex
+
+Item = namedtuple("Item", "id slot enchant_id gems")
+Record = namedtuple("Record", "id")
+
+
+class Character(object):
+    def __init__(self, name, items, glyphs=(), professions=(),
+            realm=u"Trollbane", guild=u"Emerge"):
+        self.name = name
+        self.realm = realm
+        self.guild_name = guild
+        self.items = [Item(*item) for item in items]
+        self.glyphs = [Record(id) for id in glyphs]
+        self.professions = [Record(id) for id in professions]
+
+
+class QueryTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(armoindex.parse_query("a or b AND not c"),
+                ("or", ("term", "a"), ("and", ("term", "b"),
+                ("not", ("term", "c")))))
+        self.assertEqual(armoindex.parse_query("(a OR b) AND c:1@0"),
+                ("and", ("or", ("term", "a"), ("term", "b")), ("term", "c:1@0")))
+        for query in ("", "a AND", "(a OR b", "a b", "NOT", ")"):
+            self.assertRaises(armoindex.QueryError, armoindex.parse_query, query)
+
+    def test_terms(self):
+        char = Character(u"A", [(50415, 0, 44150, (41380, 0, 0)),
+                (50000, None, 0, ())], glyphs=[510, 0], professions=[333])
+        self.assertEqual(armoindex.get_terms(char), set([
+                "item:50415", "item:50415@0", "enchant:44150",
+                "enchant:44150@0", "gem:41380", "gem:41380@0", "item:50000",
+                "glyph:510", "profession:333"]))
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = armoindex.Index(os.path.join(self.dir, "index.db"))
+        self.index.add(Character(u"A", [(1, 0, 10, (100, 0, 0)), (2, 1, 0, ())],
+                professions=[333]))
+        self.index.add(Character(u"B", [(1, 0, 11, (101, 0, 0))]))
+        self.index.add(Character(u"C", [(2, 0, 0, ())], guild=u"Other"))
+        self.index.add(Character(u"D", [(1, 5, 0, ())], realm=u"Other"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def names(self, query, realm=None, guild=None):
+        return [name for realm, name in self.index.query(query, realm, guild)]
+
+    def test_query(self):
+        self.assertEqual(self.names("item:1"), [u"D", u"A", u"B"])
+        self.assertEqual(self.names("item:1", u"Trollbane"), [u"A", u"B"])
+        self.assertEqual(self.names("item:1@0"), [u"A", u"B"])
+        self.assertEqual(self.names("item:1 AND item:2"), [u"A"])
+        self.assertEqual(self.names("gem:100 OR enchant:11"), [u"A", u"B"])
+        self.assertEqual(self.names("item:1 AND NOT profession:333"),
+                [u"D", u"B"])
+        self.assertEqual(self.names("NOT item:1 and (item:2)"), [u"C"])
+        self.assertEqual(self.names("NOT item:1", guild=u"Emerge"), [])
+        self.assertEqual(self.names("not item:1", u"Trollbane"), [u"C"])
+        self.assertEqual(self.names("item:3"), [])
+
+    def test_replace(self):
+        self.index.add(Character(u"B", [(3, 0, 0, ())]))
+        self.assertEqual(self.names("item:1", u"Trollbane"), [u"A"])
+        self.assertEqual(self.names("item:3"), [u"B"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import shutil
+import unittest
+import tempfile
+import urllib2
+from StringIO import StringIO
+
+import armonet
+import armoitems
+
+BASE_URL = "http://eu.wowarmory.com/"
+INFO = ('<page><itemInfo><item icon="x" id="%s" level="245" name="Item %s" '
+        'quality="4" type="Plate"/></itemInfo></page>')
+TOOLTIP = ('<page><itemTooltips><itemTooltip><id>%s</id>'
+        '<bonusStamina>53</bonusStamina></itemTooltip></itemTooltips></page>')
+
+
+def fetch(url):
+    """Item 2 fails, the others are fine."""
+    id = armoitems.get_item_id(url)
+    if id == 2:
+        raise urllib2.URLError("no item 2")
+    if "tooltip" in url:
+        return StringIO(TOOLTIP % id)
+    return StringIO(INFO % (id, id))
+
+
+class ResolveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = armoitems.ItemDB(os.path.join(self.dir, "items.db"), fetch)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def check(self, pool):
+        items = self.db.resolve([1, 2, 3], BASE_URL, pool)
+        self.assertEqual(sorted(items), [1, 3])
+        self.assertEqual(items[3].name, u"Item 3")
+
+    def test_serial(self):
+        self.check(None)
+
+    def test_pool(self):
+        self.check(armonet.FetchPool(2))
+
+    def test_stored(self):
+        self.db.resolve([1], BASE_URL)
+        self.db.close()
+        self.db = armoitems.ItemDB(os.path.join(self.dir, "items.db"), None)
+        url = "http://eu.wowarmory.com/item-tooltip.xml?i=1"
+        self.assertTrue(self.db.handles(url))
+        self.assertEqual(self.db.open_url(url).read(), TOOLTIP % 1)
+        self.assertEqual(self.db.resolve([1], BASE_URL)[1].name, u"Item 1")
+        self.assertEqual((self.db.hits, self.db.misses), (2, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
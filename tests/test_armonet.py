@@ -0,0 +1,186 @@
+import gzip
+import time
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+
+import armonet
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.path)
+        if server.errors:
+            server.errors -= 1
+            self.send_response(503)
+            self.send_header("content-length", "0")
+            self.end_headers()
+            return
+        body = "line 1\nline 2\n" * 100
+        self.send_response(200)
+        if "gzip" in (self.headers.getheader("accept-encoding") or ""):
+            f = StringIO()
+            g = gzip.GzipFile(fileobj=f, mode="wb")
+            g.write(body)
+            g.close()
+            body = f.getvalue()
+            self.send_header("content-encoding", "gzip")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients dropping unread responses
+        pass
+
+
+class SessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.connections = 0
+        self.server.errors = 0
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/a" % self.server.server_address[1]
+        self.session = armonet.Session()
+        self.backoff = armonet.BACKOFF
+        armonet.BACKOFF = 0.01
+
+    def tearDown(self):
+        armonet.BACKOFF = self.backoff
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for i in range(3):
+            self.assertEqual(len(self.session.open(self.url).read()), 1400)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_unread_response_dropped(self):
+        self.session.open(self.url).close()
+        self.session.open(self.url).read()
+        self.assertEqual(self.server.connections, 2)
+
+    def test_gzip(self):
+        reader = self.session.open(self.url)
+        self.assertEqual(reader.info().getheader("content-encoding"), "gzip")
+        self.assertEqual(reader.readline(), "line 1\n")
+        self.assertEqual(reader.read(7), "line 2\n")
+        self.assertEqual(len(reader.readlines()), 198)
+        self.assertEqual(reader.read(), "")
+
+    def test_retry_throttled(self):
+        self.server.errors = 2
+        self.session.limiter = armonet.RateLimiter(rate=0)
+        self.assertEqual(self.session.open(self.url).getcode(), 200)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.session.limiter.retries, 2)
+        self.assertEqual(self.session.limiter.throttled, 2)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_bucket(self):
+        bucket = armonet.TokenBucket(rate=100, burst=5)
+        start = time.time()
+        for i in range(15):
+            bucket.acquire()
+        # 5 at once, then 10 at 100 per second
+        self.assertTrue(0.08 <= time.time() - start < 0.5)
+        bucket.slow_down()
+        self.assertEqual(bucket.rate, 50)
+        bucket.speed_up()
+        self.assertEqual(bucket.rate, 55)
+
+    def test_retry_budget(self):
+        limiter = armonet.RateLimiter(max_retries=3, retry_budget=4)
+        self.assertEqual(limiter.retry(3), None)
+        delays = [limiter.retry(0) for i in range(5)]
+        self.assertEqual(delays[4], None)
+        self.assertTrue(0 <= min(delays[:4]) and max(delays[:4]) <= 1.0)
+        limiter.success("a")
+        self.assertEqual(limiter.retry(0), None)
+        for i in range(10):
+            limiter.success("a")
+        self.assertNotEqual(limiter.retry(1), None)
+
+    def test_breaker(self):
+        limiter = armonet.RateLimiter(rate=0, breaker_threshold=2,
+                breaker_cooldown=60)
+        limiter.wait("a")
+        limiter.failure("a")
+        limiter.failure("a")
+        self.assertRaises(armonet.CircuitOpen, limiter.wait, "a")
+        limiter.wait("b")
+        breaker = limiter._get("a")[1]
+        breaker.opened -= 60
+        limiter.wait("a")
+        # half open: one request at a time until one succeeds
+        self.assertRaises(armonet.CircuitOpen, limiter.wait, "a")
+        limiter.success("a")
+        limiter.wait("a")
+        limiter.wait("a")
+
+
+class FetchPoolTest(unittest.TestCase):
+
+    def test_bounds(self):
+        lock = threading.Lock()
+        running = {"a": 0, "b": 0}
+        most = {"a": 0, "b": 0, "all": 0}
+        def job(host):
+            lock.acquire()
+            running[host] += 1
+            most[host] = max(most[host], running[host])
+            most["all"] = max(most["all"], sum(running.values()))
+            lock.release()
+            time.sleep(0.02)
+            lock.acquire()
+            running[host] -= 1
+            lock.release()
+        pool = armonet.FetchPool(jobs=3, per_host=2)
+        for i in range(10):
+            for host in ("a", "b"):
+                pool.add("http://%s/%d" % (host, i), job, host)
+        self.assertEqual(pool.join(), [])
+        self.assertEqual(pool.done, 20)
+        self.assertEqual(most, {"a": 2, "b": 2, "all": 3})
+
+    def test_per_host_default(self):
+        self.assertEqual(armonet.FetchPool(jobs=12).per_host, 12)
+
+    def test_failures(self):
+        def job(i):
+            if i % 3 == 0:
+                raise ValueError(i)
+        pool = armonet.FetchPool(jobs=2)
+        for i in range(7):
+            pool.add("http://a/%d" % i, job, i)
+        failures = pool.join()
+        self.assertEqual(sorted([url for url, e in failures]),
+                ["http://a/0", "http://a/3", "http://a/6"])
+        self.assertEqual(pool.done, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+import urllib2
+from StringIO import StringIO
+
+import armonet
+import armoread
+import armoparse
+
+ITEM = ('<page><itemInfo><item icon="x" id="%s" level="245" name="Item %s" '
+        'quality="4" type="Plate"/></itemInfo></page>')
+
+
+class ParsePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+
+    def make_pool(self, processes, max_pending=None):
+        pool = armoparse.ParsePool(processes, max_pending)
+        self.pools.append(pool)
+        return pool
+
+    def documents(self, n, taken):
+        for i in range(n):
+            taken.append(i)
+            if i == 3:
+                yield i, "<page><itemInfo>"
+            else:
+                yield i, ITEM % (i, i)
+
+    def check_imap(self, pool):
+        taken = []
+        results = {}
+        for key, record, error in pool.imap("item", self.documents(20, taken)):
+            # documents are only read while there is room for them
+            self.assertTrue(len(taken) - len(results) <= pool.max_pending + 1)
+            results[key] = (record, error)
+        self.assertEqual(sorted(results), range(20))
+        self.assertEqual(results[5][0].name, u"Item 5")
+        self.assertEqual(results[5][1], None)
+        self.assertEqual(results[3][0], None)
+        self.assertTrue(results[3][1].startswith("ExpatError"))
+
+    def test_imap_in_thread(self):
+        pool = self.make_pool(0, 4)
+        self.check_imap(pool)
+
+    def test_imap_processes(self):
+        pool = self.make_pool(2, 3)
+        self.check_imap(pool)
+
+    def test_in_thread_order(self):
+        pool = self.make_pool(0)
+        keys = [key for key, record, error in
+                pool.imap("item", self.documents(10, []))]
+        self.assertEqual(keys, range(10))
+
+    def test_backpressure(self):
+        pool = self.make_pool(0, 2)
+        self.assertTrue(pool.submit("item", ITEM % (1, 1), 1, block=False))
+        self.assertTrue(pool.submit("item", ITEM % (2, 2), 2, block=False))
+        self.assertFalse(pool.submit("item", ITEM % (3, 3), 3, block=False))
+        self.assertEqual(pool.get()[0], 1)
+        self.assertTrue(pool.submit("item", ITEM % (3, 3), 3, block=False))
+        self.assertEqual([pool.get()[0], pool.get()[0]], [2, 3])
+
+    def test_parse_document(self):
+        pool = self.make_pool(1)
+        pool.submit("roster", '<page><character name="A" level="80"/>'
+                '<character name="B" level="x"/></page>', "g")
+        key, records, error = pool.get()
+        self.assertEqual([(r.name, r.level) for r in records],
+                [(u"A", 80), (u"B", 0)])
+        pool.submit("nonsense", "<page/>", "n")
+        self.assertTrue("ValueError" in pool.get()[2])
+
+
+class FetchAndParseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.open_url = armoread.open_url
+        armoread.open_url = self.fake_open_url
+
+    def tearDown(self):
+        armoread.open_url = self.open_url
+
+    def fake_open_url(self, url, max_age=None):
+        id = url.rsplit("/", 1)[1]
+        if id == "2":
+            raise urllib2.URLError("no item 2")
+        return StringIO(ITEM % (id, id))
+
+    def test_fetch_and_parse(self):
+        fetch_pool = armonet.FetchPool(3)
+        parse_pool = armoparse.ParsePool(0, 2)
+        jobs = [(i, "http://a/%d" % i, "item") for i in range(10)]
+        results = list(armoparse.fetch_and_parse(jobs, fetch_pool, parse_pool))
+        self.assertEqual(sorted([key for key, record, error in results]),
+                [0, 1, 3, 4, 5, 6, 7, 8, 9])
+        self.assertEqual([url for url, e in fetch_pool.failures], ["http://a/2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
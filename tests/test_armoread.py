@@ -0,0 +1,204 @@
+import os
+import sys
+import shutil
+import unittest
+import tempfile
+import urllib2
+import subprocess
+from StringIO import StringIO
+
+import armonet
+import armotrace
+import armoread
+
+BASE_URL = "http://eu.wowarmory.com/"
+INFO = ('<page><itemInfo><item icon="x" id="%s" level="245" name="Item %s" '
+        'quality="4" type="Plate"/></itemInfo></page>')
+ROSTER = """<page><guildInfo><guildHeader battleGroup="Reckoning" count="2"
+    faction="0" name="Emerge" realm="Trollbane"/><guild>
+<members memberCount="2">
+<character achPoints="105" classId="1" genderId="1" level="80" name="Aabacus"
+    raceId="4" rank="1" url="r=Trollbane&amp;cn=Aabacus"/>
+<character achPoints="90" classId="2" genderId="0" level="70" name="Babacus"
+    raceId="1" rank="3" url="r=Trollbane&amp;cn=Babacus"/>
+</members></guild></guildInfo></page>"""
+SHEET = """<page><characterInfo>
+<character classId="1" class="Warrior" guildName="Emerge" level="80"
+    name="%s" points="3080" realm="Trollbane"/>
+<characterTab>
+<talentSpecs><talentSpec active="0" group="1" prim="Arms"/><talentSpec
+    active="1" group="2" prim="Protection"/></talentSpecs>
+<baseStats><strength attack="200" base="150" block="10" effective="180"/>
+    </baseStats>
+<items><item id="50000" level="232" name="Helm" rarity="4" slot="0"
+    gem0Id="40000" permanentEnchantItemId="44000"/>
+    <item id="50001" level="245" name="Neck" slot="1"/></items>
+</characterTab></characterInfo></page>"""
+
+
+class Char(object):
+    items = []
+    def __init__(self, ids):
+        self.ids = ids
+    def get_item_ids(self):
+        return [(0, id) for id in self.ids]
+
+
+class ResolveItemsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.open_url = armoread.open_url
+        armoread.open_url = self.fake_open_url
+
+    def tearDown(self):
+        armoread.open_url = self.open_url
+
+    def fake_open_url(self, url, max_age=None):
+        id = url.rsplit("=", 1)[1]
+        if id == "2":
+            raise urllib2.URLError("no item 2")
+        return StringIO(INFO % (id, id))
+
+    def check(self, pool):
+        items = armoread.resolve_items([Char([1, 2]), Char([3])], BASE_URL, pool)
+        self.assertEqual(sorted(items), [1, 3])
+        self.assertEqual(items[3].name, u"Item 3")
+
+    def test_serial(self):
+        self.check(None)
+
+    def test_pool(self):
+        self.check(armonet.FetchPool(2))
+
+
+class ModelTest(unittest.TestCase):
+
+    def test_character(self):
+        char = armoread.Character()
+        char.parse_reader(StringIO(SHEET % "Aabacus"))
+        self.assertEqual((char.name, char.realm, char.level, char.ach_points),
+                (u"Aabacus", u"Trollbane", 80, 3080))
+        self.assertEqual(char.stats["baseStats/strength/effective"], 180)
+        self.assertEqual(char.stats.get("no/such/stat", -1), -1)
+        self.assertEqual([(i.name, i.slot, i.gems) for i in char.items],
+                [(u"Helm", 0, (40000, 0, 0)), (u"Neck", 1, (0, 0, 0))])
+        self.assertEqual(char.get_item_ids(), [(0, 50000), (0, 44000),
+                (0, 40000), (1, 50001)])
+        self.assertEqual(char.get_active_spec().prim, u"Protection")
+        self.assertRaises(AttributeError, setattr, char, "nickname", u"x")
+
+    def test_guild(self):
+        guild = armoread.Guild()
+        guild.parse_reader(StringIO(ROSTER))
+        self.assertEqual((guild.name, guild.realm, guild.member_count),
+                (u"Emerge", u"Trollbane", 2))
+        self.assertEqual([(m.name, m.level, m.rank) for m in guild.members],
+                [(u"Aabacus", 80, 1), (u"Babacus", 70, 3)])
+
+    def test_item(self):
+        item = armoread.Item()
+        item.parse_reader(StringIO(INFO % (19019, "Thunderfury")))
+        self.assertEqual((item.id, item.name, item.level, item.rarity),
+                (19019, u"Item Thunderfury", 245, 4))
+
+
+class LazyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.urls = []
+        self.open_url = armoread.open_url
+        armoread.open_url = self.fake_open_url
+
+    def tearDown(self):
+        armoread.open_url = self.open_url
+
+    def fake_open_url(self, url, max_age=None):
+        self.urls.append(url)
+        if "guild-info" in url:
+            return StringIO(ROSTER)
+        return StringIO(SHEET % url.rsplit("=", 1)[1])
+
+    def test_character(self):
+        char = armoread.Character("Aabacus", "Trollbane", BASE_URL)
+        self.assertEqual(char.name, "Aabacus")
+        self.assertFalse(char.is_loaded())
+        self.assertEqual(self.urls, [])
+        self.assertEqual(len(char.items), 2)
+        self.assertEqual(char.stats["baseStats/strength/effective"], 180)
+        self.assertEqual(len(self.urls), 1)
+        self.assertTrue(char.is_loaded())
+
+    def test_guild(self):
+        guild = armoread.Guild("Emerge", "Trollbane", BASE_URL)
+        self.assertEqual(self.urls, [])
+        members = guild.members
+        self.assertEqual(guild.member_count, 2)
+        self.assertEqual(len(self.urls), 1)
+        # members only fetch their sheets when their items or stats are used
+        self.assertEqual([m.level for m in members], [80, 70])
+        self.assertEqual(len(self.urls), 1)
+        self.assertEqual(len(members[1].items), 2)
+        self.assertEqual(len(self.urls), 2)
+        self.assertTrue(self.urls[1].endswith("n=Babacus"))
+
+
+class WriteAtomicallyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "a.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write(self):
+        armoread.write_str_to_file("new", self.path)
+        self.assertEqual(open(self.path).read(), "new")
+        self.assertEqual(os.listdir(self.dir), ["a.xml"])
+
+    def test_failed_write(self):
+        armoread.write_str_to_file("old", self.path)
+        def write(outfile):
+            outfile.write("half")
+            raise ValueError("write failed")
+        self.assertRaises(ValueError, armoread.write_atomically, self.path,
+                write)
+        self.assertEqual(open(self.path).read(), "old")
+        self.assertEqual(os.listdir(self.dir), ["a.xml"])
+
+    def test_failed_hook(self):
+        def hook(*args):
+            raise RuntimeError("hook failed")
+        armotrace.add_hook(hook)
+        try:
+            self.assertRaises(RuntimeError, armoread.write_str_to_file, "new",
+                    self.path)
+        finally:
+            armotrace.remove_hook(hook)
+        self.assertEqual(open(self.path).read(), "new")
+
+    def test_failed_rename(self):
+        os.mkdir(self.path)
+        os.mkdir(os.path.join(self.path, "x"))
+        self.assertRaises(OSError, armoread.write_str_to_file, "new",
+                self.path)
+        self.assertEqual(os.listdir(self.dir), ["a.xml"])
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_lazy(self):
+        dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = ("import sys, armoread\n"
+                "armoread.get_charactersheet_url('A', 'B', 'http://a/')\n"
+                "print ' '.join(sys.modules)")
+        modules = subprocess.Popen([sys.executable, "-c", code], cwd=dir,
+                stdout=subprocess.PIPE).communicate()[0].split()
+        self.assertTrue("armoread" in modules)
+        for name in ("armonet", "armocache", "armoxml", "httplib", "urllib2",
+                "xml.dom.minidom"):
+            self.assertFalse(name in modules, name)
+
+
+if __name__ == "__main__":
+    unittest.main()
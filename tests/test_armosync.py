@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import shutil
+import unittest
+import tempfile
+import urllib2
+import urlparse
+from StringIO import StringIO
+
+import armoread
+import armosync
+
+BASE_URL = "http://eu.wowarmory.com/"
+ROSTER = u"""<page><guildInfo><guild><members>
+<character achPoints="105" classId="1" genderId="1" level="80" name="Aabacus"
+    raceId="4" rank="1"/>
+<character achPoints="2210" classId="2" genderId="0" level="80"
+    name="Aabacús" raceId="1" rank="2"/>
+</members></guild></guildInfo></page>""".encode("utf-8")
+SHEET = (u'<page><characterInfo><character name="%s" level="80" '
+        u'lastModified="1 May 2010"/></characterInfo></page>')
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.open_url = armoread.open_url
+        armoread.open_url = self.fake_open_url
+
+    def tearDown(self):
+        armoread.open_url = self.open_url
+        shutil.rmtree(self.dir)
+
+    def fake_open_url(self, url, max_age=None):
+        # what urllib2 lets through
+        if isinstance(url, unicode) or re.search(r"[^\x21-\x7e]", url):
+            raise urllib2.URLError("bad url %r" % url)
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        query = urlparse.parse_qs(query)
+        self.assertEqual(query["r"], ["Argent Dawn"])
+        if path.endswith("guild-info.xml"):
+            return StringIO(ROSTER)
+        name = query["n"][0].decode("utf-8")
+        return StringIO((SHEET % name).encode("utf-8"))
+
+    def test_non_ascii_member(self):
+        chars_dir = os.path.join(self.dir, "chars")
+        os.mkdir(chars_dir)
+        changes = armosync.sync_guild(u"Argent Dawn", u"Emerge", BASE_URL,
+                write=True, snapshot_dir=self.dir, chars_dir=chars_dir)
+        self.assertEqual([(c, n) for c, n, d in changes],
+                [("joined", u"Aabacus"), ("joined", u"Aabacús")])
+        snapshot = armosync.load_snapshot(armosync.get_snapshot_path(
+                u"Argent Dawn", u"Emerge", self.dir))
+        self.assertEqual(snapshot["members"][u"Aabacús"]["lastModified"],
+                u"1 May 2010")
+        self.assertEqual(sorted(os.listdir(chars_dir)),
+                ["Aabacus.xml", u"Aabacús.xml".encode("utf-8")])
+
+    def test_no_write(self):
+        changes = armosync.sync_guild(u"Argent Dawn", u"Emerge", BASE_URL,
+                write=False, snapshot_dir=self.dir, chars_dir=self.dir)
+        self.assertEqual(len(changes), 2)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
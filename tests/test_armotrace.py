@@ -0,0 +1,59 @@
+import unittest
+from cStringIO import StringIO
+
+import armoxml
+import armotrace
+
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = armotrace.Stats(slowest=2)
+        armotrace.add_hook(self.stats)
+
+    def tearDown(self):
+        armotrace.remove_hook(self.stats)
+
+    def test_counts(self):
+        armotrace.emit("ttfb", "http://a/1", 0.5)
+        armotrace.emit("ttfb", "http://a/2", 0.25)
+        armotrace.emit("ttfb", "http://a/3", 1.0)
+        armotrace.emit("transfer", "http://a/1", 0.1, 2000)
+        armotrace.emit("cache", "http://a/1", 0.0, cached=True)
+        armotrace.emit("cache", "http://a/2", 0.0, cached=False)
+        armotrace.emit("cache", "http://a/3", 0.0, cached=False)
+        stats = self.stats
+        self.assertEqual(stats.count["ttfb"], 3)
+        self.assertEqual(stats.seconds["ttfb"], 1.75)
+        self.assertEqual(stats.bytes["transfer"], 2000)
+        self.assertEqual((stats.hits, stats.misses), (1, 2))
+        self.assertEqual(stats.worst["ttfb"], [(1.0, "http://a/3"),
+                (0.5, "http://a/1")])
+        lines = stats.summary()
+        self.assertTrue("cache: 1 hits, 2 misses" in lines)
+        self.assertEqual(len([l for l in lines if l.startswith("ttfb")]), 1)
+
+    def test_parse(self):
+        data = "<page>%s</page>" % ("<a/>" * 1000)
+        armoxml.parse(StringIO(data), armoxml.ItemInfoHandler(), 100)
+        self.assertEqual(self.stats.count["parse"], 1)
+        self.assertEqual(self.stats.bytes["parse"], len(data))
+
+
+class HooksTest(unittest.TestCase):
+
+    def test_add_remove(self):
+        events = []
+        armotrace.add_hook(events.append)
+        try:
+            armotrace.emit("write", "a.xml", 0.1, 10)
+        finally:
+            armotrace.remove_hook(events.append)
+        armotrace.emit("write", "b.xml", 0.1, 10)
+        self.assertEqual(events, [armotrace.Event("write", "a.xml", 0.1, 10,
+                None)])
+        self.assertEqual(armotrace.hooks, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+import xml.dom.minidom
+from cStringIO import StringIO
+
+import armoxml
+
+ROSTER = """<page><guildInfo><guild><members>
+<character achPoints="105" classId="1" genderId="1" level="80" name="Aabacus"
+    raceId="4" rank="1" url="r=Trollbane&amp;cn=Aabacus"/>
+<character achPoints="n/a" classId="2" genderId="0" level="7.5" name="Odd"
+    raceId="" rank="?" url="r=Trollbane&amp;cn=Odd"/>
+</members></guild></guildInfo></page>"""
+SHEET = """<?xml version="1.0" encoding="UTF-8"?><page><characterInfo>
+<character classId="1" class="Warrior" guildName="Emerge" level="80"
+    name="Aabacus" points="3080" realm="Trollbane"/>
+<characterTab>
+<talentSpecs><talentSpec active="1" group="1" prim="Protection" treeOne="14"
+    treeThree="54" treeTwo="3"/></talentSpecs>
+<professions><skill id="164" key="blacksmithing" max="450"
+    name="Blacksmithing" value="450"/></professions>
+<baseStats><strength attack="200" base="150" block="10" effective="180"/>
+    <stamina base="120" effective="n/a"/></baseStats>
+<defenses><armor base="9000" effective="9100.5" percent="50.1"/></defenses>
+<items><item id="50000" level="232" name="Helm" rarity="4" slot="0"/>
+    <item id="50001" level="245" name="Neck" slot="1" gem0Id="40000"/></items>
+<glyphs><glyph id="510" name="Glyph of Revenge" type="major"/></glyphs>
+</characterTab></characterInfo></page>"""
+
+
+class ToIntTest(unittest.TestCase):
+
+    def test_values(self):
+        self.assertEqual(armoxml.to_int("12"), 12)
+        self.assertEqual(armoxml.to_int("12.7"), 12)
+        self.assertEqual(armoxml.to_int(""), 0)
+        self.assertEqual(armoxml.to_int(None, -1), -1)
+        self.assertEqual(armoxml.to_int("n/a"), 0)
+        self.assertEqual(armoxml.to_int("inf"), 0)
+
+    def test_roster(self):
+        members = list(armoxml.iter_roster(StringIO(ROSTER)))
+        self.assertEqual([m.name for m in members], [u"Aabacus", u"Odd"])
+        self.assertEqual(members[1].achPoints, 0)
+        self.assertEqual(members[1].level, 7)
+        self.assertEqual(members[1].rank, 0)
+
+
+class RecordTest(unittest.TestCase):
+
+    def test_elements(self):
+        for chunk_size in (1, 7, 4096):
+            elements = list(armoxml.iter_elements(StringIO(ROSTER),
+                    ("character",), chunk_size))
+            self.assertEqual([attrs["name"] for tag, attrs in elements],
+                    [u"Aabacus", u"Odd"])
+
+    def test_character_sheet(self):
+        records = list(armoxml.iter_character_sheet(StringIO(SHEET)))
+        self.assertEqual(len(records), 3)
+        info = records[0]
+        self.assertEqual((info.name, info.realm, info.level, info.points),
+                (u"Aabacus", u"Trollbane", 80, 3080))
+        self.assertEqual((info.raceId, info.suffix), (0, u""))
+        self.assertEqual([(r.id, r.slot, r.gem0Id) for r in records[1:]],
+                [(50000, 0, 0), (50001, 1, 40000)])
+
+
+class CharacterSheetHandlerTest(unittest.TestCase):
+
+    def check(self, sheet):
+        index = armoxml.STAT_INDEX
+        self.assertEqual(sheet.info.name, u"Aabacus")
+        self.assertEqual(sheet.stats[index["baseStats/strength/effective"]], 180)
+        self.assertEqual(sheet.stats[index["baseStats/stamina/effective"]], 0)
+        self.assertEqual(sheet.stats[index["defenses/armor/effective"]], 9100.5)
+        self.assertEqual(sheet.stats[index["baseStats/armor/effective"]], 0)
+        self.assertEqual([i.name for i in sheet.items], [u"Helm", u"Neck"])
+        self.assertEqual([(s.prim, s.treeThree) for s in sheet.talent_specs],
+                [(u"Protection", 54)])
+        self.assertEqual([(p.key, p.value) for p in sheet.professions],
+                [(u"blacksmithing", 450)])
+        self.assertEqual([g.id for g in sheet.glyphs], [510])
+
+    def test_parse(self):
+        self.check(armoxml.parse(StringIO(SHEET),
+                armoxml.CharacterSheetHandler(), chunk_size=16))
+
+    def test_walk_dom(self):
+        dom = xml.dom.minidom.parseString(SHEET)
+        self.check(armoxml.walk_dom(dom, armoxml.CharacterSheetHandler()))
+
+
+if __name__ == "__main__":
+    unittest.main()
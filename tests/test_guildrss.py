@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import unittest
+import tempfile
+from cStringIO import StringIO
+
+import armoxml
+import armoread
+import guildrss
+
+US_URL = "http://us.wowarmory.com/"
+
+
+def member(name, rank):
+    return armoxml.RosterCharacter(name, rank, 80, 1, 0, 1, 100, u"")
+
+
+class OpmlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "opml.xml")
+        self.iter_guild_roster = armoread.iter_guild_roster
+        self.fetched = []
+        armoread.iter_guild_roster = self.fake_iter_guild_roster
+        self.roster = [member(u"Aabacus", 0), member(u"Babacus", 1)]
+
+    def tearDown(self):
+        armoread.iter_guild_roster = self.iter_guild_roster
+        shutil.rmtree(self.dir)
+
+    def fake_iter_guild_roster(self, realm, guild, base_url):
+        self.fetched.append((realm, guild, base_url))
+        return iter(self.roster)
+
+    def test_opml_doc_base_url(self):
+        ranks, groups = guildrss.parse_ranks("0 1")
+        doc = guildrss.get_opml_doc(ranks, groups, u"Trollbane", u"Emerge",
+                US_URL)
+        urls = [e.getAttribute("xmlUrl")
+                for e in doc.getElementsByTagName("outline")
+                if e.getAttribute("type") == "rss"]
+        self.assertEqual(len(urls), 2)
+        for url in urls:
+            self.assertTrue(url.startswith(US_URL + "character-feed.atom?"))
+
+    def test_update_rewrite_keeps_roster(self):
+        ranks, groups = guildrss.parse_ranks("0 1")
+        guildrss.write_opml_file(self.filename, ranks, groups, u"Trollbane",
+                u"Emerge", US_URL, iter(self.roster[:1]))
+        # drop the empty group of rank 1, so the new member has nowhere to go
+        lines = [line for line in open(self.filename)
+                if 'text="Officer"' not in line]
+        open(self.filename, "w").writelines(lines)
+        changes = guildrss.update_opml(self.filename, ranks, groups,
+                u"Trollbane", u"Emerge", US_URL, iter(self.roster))
+        self.assertEqual(changes, None)
+        self.assertEqual(self.fetched, [])
+        self.assertEqual(guildrss.read_opml_feeds(self.filename), {
+                guildrss.get_feed_url(u"Trollbane", u"Aabacus", US_URL).replace(
+                    "&", "&amp;"): "Guild Master",
+                guildrss.get_feed_url(u"Trollbane", u"Babacus", US_URL).replace(
+                    "&", "&amp;"): "Officer"})
+
+
+class CombinedOpmlTest(unittest.TestCase):
+
+    def test_missing_roster(self):
+        guilds = [
+            {"area": "EU", "realm": u"Trollbane", "guild": u"Emerge",
+                "map": "0 1"},
+            {"area": "US", "realm": u"Argent Dawn", "guild": u"Gone",
+                "map": "0 1"},
+        ]
+        rosters = {("EU", u"Trollbane", u"Emerge"): [member(u"Aabacus", 0)]}
+        out = StringIO()
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            guildrss.write_combined_opml(out, guilds, rosters, u"1 guilds")
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue("Gone@Argent Dawn" in errors)
+        opml = out.getvalue()
+        self.assertTrue("Trollbane (EU)" in opml)
+        self.assertFalse("Argent Dawn" in opml)
+
+
+if __name__ == "__main__":
+    unittest.main()